@@ -0,0 +1,32 @@
+"""Time taken by imports of modl in a fresh interpreter, and heavy
+dependencies they pull in"""
+import subprocess
+import sys
+
+statements = ['import modl',
+              'from modl import DictFact',
+              'from modl import RecsysDictFact',
+              'from modl import ImageDictFact',
+              'from modl import fMRIDictFact',
+              'from modl.datasets import fetch_adhd']
+dependencies = ['nilearn', 'nibabel', 'pandas', 'skimage', 'joblib',
+                'matplotlib']
+
+code = """
+import sys, time
+t0 = time.perf_counter()
+%s
+print(time.perf_counter() - t0)
+print(' '.join(name for name in %r if name in sys.modules))
+"""
+
+n_repeats = 5
+
+for statement in statements:
+    timings = []
+    for _ in range(n_repeats):
+        output = subprocess.check_output(
+            [sys.executable, '-c', code % (statement, dependencies)])
+        timing, loaded = (output.decode().split('\n') + [''])[:2]
+        timings.append(float(timing))
+    print('%-40s %.3fs  %s' % (statement, min(timings), loaded))
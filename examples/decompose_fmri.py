@@ -4,18 +4,14 @@
 import matplotlib as mpl
 mpl.use('Qt5Agg')
 
-from nilearn.datasets import fetch_atlas_smith_2009
-from modl.input_data.fmri.fixes import monkey_patch_nifti_image
-
-monkey_patch_nifti_image()
-
 import matplotlib.pyplot as plt
-from sklearn.externals.joblib import Memory
+from nilearn.datasets import fetch_atlas_smith_2009
 from sklearn.model_selection import train_test_split
 
 from modl.datasets import fetch_adhd
 from modl.decomposition.fmri import fMRIDictFact, rfMRIDictionaryScorer
 from modl.plotting.fmri import display_maps
+from modl.utils.hashing import FingerprintMemory
 from modl.utils.system import get_cache_dirs
 
 
@@ -39,8 +35,8 @@ train_data, test_data = train_test_split(data, test_size=1, random_state=0)
 train_imgs, train_confounds = zip(*train_data)
 test_imgs, test_confounds = zip(*test_data)
 mask = dataset.mask
-memory = Memory(cachedir=get_cache_dirs()[0],
-                verbose=2)
+memory = FingerprintMemory(cachedir=get_cache_dirs()[0],
+                           verbose=2)
 
 cb = rfMRIDictionaryScorer(test_imgs, test_confounds=test_confounds)
 dict_fact = fMRIDictFact(smoothing_fwhm=smoothing_fwhm,
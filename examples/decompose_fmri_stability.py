@@ -12,7 +12,7 @@ from os.path import expanduser, join
 import matplotlib.pyplot as plt
 import numpy as np
 import seaborn as sns
-from joblib import Memory, dump
+from joblib import dump
 from joblib import Parallel, delayed
 from sklearn.model_selection import train_test_split
 from sklearn.utils import check_random_state
@@ -24,6 +24,7 @@ from modl.plotting.fmri import display_maps
 
 from nilearn.datasets import fetch_atlas_smith_2009
 
+from modl.utils.hashing import FingerprintMemory
 from modl.utils.system import get_cache_dirs
 
 batch_size = 200
@@ -47,7 +48,8 @@ train_data, test_data = train_test_split(data, test_size=2, random_state=0)
 train_imgs, train_confounds = zip(*train_data)
 test_imgs, test_confounds = zip(*test_data)
 mask = dataset.mask
-mem = Memory(location=get_cache_dirs()[0])
+# Input images are hashed by file fingerprints rather than content
+mem = FingerprintMemory(location=get_cache_dirs()[0])
 masker = NiftiMasker(mask_img=mask).fit()
 
 
@@ -9,11 +9,8 @@ from hcp_builder.dataset import fetch_hcp_mask
 from sacred.observers import FileStorageObserver
 
 from modl.datasets import get_data_dirs
-from modl.input_data.fmri.fixes import monkey_patch_nifti_image
 from modl.input_data.fmri.unmask import MultiRawMasker
 
-monkey_patch_nifti_image()
-
 from sklearn.model_selection import train_test_split
 
 from modl.input_data.fmri.rest import get_raw_rest_data
@@ -2,13 +2,8 @@ import os
 from os.path import join
 
 from modl.datasets import fetch_adhd
-from modl.input_data.fmri.fixes import monkey_patch_nifti_image
-
-monkey_patch_nifti_image()
-
-from sklearn.externals.joblib import Memory
-
 from modl.input_data.fmri.rest import create_raw_rest_data
+from modl.utils.hashing import FingerprintMemory
 from modl.utils.system import get_cache_dirs, get_output_dir
 
 smoothing_fwhm = 6
@@ -16,7 +11,7 @@ n_jobs = 20
 
 dataset = fetch_adhd()
 
-memory = Memory(cachedir=get_cache_dirs()[0])
+memory = FingerprintMemory(cachedir=get_cache_dirs()[0])
 imgs_list = dataset.rest
 root = dataset.root
 mask_img = dataset.mask
@@ -1,4 +1,8 @@
-from .decomposition.dict_fact import DictFact
-from .decomposition.fmri import fMRIDictFact
-from .decomposition.recsys import RecsysDictFact
-from .decomposition.image import ImageDictFact
\ No newline at end of file
+from .utils.lazy import lazy_attributes
+
+# Estimators are imported on first access, so that e.g. recommender jobs
+# do not import nilearn
+lazy_attributes(__name__, {'DictFact': '.decomposition.dict_fact',
+                           'fMRIDictFact': '.decomposition.fmri',
+                           'RecsysDictFact': '.decomposition.recsys',
+                           'ImageDictFact': '.decomposition.image'})
@@ -1,5 +1,7 @@
 import os
 
+from ..utils.lazy import lazy_attributes
+
 
 def get_data_dirs(data_dir=None):
     """ Returns the directories in which modl looks for data.
@@ -47,4 +49,7 @@ def get_data_dirs(data_dir=None):
         paths.append(os.path.expanduser('~/modl_data'))
     return paths
 
-from .adhd import fetch_adhd
\ No newline at end of file
+
+__all__ = ['get_data_dirs']
+
+lazy_attributes(__name__, {'fetch_adhd': '.adhd'})
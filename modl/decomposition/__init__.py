@@ -1,4 +1,6 @@
-from .dict_fact import DictFact
-from .fmri import fMRIDictFact
-from .image import ImageDictFact
-from .recsys import RecsysDictFact
+from ..utils.lazy import lazy_attributes
+
+lazy_attributes(__name__, {'DictFact': '.dict_fact',
+                           'fMRIDictFact': '.fmri',
+                           'ImageDictFact': '.image',
+                           'RecsysDictFact': '.recsys'})
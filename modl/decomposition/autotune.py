@@ -0,0 +1,164 @@
+"""
+Pick DictFact hyper-parameters that only affect speed (batch_size,
+reduction, n_threads, G_agg / Dx_agg) by running short learning passes on a
+sample of the data, on the current machine.
+"""
+import itertools
+import os
+import time
+
+import numpy as np
+from sklearn.utils import check_array, check_random_state
+
+from .dict_fact import DictFact, METHODS
+
+# Methods of METHODS that keep the same parameters across epochs
+TUNABLE_METHODS = ['masked', 'dictionary only', 'average']
+
+
+def autotune(X,
+             n_components=10,
+             code_alpha=1,
+             code_l1_ratio=1,
+             comp_l1_ratio=0,
+             code_pos=False,
+             comp_pos=False,
+             learning_rate=1,
+             batch_sizes=(10, 50, 200),
+             reductions=(1, 4, 12),
+             method_list=('masked', 'dictionary only', 'average'),
+             n_threads_list=None,
+             max_samples=2000,
+             test_size=0.1,
+             random_state=None,
+             verbose=0):
+    """
+    Benchmark DictFact on a sample of X for every combination of
+    batch_size, reduction, method and n_threads, and return the
+    combination that yields the largest decrease of the objective function
+    on held-out samples per second of computation.
+
+    Each candidate starts from the same dictionary and performs a single
+    pass over the same training sample, so that the coding and dictionary
+    update kernels are timed on the actual data shape and machine.
+
+    Parameters
+    ----------
+    X: ndarray, shape (n_samples, n_features)
+        Data, or a representative sample of it (e.g. a few masked fMRI
+        records)
+    n_components, code_alpha, code_l1_ratio, comp_l1_ratio, code_pos,
+    comp_pos, learning_rate:
+        See DictFact. These define the problem and are not tuned
+    batch_sizes: iterable of int
+        Candidate mini-batch sizes
+    reductions: iterable of float
+        Candidate subsampling ratios. Ignored for 'dictionary only', and
+        values larger than n_features are skipped
+    method_list: iterable of str in ['masked', 'dictionary only', 'average']
+        Candidate estimators of D^T D and D^T x
+    n_threads_list: iterable of int or None
+        Candidate number of threads. Defaults to 1 and the number of CPUs
+    max_samples: int
+        Maximum number of rows of X used for benchmarking
+    test_size: float in ]0, 1[
+        Fraction of the sample used to measure the objective decrease
+    random_state: int, RandomState or None
+        Control sample selection and learning randomness
+    verbose: int
+        Print the benchmark table and the chosen configuration if > 0
+
+    Returns
+    -------
+    params: dict
+        Keys 'batch_size', 'reduction', 'n_threads', 'method', 'G_agg' and
+        'Dx_agg' of the best configuration, to be passed to DictFact (or
+        ImageDictFact / fMRIDictFact, which use method)
+    report: list of dict
+        One entry per candidate, with the above keys and 'time', 'decrease'
+        and 'rate' (decrease per second)
+    """
+    X = check_array(X, order='C', dtype=[np.float32, np.float64])
+    random_state = check_random_state(random_state)
+    n_samples, n_features = X.shape
+    if n_threads_list is None:
+        n_threads_list = sorted({1, os.cpu_count() or 1})
+    for method in method_list:
+        if method not in TUNABLE_METHODS:
+            raise ValueError('method should be in %s, got %s'
+                             % (TUNABLE_METHODS, method))
+
+    permutation = random_state.permutation(n_samples)[:max_samples]
+    sample = X[permutation]
+    n_test = max(1, int(len(sample) * test_size))
+    X_test, X_train = sample[:n_test], sample[n_test:]
+    if X_train.shape[0] < n_components:
+        raise ValueError('Too few samples to benchmark %i components'
+                         % n_components)
+    dict_init = X_train[:n_components]
+    seed = random_state.randint(np.iinfo(np.int32).max)
+
+    params = dict(n_components=n_components,
+                  code_alpha=code_alpha,
+                  code_l1_ratio=code_l1_ratio,
+                  comp_l1_ratio=comp_l1_ratio,
+                  code_pos=code_pos,
+                  comp_pos=comp_pos,
+                  learning_rate=learning_rate)
+
+    # Score of the initial dictionary, identical for all candidates
+    init_score = DictFact(random_state=seed, **params).prepare(
+        X=dict_init, n_samples=X_train.shape[0]).score(X_test)
+
+    report = []
+    for method, batch_size, reduction, n_threads in itertools.product(
+            method_list, batch_sizes, reductions, n_threads_list):
+        if method == 'dictionary only' and reduction != reductions[0]:
+            continue
+        if method == 'dictionary only':
+            reduction = 1
+        if reduction > n_features:
+            continue
+        dict_fact = DictFact(batch_size=batch_size,
+                             reduction=reduction,
+                             n_threads=n_threads,
+                             random_state=seed,
+                             **METHODS[method], **params)
+        try:
+            dict_fact.prepare(X=dict_init, n_samples=X_train.shape[0])
+            t0 = time.perf_counter()
+            dict_fact.partial_fit(X_train,
+                                  sample_indices=np.arange(X_train.shape[0]))
+            this_time = time.perf_counter() - t0
+            decrease = init_score - dict_fact.score(X_test)
+        finally:
+            dict_fact._exit()
+            # Candidates are discarded: stop their worker threads
+            if getattr(dict_fact, '_pool', None) is not None:
+                dict_fact._pool.shutdown()
+        report.append(dict(method=method,
+                           batch_size=batch_size,
+                           reduction=reduction,
+                           n_threads=n_threads,
+                           time=this_time,
+                           decrease=decrease,
+                           rate=decrease / this_time,
+                           **METHODS[method]))
+    best = max(report, key=lambda entry: entry['rate'])
+    if verbose:
+        print('%-16s %10s %9s %9s %9s %10s %10s' % (
+            'method', 'batch_size', 'reduction', 'n_threads', 'time',
+            'decrease', 'rate'))
+        for entry in report:
+            print('%-16s %10i %9.3g %9i %9.3g %10.3g %10.3g' % (
+                entry['method'], entry['batch_size'], entry['reduction'],
+                entry['n_threads'], entry['time'], entry['decrease'],
+                entry['rate']))
+        print('Chosen configuration: method=%s, batch_size=%i, '
+              'reduction=%.3g, n_threads=%i' % (
+                  best['method'], best['batch_size'], best['reduction'],
+                  best['n_threads']))
+    params = {key: best[key] for key in ['method', 'batch_size',
+                                         'reduction', 'n_threads',
+                                         'G_agg', 'Dx_agg']}
+    return params, report
@@ -1,4 +1,5 @@
-import atexit
+import weakref
+from collections import OrderedDict
 from concurrent.futures import ThreadPoolExecutor
 from math import log, ceil
 from tempfile import TemporaryFile
@@ -19,6 +20,15 @@ from ..utils.math.enet import enet_norm, enet_projection, enet_scale
 
 MAX_INT = np.iinfo(np.int64).max
 
+# G_agg and Dx_agg of the learning methods of ImageDictFact and
+# fMRIDictFact, during the first epoch: 'gram' then switches to full G_agg,
+# and 'reducing ratio' lowers the reduction at each epoch
+METHODS = {'masked': {'G_agg': 'masked', 'Dx_agg': 'masked'},
+           'dictionary only': {'G_agg': 'full', 'Dx_agg': 'full'},
+           'gram': {'G_agg': 'masked', 'Dx_agg': 'masked'},
+           'average': {'G_agg': 'average', 'Dx_agg': 'average'},
+           'reducing ratio': {'G_agg': 'masked', 'Dx_agg': 'masked'}}
+
 
 class CodingMixin(TransformerMixin):
     def _set_coding_params(self,
@@ -29,7 +39,8 @@ class CodingMixin(TransformerMixin):
                            max_iter=100,
                            code_pos=False,
                            random_state=None,
-                           n_threads=1
+                           n_threads=1,
+                           code_cache_size=0
                            ):
         self.n_components = n_components
         self.code_l1_ratio = code_l1_ratio
@@ -40,11 +51,13 @@ class CodingMixin(TransformerMixin):
         self.max_iter = max_iter
 
         self.n_threads = n_threads
+        self.code_cache_size = code_cache_size
 
         if self.n_threads > 1:
             self._pool = ThreadPoolExecutor(n_threads)
+        self._code_cache = OrderedDict()
 
-    def transform(self, X):
+    def transform(self, X, cache_key=None):
         """
         Compute the codes associated to input matrix X, decomposing it onto
         the dictionary
@@ -53,23 +66,32 @@ class CodingMixin(TransformerMixin):
         ----------
         X: ndarray, shape = (n_samples, n_features)
 
+        cache_key: object or None,
+            Object whose identity is used to look up and store codes in the
+            code cache, when code_cache_size > 0. Defaults to X itself.
+
         Returns
         -------
         code: ndarray, shape = (n_samples, n_components)
         """
         check_is_fitted(self, 'components_')
 
+        if cache_key is None:
+            cache_key = X
         dtype = self.components_.dtype
         X = check_array(X, order='C', dtype=dtype.type)
         if X.flags['WRITEABLE'] is False:
             X = X.copy()
         n_samples, n_features = X.shape
-        if not hasattr(self, 'G_agg') or self.G_agg != 'full':
+        if getattr(self, 'G_agg', 'full') != 'full' or not hasattr(self,
+                                                                 'G_'):
             G = self.components_.dot(self.components_.T)
         else:
             G = self.G_
         Dx = X.dot(self.components_.T)
-        code = np.ones((n_samples, self.n_components), dtype=dtype)
+        code = self._get_cached_code(cache_key, n_samples, dtype)
+        if code is None:
+            code = np.ones((n_samples, self.n_components), dtype=dtype)
         sample_indices = np.arange(n_samples)
         size_job = ceil(n_samples / self.n_threads)
         batches = list(gen_batches(n_samples, size_job))
@@ -88,10 +110,10 @@ class CodingMixin(TransformerMixin):
                 sample_indices,
                 self.code_l1_ratio, self.code_alpha, self.code_pos,
                 self.tol, self.max_iter)
-
+        self._set_cached_code(cache_key, code)
         return code
 
-    def score(self, X):
+    def score(self, X, cache_key=None):
         """
         Objective function value on test data X
 
@@ -99,13 +121,15 @@ class CodingMixin(TransformerMixin):
         ----------
         X: ndarray, shape=(n_samples, n_features)
             Input matrix
+        cache_key: object or None,
+            See transform
         Returns
         -------
         score: float, positive
         """
         check_is_fitted(self, 'components_')
 
-        code = self.transform(X)
+        code = self.transform(X, cache_key=cache_key)
         loss = np.sum((X - code.dot(self.components_)) ** 2) / 2
         norm1_code = np.sum(np.abs(code))
         norm2_code = np.sum(code ** 2)
@@ -113,15 +137,48 @@ class CodingMixin(TransformerMixin):
                                    + (1 - self.code_l1_ratio) * norm2_code / 2)
         return (loss + regul) / X.shape[0]
 
+    def _get_cached_code(self, key, n_samples, dtype):
+        """Return a copy of the codes last computed for key, to be used as a
+        warm start, or None if there is no valid entry for key"""
+        if not self.code_cache_size:
+            return None
+        entry = self._code_cache.get(id(key))
+        if entry is None:
+            return None
+        ref, code = entry
+        # id() may be reused once key is garbage collected
+        if (ref() is not key or code.dtype != dtype
+                or code.shape != (n_samples, self.n_components)):
+            del self._code_cache[id(key)]
+            return None
+        self._code_cache.move_to_end(id(key))
+        return code.copy()
+
+    def _set_cached_code(self, key, code):
+        """Store code in the LRU code cache, keyed by the identity of key"""
+        if not self.code_cache_size:
+            return
+        try:
+            ref = weakref.ref(key)
+        except TypeError:
+            # Lists and other non weak-referencable inputs are not cached
+            return
+        self._code_cache[id(key)] = ref, code
+        self._code_cache.move_to_end(id(key))
+        while len(self._code_cache) > self.code_cache_size:
+            self._code_cache.popitem(last=False)
+
     def __getstate__(self):
         state = dict(self.__dict__)
         state.pop('_pool', None)
+        state.pop('_code_cache', None)
         return state
 
     def __setstate__(self, state):
         self.__dict__ = state
         if self.n_threads > 1:
             self._pool = ThreadPoolExecutor(self.n_threads)
+        self._code_cache = OrderedDict()
 
 
 class DictFact(CodingMixin, BaseEstimator):
@@ -150,6 +207,13 @@ class DictFact(CodingMixin, BaseEstimator):
                  n_threads=1,
                  rand_size=True,
                  replacement=True,
+                 code_cache_size=0,
+                 check_freq=None,
+                 stop_tol=None,
+                 stop_comp_tol=None,
+                 max_time=None,
+                 max_memory=None,
+                 mixed_precision=False,
                  ):
         """
         Estimator to perform matrix factorization by streaming samples and
@@ -219,6 +283,38 @@ class DictFact(CodingMixin, BaseEstimator):
             Whether the masks should have fixed size
         replacement: boolean
             Whether to compute random or cycling masks
+        code_cache_size: int, positive
+            Number of input matrices for which transform keeps the last
+            computed codes, keyed by input identity. Transforming the same
+            matrix again (e.g. a test set in a scoring callback) warm-starts
+            the elastic-net solver from these codes. 0 disables the cache.
+        check_freq: int or None
+            Number of samples to stream between two convergence checks. At
+            each check, the surrogate objective is recorded in monitor_. If
+            None, check once every n_samples if a stopping criterion is set,
+            and never otherwise. The running loss and the surrogate
+            objective are only tracked if check_freq or stop_tol is set
+        stop_tol: float or None
+            Stop when the relative change of the surrogate objective between
+            two checks falls below stop_tol
+        stop_comp_tol: float or None
+            Stop when the relative Frobenius change of the dictionary between
+            two checks falls below stop_comp_tol. The dictionary change is
+            only computed if stop_comp_tol is set
+        max_time: float or None
+            Stop when the time spent in learning (time_) exceeds max_time
+            seconds
+        max_memory: int or None
+            Maximum number of bytes that prepare may allocate in RAM. If the
+            estimate of estimate_resources exceeds it, code_ then
+            Dx_average_ are memory-mapped onto temporary files, and a
+            MemoryError is raised if this is not sufficient
+        mixed_precision: boolean
+            Use float32 for the data, the dictionary, the codes and the
+            regression statistics (coding and G/Dx estimates), and float64
+            for the C_ and B_ accumulators, that are updated with small
+            weights over millions of iterations and would drift in float32.
+            Data is cast to float32 if needed
 
         Attributes
         ----------
@@ -245,6 +341,17 @@ class DictFact(CodingMixin, BaseEstimator):
             Number of time each sample has been seen
         self.verbose_iter_: int
             List of verbose iteration
+        self.loss_: float
+            Running average of the coding loss of each mini-batch, using the
+            same weights as C_ and B_. nan if the loss is not tracked
+        self.monitor_: dict of lists
+            Iteration, time, surrogate objective, running loss and relative
+            dictionary change, recorded at each convergence check. Untracked
+            quantities are recorded as nan. Empty if neither check_freq nor
+            a stopping criterion is set
+        self.converged_: boolean
+            Whether a stopping criterion has been met. fit and partial_fit
+            return early when True
         self.feature_sampler_: Sampler
             Generator of masks
         """
@@ -265,7 +372,8 @@ class DictFact(CodingMixin, BaseEstimator):
                                 random_state=random_state,
                                 tol=tol,
                                 max_iter=max_iter,
-                                n_threads=n_threads)
+                                n_threads=n_threads,
+                                code_cache_size=code_cache_size)
 
         self.comp_l1_ratio = comp_l1_ratio
         self.comp_pos = comp_pos
@@ -283,6 +391,13 @@ class DictFact(CodingMixin, BaseEstimator):
         self.rand_size = rand_size
         self.replacement = replacement
 
+        self.check_freq = check_freq
+        self.stop_tol = stop_tol
+        self.stop_comp_tol = stop_comp_tol
+        self.max_time = max_time
+        self.max_memory = max_memory
+        self.mixed_precision = mixed_precision
+
     def fit(self, X):
         """
         Compute the factorisation X ~ code_ x components_, solving for
@@ -296,7 +411,10 @@ class DictFact(CodingMixin, BaseEstimator):
         -------
         self
         """
-        X = check_array(X, order='C', dtype=[np.float32, np.float64])
+        if self.mixed_precision:
+            X = check_array(X, order='C', dtype=np.float32)
+        else:
+            X = check_array(X, order='C', dtype=[np.float32, np.float64])
         if self.dict_init is None:
             dict_init = X
         else:
@@ -306,6 +424,8 @@ class DictFact(CodingMixin, BaseEstimator):
         # Main loop
         for _ in range(self.n_epochs):
             self.partial_fit(X)
+            if self.converged_:
+                break
             permutation = self.shuffle()
             X = X[permutation]
         return self
@@ -325,12 +445,17 @@ class DictFact(CodingMixin, BaseEstimator):
         -------
         self
         """
-        X = check_array(X, dtype=[np.float32, np.float64], order='C')
+        if self.mixed_precision:
+            X = check_array(X, dtype=self.components_.dtype.type, order='C')
+        else:
+            X = check_array(X, dtype=[np.float32, np.float64], order='C')
 
         n_samples, n_features = X.shape
         batches = gen_batches(n_samples, self.batch_size)
 
         for batch in batches:
+            if self.converged_:
+                break
             this_X = X[batch]
             these_sample_indices = get_sub_slice(sample_indices, batch)
             self._single_batch_fit(this_X, these_sample_indices)
@@ -390,7 +515,8 @@ class DictFact(CodingMixin, BaseEstimator):
         n_features: int,
 
         dtype: dtype in np.float32, np.float64
-             to use in the estimator. Override X.dtype if provided
+             to use in the estimator. Override X.dtype if provided. Ignored
+             if mixed_precision is True
         X: ndarray, shape (> n_components, n_features)
             Array to use to determine shape and types, and init dictionary if
             provided
@@ -427,22 +553,30 @@ class DictFact(CodingMixin, BaseEstimator):
             self.G_agg = 'full'
             self.Dx_agg = 'full'
 
+        if self.mixed_precision:
+            dtype = np.dtype(np.float32)
+            acc_dtype = np.float64
+        else:
+            acc_dtype = dtype
+
+        resources = self.estimate_resources(n_samples, n_features, dtype)
+        mmap_attrs = self._admit(resources)
+
         # Regression statistics
         if self.G_agg == 'average':
-            with TemporaryFile() as self.G_average_mmap_:
-                self.G_average_mmap_ = TemporaryFile()
-                self.G_average_ = np.memmap(self.G_average_mmap_, mode='w+',
-                                            shape=(n_samples,
-                                                   self.n_components,
-                                                   self.n_components),
-                                            dtype=dtype)
-            atexit.register(self._exit)
+            self.G_average_ = self._allocate('G_average_',
+                                             (n_samples, self.n_components,
+                                              self.n_components),
+                                             dtype, mmap=True)
         if self.Dx_agg == 'average':
-            self.Dx_average_ = np.zeros((n_samples, self.n_components),
-                                        dtype=dtype)
+            self.Dx_average_ = self._allocate('Dx_average_',
+                                              (n_samples, self.n_components),
+                                              dtype,
+                                              mmap='Dx_average_' in mmap_attrs)
         # Dictionary statistics
-        self.C_ = np.zeros((self.n_components, self.n_components), dtype=dtype)
-        self.B_ = np.zeros((self.n_components, n_features), dtype=dtype)
+        self.C_ = np.zeros((self.n_components, self.n_components),
+                           dtype=acc_dtype)
+        self.B_ = np.zeros((self.n_components, n_features), dtype=acc_dtype)
         self.gradient_ = np.zeros((self.n_components, n_features), dtype=dtype,
                                   order='F')
 
@@ -467,7 +601,9 @@ class DictFact(CodingMixin, BaseEstimator):
                        l1_ratio=self.comp_l1_ratio,
                        radius=1)
 
-        self.code_ = np.ones((n_samples, self.n_components), dtype=dtype)
+        self.code_ = self._allocate('code_', (n_samples, self.n_components),
+                                    dtype, mmap='code_' in mmap_attrs)
+        self.code_[:] = 1
 
         self.labels_ = np.arange(n_samples)
 
@@ -486,8 +622,130 @@ class DictFact(CodingMixin, BaseEstimator):
             self.verbose_iter_ = np.linspace(0, n_samples * self.n_epochs,
                                              self.verbose).tolist()
         self.time_ = 0
+
+        self.loss_ = 0. if self._track_loss() else np.nan
+        self.const_ = 0.
+        self.monitor_ = {'iter': [], 'time': [], 'surrogate': [],
+                         'loss': [], 'comp_change': []}
+        self.converged_ = False
+        if self.check_freq is None:
+            self.check_iter_ = n_samples
+        else:
+            self.check_iter_ = self.check_freq
+        if self.stop_comp_tol is not None:
+            self.last_components_ = self.components_.copy()
         return self
 
+    def estimate_resources(self, n_samples, n_features, dtype=np.float64,
+                           mmap_attrs=()):
+        """
+        Estimate the memory and disk space needed by the attributes that
+        prepare allocates, given the estimator parameters. Temporaries
+        created during learning, which scale with batch_size, are not
+        accounted for.
+
+        Parameters
+        ----------
+        n_samples: int,
+
+        n_features: int,
+
+        dtype: dtype in np.float32, np.float64
+
+        mmap_attrs: iterable of str
+            Attributes that are stored in memory-mapped files instead of RAM
+
+        Returns
+        -------
+        resources: dict
+            Maps each attribute name to a dict with keys 'ram' and 'disk',
+            in bytes. The 'total' entry holds the sums.
+        """
+        if self.mixed_precision:
+            dtype = np.float32
+            acc_itemsize = np.dtype(np.float64).itemsize
+        else:
+            acc_itemsize = np.dtype(dtype).itemsize
+        itemsize = np.dtype(dtype).itemsize
+        int_itemsize = np.dtype('int').itemsize
+        n_components = self.n_components
+        if self.optimizer == 'sgd':
+            G_agg, Dx_agg = 'full', 'full'
+        else:
+            G_agg, Dx_agg = self.G_agg, self.Dx_agg
+        sizes = {'components_': n_components * n_features * itemsize,
+                 'B_': n_components * n_features * acc_itemsize,
+                 'gradient_': n_components * n_features * itemsize,
+                 'C_': n_components ** 2 * acc_itemsize,
+                 'comp_norm_': n_components * itemsize,
+                 'code_': n_samples * n_components * itemsize,
+                 'labels_': n_samples * int_itemsize,
+                 'sample_n_iter_': n_samples * int_itemsize,
+                 'feature_sampler_': 2 * n_features * int_itemsize}
+        if self.stop_comp_tol is not None:
+            sizes['last_components_'] = n_components * n_features * itemsize
+        if G_agg == 'full':
+            sizes['G_'] = n_components ** 2 * itemsize
+        elif G_agg == 'average':
+            sizes['G_average_'] = n_samples * n_components ** 2 * itemsize
+        if Dx_agg == 'average':
+            sizes['Dx_average_'] = n_samples * n_components * itemsize
+        mmap_attrs = set(mmap_attrs) | {'G_average_'}
+        resources = {}
+        for attr, size in sizes.items():
+            if attr in mmap_attrs:
+                resources[attr] = {'ram': 0, 'disk': size}
+            else:
+                resources[attr] = {'ram': size, 'disk': 0}
+        resources['total'] = {
+            'ram': sum(this['ram'] for this in resources.values()),
+            'disk': sum(this['disk'] for this in resources.values())}
+        return resources
+
+    def _admit(self, resources):
+        """Check that the attributes allocated by prepare fit in max_memory,
+        moving per-sample statistics to memory-mapped files if needed.
+        Returns the set of attributes to memory-map"""
+        mmap_attrs = set()
+        if self.verbose:
+            print('Allocating %.1f MB in memory, %.1f MB on disk'
+                  % (resources['total']['ram'] / 1e6,
+                     resources['total']['disk'] / 1e6))
+        if self.max_memory is None:
+            return mmap_attrs
+        ram = resources['total']['ram']
+        for attr in ['code_', 'Dx_average_']:
+            if ram <= self.max_memory:
+                break
+            if attr in resources:
+                mmap_attrs.add(attr)
+                ram -= resources[attr]['ram']
+                if self.verbose:
+                    print('Memory-mapping %s' % attr)
+        if ram > self.max_memory:
+            detail = ', '.join('%s: %.1f MB' % (attr, this['ram'] / 1e6)
+                               for attr, this in sorted(resources.items())
+                               if this['ram'] > 0 and attr != 'total')
+            raise MemoryError('Estimator requires %.1f MB of memory, more '
+                              'than max_memory=%.1f MB (%s)'
+                              % (ram / 1e6, self.max_memory / 1e6, detail))
+        return mmap_attrs
+
+    def _allocate(self, attr, shape, dtype, mmap=False):
+        """Allocate a zero-filled array, possibly memory-mapped onto a
+        temporary file stored in attr + 'mmap_'"""
+        if not mmap:
+            return np.zeros(shape, dtype=dtype)
+        previous_file = getattr(self, attr + 'mmap_', None)
+        if previous_file is not None:
+            previous_file.close()
+        mmap_file = TemporaryFile()
+        setattr(self, attr + 'mmap_', mmap_file)
+        # Closed at exit or when the estimator is garbage collected. Unlike
+        # atexit.register(self._exit), this does not keep the estimator alive
+        weakref.finalize(self, mmap_file.close)
+        return np.memmap(mmap_file, mode='w+', shape=shape, dtype=dtype)
+
     def _callback(self):
         if self.callback is not None:
             self.callback(self)
@@ -514,9 +772,11 @@ class DictFact(CodingMixin, BaseEstimator):
             astype(self.components_.dtype)
         w = _batch_weight(self.n_iter_, batch_size,
                           self.learning_rate, 0)
-        self._compute_code(X, sample_indices, w_sample, subset)
+        Dx, G = self._compute_code(X, sample_indices, w_sample, subset)
 
         this_code = self.code_[sample_indices]
+        if self._track_loss():
+            self._update_loss(X, this_code, Dx, G, w)
 
         if self.n_threads == 1:
             self._update_stat_and_dict(subset, X, this_code, w)
@@ -524,6 +784,8 @@ class DictFact(CodingMixin, BaseEstimator):
             self._update_stat_and_dict_parallel(subset, X,
                                                 this_code, w)
         self.time_ += time.perf_counter() - t0
+        if self._check() and self.n_iter_ >= self.check_iter_:
+            self._check_convergence()
 
     def _update_stat_and_dict(self, subset, X, code, w):
         """For multi-threading"""
@@ -563,7 +825,7 @@ class DictFact(CodingMixin, BaseEstimator):
             self.B_ *= 1 - w
             self.B_ += w * code.T.dot(X) / batch_size
         else:
-            self.B_ = code.T.dot(X) / batch_size
+            self.B_[:] = code.T.dot(X) / batch_size
 
     def _update_C(self, this_code, w):
         """Update C statistics (for updating D)"""
@@ -572,7 +834,7 @@ class DictFact(CodingMixin, BaseEstimator):
             self.C_ *= 1 - w
             self.C_ += w * this_code.T.dot(this_code) / batch_size
         else:
-            self.C_ = this_code.T.dot(this_code) / batch_size
+            self.C_[:] = this_code.T.dot(this_code) / batch_size
 
     def _compute_code(self, X, sample_indices,
                       w_sample, subset):
@@ -646,6 +908,100 @@ class DictFact(CodingMixin, BaseEstimator):
                     sample_indices,
                     self.code_l1_ratio, self.code_alpha, self.code_pos,
                     self.tol, self.max_iter)
+        return Dx, G
+
+    def _check(self):
+        """Whether convergence checks are run"""
+        return (self.check_freq is not None or self.stop_tol is not None
+                or self.stop_comp_tol is not None
+                or self.max_time is not None)
+
+    def _track_loss(self):
+        """Whether the running loss and the constant part of the surrogate
+        function are needed by a convergence check"""
+        return self.check_freq is not None or self.stop_tol is not None
+
+    def _update_loss(self, X, code, Dx, G, w):
+        """Update the running averages of the coding loss and of the
+        constant part of the surrogate function. The loss is expanded on the
+        Dx and G used for coding, which estimate the full ones in masked
+        modes, so that it costs no product with the dictionary"""
+        batch_size = X.shape[0]
+        X_flat = X.ravel()
+        X_norm = np.dot(X_flat, X_flat)
+        regul = self.code_alpha * (
+            self.code_l1_ratio * np.sum(np.abs(code))
+            + (1 - self.code_l1_ratio) * np.sum(code ** 2) / 2)
+        const = (X_norm / 2 + regul) / batch_size
+        loss = const + (np.sum(code * code.dot(G)) / 2
+                        - np.sum(code * Dx)) / batch_size
+        if self.optimizer == 'variational':
+            self.const_ *= 1 - w
+            self.const_ += w * const
+            self.loss_ *= 1 - w
+            self.loss_ += w * loss
+        else:
+            self.const_ = const
+            self.loss_ = loss
+
+    def surrogate_objective(self):
+        """
+        Value of the surrogate objective function for the current dictionary,
+        computed from the aggregated statistics C_ and B_, without accessing
+        data. Its constant part is only included if check_freq or stop_tol is
+        set
+
+        Returns
+        -------
+        surrogate: float
+        """
+        check_is_fitted(self, 'components_')
+        if self.G_agg == 'full':
+            G = self.G_
+        else:
+            G = self.components_.dot(self.components_.T)
+        return float(np.sum(self.C_ * G) / 2
+                     - np.sum(self.B_ * self.components_) + self.const_)
+
+    def _check_convergence(self):
+        """Record convergence statistics and check stopping criteria"""
+        if self.check_freq is None:
+            self.check_iter_ += self.sample_n_iter_.shape[0]
+        else:
+            self.check_iter_ += self.check_freq
+        # Without its constant part, the surrogate objective is not comparable
+        # to the objective function: only record it if it is tracked
+        if self._track_loss():
+            surrogate = self.surrogate_objective()
+        else:
+            surrogate = np.nan
+        if self.stop_comp_tol is not None:
+            comp_change = (np.sqrt(np.sum((self.components_
+                                           - self.last_components_) ** 2))
+                           / np.sqrt(np.sum(self.last_components_ ** 2)))
+            self.last_components_[:] = self.components_
+        else:
+            comp_change = np.nan
+        surrogates = self.monitor_['surrogate']
+        if surrogates:
+            surrogate_change = (abs(surrogates[-1] - surrogate)
+                                / max(abs(surrogates[-1]), 1e-20))
+        else:
+            surrogate_change = np.inf
+        self.monitor_['iter'].append(self.n_iter_)
+        self.monitor_['time'].append(self.time_)
+        self.monitor_['surrogate'].append(surrogate)
+        self.monitor_['loss'].append(self.loss_)
+        self.monitor_['comp_change'].append(comp_change)
+        if self.stop_tol is not None and surrogate_change < self.stop_tol:
+            self.converged_ = True
+        if (self.stop_comp_tol is not None
+                and comp_change < self.stop_comp_tol):
+            self.converged_ = True
+        if self.max_time is not None and self.time_ >= self.max_time:
+            self.converged_ = True
+        if self.verbose and self.converged_:
+            print('Stopping at iteration %i' % self.n_iter_)
 
     def _update_dict(self, subset, w):
         """Dictionary update part
@@ -656,8 +1012,9 @@ class DictFact(CodingMixin, BaseEstimator):
             Subset of features to update.
 
         """
-        ger, = scipy.linalg.get_blas_funcs(('ger',), (self.C_,
-                                                      self.components_))
+        # Accumulated in float64 when using mixed precision
+        C = self.C_.astype(self.components_.dtype, copy=False)
+        ger, = scipy.linalg.get_blas_funcs(('ger',), (C, self.components_))
         len_subset = subset.shape[0]
         n_components, n_features = self.components_.shape
         components_subset = self.components_[:, subset]
@@ -667,7 +1024,7 @@ class DictFact(CodingMixin, BaseEstimator):
         if self.G_agg == 'full' and len_subset < n_features / 2.:
             self.G_ -= components_subset.dot(components_subset.T)
 
-        gradient_subset -= self.C_.dot(components_subset)
+        gradient_subset -= C.dot(components_subset)
 
         order = self.random_state.permutation(n_components)
 
@@ -676,10 +1033,10 @@ class DictFact(CodingMixin, BaseEstimator):
                 subset_norm = enet_norm(components_subset[k],
                                         self.comp_l1_ratio)
                 self.comp_norm_[k] += subset_norm
-                gradient_subset = ger(1.0, self.C_[k], components_subset[k],
+                gradient_subset = ger(1.0, C[k], components_subset[k],
                                       a=gradient_subset, overwrite_a=True)
-                if self.C_[k, k] > 1e-20:
-                    components_subset[k] = gradient_subset[k] / self.C_[k, k]
+                if C[k, k] > 1e-20:
+                    components_subset[k] = gradient_subset[k] / C[k, k]
                 # Else do not update
                 if self.comp_pos:
                     components_subset[components_subset < 0] = 0
@@ -690,7 +1047,7 @@ class DictFact(CodingMixin, BaseEstimator):
                 subset_norm = enet_norm(components_subset[k],
                                         self.comp_l1_ratio)
                 self.comp_norm_[k] -= subset_norm
-                gradient_subset = ger(-1.0, self.C_[k], components_subset[k],
+                gradient_subset = ger(-1.0, C[k], components_subset[k],
                                       a=gradient_subset, overwrite_a=True)
         else:
             for k in order:
@@ -715,10 +1072,11 @@ class DictFact(CodingMixin, BaseEstimator):
                 self.G_[:] = self.components_.dot(self.components_.T)
 
     def _exit(self):
-        """Useful to delete G_average_ memorymap when the algorithm is
-         interrupted/completed"""
-        if hasattr(self, 'G_average_mmap_'):
-            self.G_average_mmap_.close()
+        """Useful to delete G_average_, Dx_average_ and code_ memorymaps
+        when the algorithm is interrupted/completed"""
+        for attr in ['G_average_mmap_', 'Dx_average_mmap_', 'code_mmap_']:
+            if hasattr(self, attr):
+                getattr(self, attr).close()
 
 
 class Coder(CodingMixin, BaseEstimator):
@@ -729,7 +1087,8 @@ class Coder(CodingMixin, BaseEstimator):
                  max_iter=100,
                  code_pos=False,
                  random_state=None,
-                 n_threads=1
+                 n_threads=1,
+                 code_cache_size=0
                  ):
         self._set_coding_params(dictionary.shape[0],
                                 code_l1_ratio=code_l1_ratio,
@@ -738,8 +1097,11 @@ class Coder(CodingMixin, BaseEstimator):
                                 random_state=random_state,
                                 tol=tol,
                                 max_iter=max_iter,
-                                n_threads=n_threads)
+                                n_threads=n_threads,
+                                code_cache_size=code_cache_size)
         self.components_ = dictionary
 
     def fit(self, X=None):
+        """Precompute the Gram matrix of the dictionary"""
+        self.G_ = self.components_.dot(self.components_.T)
         return self
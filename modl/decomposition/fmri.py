@@ -7,15 +7,20 @@ component sparsity
 # License: BSD 3 clause
 from __future__ import division
 
+import copy
 import itertools
+import os
+import shutil
 import time
 import warnings
 from math import log, sqrt
 from os.path import join
+from tempfile import mkdtemp
 
 import numpy as np
 from joblib import dump
-from nibabel.filebasedimages import ImageFileError
+from scipy import linalg
+from scipy import sparse
 from nilearn._utils import CacheMixin
 from nilearn._utils import check_niimg
 from nilearn.input_data import NiftiMasker
@@ -24,10 +29,17 @@ from sklearn.externals.joblib import Memory
 from sklearn.externals.joblib import Parallel
 from sklearn.externals.joblib import delayed
 from sklearn.utils import check_random_state
+from sklearn.utils.extmath import randomized_svd
 
 from ..input_data.fmri.base import BaseNilearnEstimator
+from ..input_data.fmri.chunked import ChunkedRecord
+from ..input_data.fmri.parcellation import grid_clustering, rena_clustering
+from ..input_data.fmri.scan import scan_imgs
+from ..input_data.fmri.unmask import MultiRawMasker
+from ..utils.artifacts import ArtifactWriter
+from ..utils.hashing import fingerprint_hash
 
-from .dict_fact import DictFact, Coder
+from .dict_fact import DictFact, Coder, METHODS
 
 warnings.filterwarnings('ignore', module='scipy.ndimage.interpolation',
                         category=UserWarning,
@@ -118,18 +130,17 @@ class fMRICoderMixin(BaseNilearnEstimator, CacheMixin, TransformerMixin):
             imgs = [imgs]
         if confounds is None:
             confounds = itertools.repeat(None)
-        scores = Parallel(n_jobs=self.n_jobs, verbose=self.verbose)(
-            delayed(self._cache(_score_img, func_memory_level=1))(
-                self.coder_, self.masker_, img, these_confounds)
-            for img, these_confounds in zip(imgs, confounds))
-        scores = np.array(scores)
+        coder, temp_folder = self._share_coder()
         try:
-            len_imgs = np.array([check_niimg(img).get_shape()[3]
-                                 for img in imgs])
-        except ImageFileError:
-            len_imgs = np.array([np.load(img, mmap_mode='r').shape[0]
-                                 for img in imgs])
-        score = np.sum(scores * len_imgs) / np.sum(len_imgs)
+            res = Parallel(n_jobs=self.n_jobs, verbose=self.verbose)(
+                delayed(self._cache(_score_img, func_memory_level=1))(
+                    coder, self.masker_, img, these_confounds)
+                for img, these_confounds in zip(imgs, confounds))
+        finally:
+            if temp_folder is not None:
+                shutil.rmtree(temp_folder, ignore_errors=True)
+        sums, len_imgs = zip(*res)
+        score = np.sum(sums) / np.sum(len_imgs)
         return score
 
     def transform(self, imgs, confounds=None):
@@ -156,12 +167,120 @@ class fMRICoderMixin(BaseNilearnEstimator, CacheMixin, TransformerMixin):
             imgs = [imgs]
         if confounds is None:
             confounds = itertools.repeat(None)
-        codes = Parallel(n_jobs=self.n_jobs, verbose=self.verbose)(
-            delayed(self._cache(_transform_img, func_memory_level=1))(
-                self.coder_, self.masker_, img, these_confounds)
-            for img, these_confounds in zip(imgs, confounds))
+        coder, temp_folder = self._share_coder()
+        try:
+            codes = Parallel(n_jobs=self.n_jobs, verbose=self.verbose)(
+                delayed(self._cache(_transform_img, func_memory_level=1))(
+                    coder, self.masker_, img, these_confounds)
+                for img, these_confounds in zip(imgs, confounds))
+        finally:
+            if temp_folder is not None:
+                shutil.rmtree(temp_folder, ignore_errors=True)
         return codes
 
+    def dual_regression(self, imgs, confounds=None, output_dir=None):
+        """Compute subject-specific time courses and spatial maps by dual
+        regression onto the learned maps
+
+        Time courses are regressed from the learned maps, as in transform,
+        then subject maps are regressed from these time courses by least
+        squares. Both stages use the data of each subject from a single
+        read, and subjects are processed in parallel.
+
+        Parameters
+        ----------
+        imgs: list of Niimg-like objects
+            See http://nilearn.github.io/building_blocks/manipulating_mr_images.html#niimg.
+            Subject data.
+
+        confounds: CSV file path or 2D matrix
+            This parameter is passed to nilearn.signal.clean. Please see the
+            related documentation for details
+
+        output_dir: str or None
+            If not None, the maps of each subject are saved as soon as they
+            are computed in output_dir/dual_regression_<i>.npy, and the
+            filenames are returned instead of the maps
+
+        Returns
+        -------
+        codes: list of ndarray, shape = n_images * (n_samples, n_components)
+            Subject time courses
+
+        maps: list of ndarray or str, shape = n_images * (n_components, n_voxels)
+            Subject maps, that masker_.inverse_transform turns into images,
+            or files holding them
+        """
+        if (isinstance(imgs, str) or not hasattr(imgs, '__iter__')):
+            imgs = [imgs]
+        if confounds is None:
+            confounds = itertools.repeat(None)
+        if output_dir is not None:
+            if not os.path.exists(output_dir):
+                os.makedirs(output_dir)
+            filenames = [join(output_dir, 'dual_regression_%i.npy' % i)
+                         for i in range(len(imgs))]
+        else:
+            filenames = itertools.repeat(None)
+        gram_factor = self._gram_factor()
+        coder, temp_folder = self._share_coder()
+        try:
+            res = Parallel(n_jobs=self.n_jobs, verbose=self.verbose)(
+                delayed(_dual_regression_img)(
+                    coder, self.masker_, img, these_confounds,
+                    gram_factor=gram_factor, filename=filename)
+                for img, these_confounds, filename in zip(imgs, confounds,
+                                                          filenames))
+        finally:
+            if temp_folder is not None:
+                shutil.rmtree(temp_folder, ignore_errors=True)
+        codes, maps = zip(*res)
+        return list(codes), list(maps)
+
+    def _gram_factor(self):
+        """Cholesky factor of the ridge-regularized Gram matrix of the maps,
+        from which time courses are obtained in closed form with a ridge
+        penalty, or None otherwise. The factor is kept on the estimator for
+        as long as coder_ holds the same maps and penalty"""
+        coder = self.coder_
+        if coder.code_l1_ratio != 0 or coder.code_pos:
+            return None
+        cache = getattr(self, '_gram_factor_cache', None)
+        if (cache is None or cache[0] is not coder.components_
+                or cache[1] != coder.code_alpha):
+            G = coder.components_.dot(coder.components_.T)
+            G.flat[::coder.n_components + 1] += coder.code_alpha
+            cache = (coder.components_, coder.code_alpha,
+                     linalg.cho_factor(G))
+            self._gram_factor_cache = cache
+        return cache[2]
+
+    def _share_coder(self):
+        """Return a copy of coder_ whose dictionary and Gram matrix are
+        memory-mapped from a temporary folder, and this folder.
+
+        joblib sends memory-mapped arrays to workers as a reference to
+        their file, so that each task only carries the image to process
+        instead of a pickled copy of the dictionary. The folder lies in
+        shared memory (/dev/shm) when available. With n_jobs=1, coder_ and
+        None are returned.
+        """
+        if self.n_jobs == 1:
+            return self.coder_, None
+        if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+            temp_folder = mkdtemp(prefix='modl_coder_', dir='/dev/shm')
+        else:
+            temp_folder = mkdtemp(prefix='modl_coder_')
+        coder = copy.copy(self.coder_)
+        # The coding kernel needs a writeable Gram matrix: copy-on-write
+        # keeps pages shared as long as they are not written
+        for attr, mmap_mode in [('components_', 'r'), ('G_', 'c')]:
+            if hasattr(coder, attr):
+                filename = join(temp_folder, attr + '.npy')
+                np.save(filename, getattr(coder, attr))
+                setattr(coder, attr, np.load(filename, mmap_mode=mmap_mode))
+        return coder, temp_folder
+
 
 class fMRIDictFact(fMRICoderMixin):
     """Perform a map learning algorithm based on component sparsity,
@@ -263,6 +382,110 @@ class fMRIDictFact(fMRICoderMixin):
     verbose: integer, optional
         Indicate the level of verbosity. By default, nothing is printed
 
+    stop_tol: float or None, optional
+        Stop learning when the relative change of the surrogate objective
+        between two epochs falls below stop_tol. See DictFact
+
+    stop_comp_tol: float or None, optional
+        Stop learning when the relative change of the dictionary between
+        two epochs falls below stop_comp_tol. See DictFact
+
+    max_time: float or None, optional
+        Stop learning after max_time seconds of computation (IO excluded)
+
+    max_memory: int or None, optional
+        Maximum number of bytes the learning statistics may use in RAM,
+        checked once data has been scanned and before any allocation. See
+        DictFact
+
+    mixed_precision: boolean, optional
+        Learn in float32 with float64 accumulators for the dictionary
+        statistics. See DictFact
+
+    scan_manifest: str or None, optional
+        JSON file caching the length and dtype of input files, keyed by
+        path, size and modification time, so that later fits do not need to
+        read headers again. create_raw_rest_data writes one in raw_dir.
+
+    n_mix_records: int, optional
+        Number of records kept open at once, across which mini-batches are
+        drawn. 1 feeds records one after the other. Larger values mix
+        subjects and sessions within batches, at the cost of holding
+        n_mix_records records in memory (.npy records are memory-mapped)
+
+    record_cache_dir: str or None, optional
+        If not None, records given as images are masked and cleaned once,
+        during the first epoch, and saved in a temporary subdirectory of
+        record_cache_dir, from which later epochs read them. The
+        subdirectory is removed at the end of fit. Best set to a local
+        disk
+
+    record_cache_dtype: str or None, optional
+        dtype of cached records, e.g. 'float16' to halve the cache size.
+        None keeps the dtype of masked data
+
+    record_cache_size: int or None, optional
+        Maximum number of bytes written in record_cache_dir. Records that
+        do not fit are masked at every epoch
+
+    n_temporal_components: int or None, optional
+        If not None, each record is reduced to its n_temporal_components
+        first temporal components (scaled by their singular values) by a
+        randomized SVD before learning, as in CanICA. This divides the
+        number of samples per epoch by n_time_points /
+        n_temporal_components. Compressions are memory-mapped from .npy
+        files written in record_cache_dir, where later fits with the same
+        records, confounds and masking parameters reuse them, or in a
+        temporary folder removed at the end of fit if record_cache_dir is
+        None. Files in record_cache_dir persist across fits and do not
+        count towards record_cache_size: remove them to free disk space
+
+    n_clusters: int or None, optional
+        If not None, voxels are grouped in n_clusters spatially connected
+        parcels by recursive nearest-neighbor agglomeration (ReNA) of a
+        sample of the data, and the dictionary is learned on parcel
+        averages for n_epochs, which divides the cost of each iteration by
+        about n_voxels / n_clusters. The penalty on codes is multiplied by
+        the mean parcel size, so that learning on parcels approximates
+        learning parcel-wise constant components on voxels with the penalty
+        alpha. Components are then mapped back to voxels. Callbacks are
+        only called at full resolution
+
+    n_refine_epochs: int, optional
+        Number of epochs run at full resolution after learning on parcels,
+        starting from the mapped-back components. Ignored if n_clusters is
+        None
+
+    resolutions: list of float or None, optional
+        If not None, the dictionary is first learned on data downsampled
+        to each of these voxel sizes (in mm), from coarse to fine, e.g.
+        [6, 4]. Data are downsampled by averaging voxels within the cubes
+        of the coarse grid, with the penalty on codes mapped as for
+        n_clusters, and the components of each level initialize the
+        next one, then the final fit at the mask resolution. Resolutions
+        finer than the mask are skipped. Stopping criteria (stop_tol,
+        stop_comp_tol, max_time) apply to each level, and the record cache
+        is shared by all levels
+
+    n_coarse_epochs: int, optional
+        Number of epochs run at each level of resolutions
+
+    record_weights: array-like of shape (n_records,), 'length' or None
+        If not None, each epoch visits n_records records drawn with
+        replacement, with probabilities proportional to record_weights,
+        e.g. a quality column of the data.csv index written by
+        create_raw_rest_data. 'length' weights records by their number of
+        samples. None visits every record once per epoch
+
+    strata: array-like of shape (n_records,) or None, optional
+        Group of each record, e.g. its site or subject. If not None,
+        records are drawn so that each group is visited equally often,
+        records within a group being drawn according to record_weights
+
+    visit_size: int or None, optional
+        Maximum number of samples read from a record at each visit, drawn
+        at random. None reads records in full
+
     """
 
     def __init__(self,
@@ -285,7 +508,25 @@ class fMRIDictFact(fMRICoderMixin):
                  mask_strategy='background', mask_args=None,
                  memory=Memory(cachedir=None), memory_level=0,
                  n_jobs=1, verbose=0,
-                 callback=None):
+                 callback=None,
+                 stop_tol=None,
+                 stop_comp_tol=None,
+                 max_time=None,
+                 max_memory=None,
+                 mixed_precision=False,
+                 scan_manifest=None,
+                 n_mix_records=1,
+                 record_cache_dir=None,
+                 record_cache_dtype=None,
+                 record_cache_size=None,
+                 n_temporal_components=None,
+                 n_clusters=None,
+                 n_refine_epochs=0,
+                 resolutions=None,
+                 n_coarse_epochs=1,
+                 record_weights=None,
+                 strata=None,
+                 visit_size=None):
         fMRICoderMixin.__init__(self, n_components=n_components,
                                 alpha=alpha,
                                 dict_init=dict_init,
@@ -314,6 +555,24 @@ class fMRIDictFact(fMRICoderMixin):
         self.learning_rate = learning_rate
         self.random_state = random_state
         self.callback = callback
+        self.stop_tol = stop_tol
+        self.stop_comp_tol = stop_comp_tol
+        self.max_time = max_time
+        self.max_memory = max_memory
+        self.mixed_precision = mixed_precision
+        self.scan_manifest = scan_manifest
+        self.n_mix_records = n_mix_records
+        self.record_cache_dir = record_cache_dir
+        self.record_cache_dtype = record_cache_dtype
+        self.record_cache_size = record_cache_size
+        self.n_temporal_components = n_temporal_components
+        self.n_clusters = n_clusters
+        self.n_refine_epochs = n_refine_epochs
+        self.resolutions = resolutions
+        self.n_coarse_epochs = n_coarse_epochs
+        self.record_weights = record_weights
+        self.strata = strata
+        self.visit_size = visit_size
 
     def fit(self, imgs=None, y=None, confounds=None):
         """Compute the mask and the dictionary maps across subjects
@@ -343,7 +602,10 @@ class fMRIDictFact(fMRICoderMixin):
         self.components_ = self._cache(_compute_components,
                                        func_memory_level=1,
                                        ignore=['n_jobs',
-                                               'verbose'])(
+                                               'verbose',
+                                               'scan_manifest',
+                                               'record_cache_dir',
+                                               'record_cache_size'])(
             self.masker_, imgs,
             step_size=self.step_size,
             confounds=confounds,
@@ -359,6 +621,24 @@ class fMRIDictFact(fMRICoderMixin):
             verbose=self.verbose,
             random_state=self.random_state,
             callback=self.callback,
+            stop_tol=self.stop_tol,
+            stop_comp_tol=self.stop_comp_tol,
+            max_time=self.max_time,
+            max_memory=self.max_memory,
+            mixed_precision=self.mixed_precision,
+            scan_manifest=self.scan_manifest,
+            n_mix_records=self.n_mix_records,
+            record_cache_dir=self.record_cache_dir,
+            record_cache_dtype=self.record_cache_dtype,
+            record_cache_size=self.record_cache_size,
+            n_temporal_components=self.n_temporal_components,
+            n_clusters=self.n_clusters,
+            n_refine_epochs=self.n_refine_epochs,
+            resolutions=self.resolutions,
+            n_coarse_epochs=self.n_coarse_epochs,
+            record_weights=self.record_weights,
+            strata=self.strata,
+            visit_size=self.visit_size,
             n_jobs=self.n_jobs)
         self.components_img_ = self.masker_.inverse_transform(self.components_)
         self.coder_ = Coder(dictionary=self.components_,
@@ -436,14 +716,25 @@ def _compute_components(masker,
                         verbose=0,
                         random_state=None,
                         callback=None,
+                        stop_tol=None,
+                        stop_comp_tol=None,
+                        max_time=None,
+                        max_memory=None,
+                        mixed_precision=False,
+                        scan_manifest=None,
+                        n_mix_records=1,
+                        record_cache_dir=None,
+                        record_cache_dtype=None,
+                        record_cache_size=None,
+                        n_temporal_components=None,
+                        n_clusters=None,
+                        n_refine_epochs=0,
+                        resolutions=None,
+                        n_coarse_epochs=1,
+                        record_weights=None,
+                        strata=None,
+                        visit_size=None,
                         n_jobs=1):
-    methods = {'masked': {'G_agg': 'masked', 'Dx_agg': 'masked'},
-               'dictionary only': {'G_agg': 'full', 'Dx_agg': 'full'},
-               'gram': {'G_agg': 'masked', 'Dx_agg': 'masked'},
-               # 1st epoch parameters
-               'average': {'G_agg': 'average', 'Dx_agg': 'average'},
-               'reducing ratio': {'G_agg': 'masked', 'Dx_agg': 'masked'}}
-
     masker._check_fitted()
     dict_init = _check_dict_init(dict_init, mask_img=masker.mask_img_,
                                  n_components=n_components)
@@ -457,52 +748,180 @@ def _compute_components(masker,
         Dx_agg = 'full'
         reduction = 1
     else:
-        method = methods[method]
-        G_agg = method['G_agg']
-        Dx_agg = method['Dx_agg']
+        G_agg = METHODS[method]['G_agg']
+        Dx_agg = METHODS[method]['Dx_agg']
         optimizer = 'variational'
 
-    if verbose:
-        print("Scanning data")
-    n_records = len(imgs)
     if confounds is None:
         confounds = itertools.repeat(None)
-    data_list = list(zip(imgs, confounds))
-    # With modl implementation, we need to know the number of samples beforehand,
-    # even if it is actually not useful.
-    n_samples_list, dtype = _lazy_scan(imgs)
-    indices_list = np.zeros(len(imgs) + 1, dtype='int')
-    indices_list[1:] = np.cumsum(n_samples_list)
+    if record_cache_dir is not None:
+        record_cache = _RecordCache(record_cache_dir,
+                                    dtype=record_cache_dtype,
+                                    max_size=record_cache_size)
+    else:
+        record_cache = None
+    temp_dir = None
+    try:
+        if n_temporal_components is not None:
+            if verbose:
+                print("Compressing records")
+            # Compressions are kept in record_cache_dir for later fits, and
+            # in a temporary folder otherwise
+            if record_cache_dir is None:
+                temp_dir = mkdtemp(prefix='modl_tpca_')
+                cache_dir = temp_dir
+            else:
+                cache_dir = record_cache_dir
+            imgs = _compress_records(masker, imgs, confounds,
+                                     n_temporal_components, cache_dir,
+                                     n_jobs=n_jobs)
+            confounds = itertools.repeat(None)
+        if verbose:
+            print("Scanning data")
+        data_list = list(zip(imgs, confounds))
+        # With modl implementation, we need to know the number of samples
+        # beforehand, even if it is actually not useful.
+        n_samples_list, dtype = scan_imgs(imgs, manifest=scan_manifest,
+                                          n_jobs=n_jobs, verbose=verbose)
+        if mixed_precision:
+            dtype = np.dtype(np.float32)
+        indices_list = np.zeros(len(imgs) + 1, dtype='int')
+        indices_list[1:] = np.cumsum(n_samples_list)
+        record_probabilities = _record_probabilities(n_samples_list,
+                                                     record_weights, strata)
+
+        # Each level is a (labels, n_epochs) pair, labels being None at full
+        # resolution. Each level is initialized with the components of the
+        # previous one, mapped back to voxels
+        levels = []
+        mask_img = check_niimg(masker.mask_img_)
+        mask = mask_img.get_data() != 0
+        if resolutions is not None:
+            voxel_size = np.min(np.sqrt(np.sum(mask_img.affine[:3, :3] ** 2,
+                                               axis=0)))
+            for resolution in resolutions:
+                if resolution > voxel_size:
+                    levels.append((grid_clustering(mask, mask_img.affine,
+                                                   resolution),
+                                   n_coarse_epochs))
+        if n_clusters is not None:
+            if verbose:
+                print("Clustering voxels")
+            labels = _cluster_voxels(masker, data_list, mask, n_clusters,
+                                     random_state)
+            levels.append((labels, n_epochs))
+            if n_refine_epochs > 0:
+                levels.append((None, n_refine_epochs))
+        else:
+            levels.append((None, n_epochs))
+
+        dict_fact_params = dict(n_components=n_components,
+                                code_alpha=alpha,
+                                code_l1_ratio=0,
+                                comp_l1_ratio=1,
+                                comp_pos=positive,
+                                reduction=reduction,
+                                Dx_agg=Dx_agg,
+                                optimizer=optimizer,
+                                step_size=step_size,
+                                G_agg=G_agg,
+                                learning_rate=learning_rate,
+                                batch_size=batch_size,
+                                random_state=random_state,
+                                n_threads=n_jobs,
+                                stop_tol=stop_tol,
+                                stop_comp_tol=stop_comp_tol,
+                                max_time=max_time,
+                                max_memory=max_memory,
+                                mixed_precision=mixed_precision,
+                                verbose=0)
+        components = dict_init
+        for labels, this_n_epochs in levels:
+            if verbose and labels is not None:
+                print("Learning on %i parcels" % (labels.max() + 1))
+            elif verbose:
+                print("Learning at full resolution")
+            components = _learn_level(masker, data_list, indices_list,
+                                      dtype, components, labels,
+                                      dict_fact_params, this_n_epochs,
+                                      method, random_state,
+                                      record_probabilities, n_mix_records,
+                                      visit_size, record_cache, callback,
+                                      verbose)
+    finally:
+        if record_cache is not None:
+            record_cache.close()
+        if temp_dir is not None:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+    # Wait for callback artifacts written in the background
+    if hasattr(callback, 'close'):
+        callback.close()
+    return components
+
+
+def _learn_level(masker, data_list, indices_list, dtype, dict_init, labels,
+                 dict_fact_params, n_epochs, method, random_state,
+                 record_probabilities, n_mix_records, visit_size,
+                 record_cache, callback, verbose):
+    """Learn components for n_epochs with a DictFact built from
+    dict_fact_params.
+
+    If labels is not None, data are compressed by averaging voxels within
+    the parcels it defines, and the components learned on parcels are
+    mapped back to parcel-wise constant voxel maps. The code penalty is
+    scaled by the mean parcel size, which matches the voxel-level problem
+    for parcels of equal sizes and approximates it otherwise. Returns
+    components in voxel space"""
+    n_records = len(data_list)
     n_samples = indices_list[-1] + 1
-    n_voxels = np.sum(check_niimg(masker.mask_img_).get_data() != 0)
-
-    if verbose:
-        print("Learning...")
-    dict_fact = DictFact(n_components=n_components,
-                         code_alpha=alpha,
-                         code_l1_ratio=0,
-                         comp_l1_ratio=1,
-                         comp_pos=positive,
-                         reduction=reduction,
-                         Dx_agg=Dx_agg,
-                         optimizer=optimizer,
-                         step_size=step_size,
-                         G_agg=G_agg,
-                         learning_rate=learning_rate,
-                         batch_size=batch_size,
-                         random_state=random_state,
-                         n_threads=n_jobs,
-                         verbose=0)
-    dict_fact.prepare(n_samples=n_samples, n_features=n_voxels,
+    mask = check_niimg(masker.mask_img_).get_data() != 0
+    n_voxels = np.sum(mask)
+    if labels is not None:
+        # Parcels are treated as the pixels of a downsampled image: data are
+        # averaged within parcels, and components are parcel-wise constant.
+        # With parcels of k voxels, the map d taking the values c / k on
+        # the voxels of each parcel has ||d||_1 = ||c||_1, and
+        #     ||x - a d||^2 = k ||x_mean - (a / k) c||^2 + const.
+        # Learning c on parcel means with the penalty alpha * k on codes is
+        # then learning d on voxels with the penalty alpha, restricted to
+        # parcel-wise constant components. This only holds exactly for
+        # parcels of equal sizes. Otherwise k is the mean parcel size, and
+        # the mapping is an approximation: the fit on parcel means weights
+        # all parcels equally, where the voxel objective weights them by
+        # their size
+        n_features = np.max(labels) + 1
+        mean_size = n_voxels / n_features
+        sizes = np.bincount(labels, minlength=n_features)
+        parcel_matrix = sparse.csr_matrix(
+            (1 / sizes[labels], (np.arange(n_voxels), labels)),
+            shape=(n_voxels, n_features), dtype=dtype)
+        if dict_init is not None:
+            dict_init = parcel_matrix.T.dot(dict_init.T).T
+        dict_fact_params = dict(
+            dict_fact_params,
+            code_alpha=dict_fact_params['code_alpha'] * mean_size)
+    else:
+        parcel_matrix = None
+        n_features = n_voxels
+    dict_fact = DictFact(**dict_fact_params)
+    dict_fact.prepare(n_samples=n_samples, n_features=n_features,
                       X=dict_init, dtype=dtype)
+    reduction = dict_fact.reduction
     cpu_time = 0
     io_time = 0
+    # Batches are gathered into this buffer, so that at most one batch of
+    # each record is loaded in memory for memory-mapped records
+    buffer = np.empty((dict_fact.batch_size, n_voxels), dtype=dtype)
     if n_records > 0:
         if verbose:
             verbose_iter_ = np.linspace(0, n_records * n_epochs, verbose)
             verbose_iter_ = verbose_iter_.tolist()
         current_n_records = 0
         for i in range(n_epochs):
+            if dict_fact.converged_:
+                if verbose:
+                    print('Converged after %i epochs' % i)
+                break
             if verbose:
                 print('Epoch %i' % (i + 1))
             if method == 'gram' and i == 5:
@@ -511,41 +930,324 @@ def _compute_components(masker,
             if method == 'reducing ratio':
                 reduction = 1 + (reduction - 1) / sqrt(i + 1)
                 dict_fact.set_params(reduction=reduction)
-            record_list = random_state.permutation(n_records)
-            for record in record_list:
+            if record_probabilities is None:
+                record_list = random_state.permutation(n_records)
+            else:
+                record_list = random_state.choice(
+                    n_records, size=n_records, p=record_probabilities)
+            for (this_data, sample_indices, n_done_records,
+                 this_io_time) in _iter_batches(masker, data_list,
+                                                record_list, indices_list,
+                                                buffer, n_mix_records,
+                                                random_state,
+                                                record_cache=record_cache,
+                                                visit_size=visit_size):
+                io_time += this_io_time
+                if dict_fact.converged_:
+                    break
                 if (verbose and verbose_iter_ and
-                            current_n_records >= verbose_iter_[0]):
-                    print('Record %i' % current_n_records)
-                    if callback is not None:
+                        current_n_records + n_done_records >=
+                        verbose_iter_[0]):
+                    print('Record %i' % (current_n_records + n_done_records))
+                    # Callbacks expect components at full resolution
+                    if callback is not None and parcel_matrix is None:
                         callback(masker, dict_fact, cpu_time, io_time)
                     verbose_iter_ = verbose_iter_[1:]
 
-                # IO bounded
-                t0 = time.perf_counter()
-                img, these_confounds = data_list[record]
-                masked_data = masker.transform(img, confounds=these_confounds)
-                masked_data = masked_data.astype(dtype)
-                io_time += time.perf_counter() - t0
-
                 # CPU bounded
                 t0 = time.perf_counter()
-                permutation = random_state.permutation(
-                    masked_data.shape[0])
-                if method in ['average', 'gram']:
-                    sample_indices = np.arange(
-                        indices_list[record], indices_list[record + 1])
-                    sample_indices = sample_indices[permutation]
-                else:
+                if parcel_matrix is not None:
+                    this_data = parcel_matrix.T.dot(this_data.T).T
+                if method not in ['average', 'gram']:
                     sample_indices = None
-                masked_data = masked_data[permutation]
-                dict_fact.partial_fit(masked_data,
+                dict_fact.partial_fit(this_data,
                                       sample_indices=sample_indices)
-                current_n_records += 1
                 cpu_time += time.perf_counter() - t0
+            current_n_records += n_records
     components = _flip(dict_fact.components_)
+    if labels is not None:
+        components = components[:, labels] / mean_size
     return components
 
 
+def _cluster_voxels(masker, data_list, mask, n_clusters, random_state,
+                    n_records=10, n_samples_per_record=100):
+    """Cluster voxels with ReNA, using a few time points of a few records
+    as features"""
+    data = []
+    for record in random_state.permutation(len(data_list))[:n_records]:
+        img, these_confounds = data_list[record]
+        this_data = _open_record(masker, img, these_confounds)
+        rows = np.sort(random_state.permutation(
+            this_data.shape[0])[:n_samples_per_record])
+        data.append(np.asarray(this_data[rows]))
+    data = np.concatenate(data)
+    return rena_clustering(data, mask, n_clusters)
+
+
+def _record_probabilities(n_samples_list, record_weights=None, strata=None):
+    """Probability of drawing each record at a visit, or None if records
+    should all be visited once per epoch"""
+    if record_weights is None and strata is None:
+        return None
+    n_records = len(n_samples_list)
+    if record_weights is None:
+        weights = np.ones(n_records)
+    elif isinstance(record_weights, str):
+        if record_weights != 'length':
+            raise ValueError("record_weights should be an array or "
+                             "'length', got %s" % record_weights)
+        weights = np.array(n_samples_list, dtype='float')
+    else:
+        weights = np.asarray(record_weights, dtype='float')
+    if weights.shape != (n_records,):
+        raise ValueError('Expected %i record weights, got shape %s'
+                         % (n_records, str(weights.shape)))
+    if np.any(weights < 0) or weights.sum() == 0:
+        raise ValueError('Record weights should be non-negative, '
+                         'with a positive sum')
+    if strata is not None:
+        strata = np.asarray(strata)
+        if strata.shape != (n_records,):
+            raise ValueError('Expected %i strata, got shape %s'
+                             % (n_records, str(strata.shape)))
+        _, strata = np.unique(strata, return_inverse=True)
+        stratum_weights = np.bincount(strata, weights=weights)
+        # Strata of null weight are never visited
+        stratum_weights[stratum_weights == 0] = 1
+        weights = weights / stratum_weights[strata]
+    return weights / weights.sum()
+
+
+def _iter_batches(masker, data_list, record_list, indices_list, buffer,
+                  n_mix_records, random_state, record_cache=None,
+                  visit_size=None):
+    """Yield mini-batches drawn uniformly across n_mix_records resident
+    records.
+
+    Records are opened in the order of record_list, and each is read
+    without replacement along its own permutation. Every batch draws its
+    rows from the pool of unread rows of resident records, so that
+    consecutive batches mix several subjects and sessions. An exhausted
+    record is replaced by the next one of record_list that is not resident.
+    Records are opened
+    through record_cache if provided. If visit_size is not None, at most
+    visit_size random rows of each record are read.
+
+    Yields
+    ------
+    data: ndarray, shape (n_batch_samples, n_voxels)
+        View of buffer holding the batch
+
+    sample_indices: ndarray, shape (n_batch_samples)
+        Index of each row in the concatenation of records
+
+    n_done_records: int
+        Number of records of record_list already exhausted
+
+    io_time: float
+        Time spent opening and reading records for this batch
+    """
+    batch_size = buffer.shape[0]
+    record_list = list(record_list)
+    pool = []
+    n_done_records = 0
+    while True:
+        t0 = time.perf_counter()
+        n_done_records += sum(pos == len(permutation)
+                              for _, _, permutation, pos in pool)
+        pool = [entry for entry in pool if entry[3] < len(entry[2])]
+        while len(pool) < n_mix_records:
+            # A record drawn several times is opened again only once its
+            # previous visit is over, so that a batch never holds the same
+            # row twice
+            resident = [entry[0] for entry in pool]
+            next_record = next((k for k, record in enumerate(record_list)
+                                if record not in resident), None)
+            if next_record is None:
+                break
+            record = record_list.pop(next_record)
+            img, these_confounds = data_list[record]
+            if record_cache is not None:
+                data = record_cache.open(record, masker, img,
+                                         these_confounds)
+            else:
+                data = _open_record(masker, img, these_confounds)
+            permutation = _permutation(data, random_state)[:visit_size]
+            pool.append([record, data, permutation, 0])
+        if not pool:
+            return
+        n_left = np.array([len(permutation) - pos
+                           for _, _, permutation, pos in pool])
+        n_batch_samples = min(batch_size, n_left.sum())
+        # Multivariate hypergeometric draw of the number of rows taken in
+        # each record
+        counts = np.zeros(len(pool), dtype='int')
+        n_rest, n_draw = n_left.sum(), n_batch_samples
+        for k in range(len(pool) - 1):
+            n_rest -= n_left[k]
+            if n_draw > 0:
+                counts[k] = random_state.hypergeometric(n_left[k],
+                                                        n_rest, n_draw)
+                n_draw -= counts[k]
+        counts[-1] = n_draw
+
+        sample_indices = np.empty(n_batch_samples, dtype='int')
+        offset = 0
+        for entry, count in zip(pool, counts):
+            if count == 0:
+                continue
+            record, data, permutation, pos = entry
+            # Sorted rows for sequential reads: order within a batch does
+            # not change the update
+            rows = np.sort(permutation[pos:pos + count])
+            _read_rows(data, rows, buffer[offset:offset + count])
+            sample_indices[offset:offset + count] = (indices_list[record]
+                                                     + rows)
+            entry[3] += count
+            offset += count
+        io_time = time.perf_counter() - t0
+        yield (buffer[:n_batch_samples], sample_indices, n_done_records,
+               io_time)
+
+
+def _temporal_pca_key(masker, img, confounds):
+    """Key of the compression of a record. Records are identified by the
+    fingerprint of their file when they have one, and by their content
+    otherwise (see fingerprint_hash), along with their confounds and the
+    masking parameters"""
+    return fingerprint_hash((masker.get_params(), masker.mask_img_, img,
+                             confounds))
+
+
+def _compress_record(masker, img, confounds, n_temporal_components,
+                     filename, random_state=None):
+    """Reduce a record to its n_temporal_components first temporal
+    components, scaled by their singular values, using a randomized SVD,
+    and save the result in filename"""
+    data = _open_record(masker, img, confounds)
+    if isinstance(data, ChunkedRecord):
+        data = data.read()
+    if n_temporal_components < data.shape[0]:
+        _, S, V = randomized_svd(data, n_temporal_components,
+                                 random_state=random_state)
+        compressed = S[:, np.newaxis] * V
+    else:
+        compressed = np.asarray(data)
+    compressed = compressed.astype(data.dtype, copy=False)
+    tmp_filename = '%s.%i.tmp' % (filename, os.getpid())
+    with open(tmp_filename, 'wb') as f:
+        np.save(f, compressed)
+    os.replace(tmp_filename, filename)
+
+
+def _compress_records(masker, imgs, confounds, n_temporal_components,
+                      cache_dir, n_jobs=1):
+    """Compress records in parallel, in the style of CanICA subject-level
+    PCA. Compressions are saved in cache_dir, and reused if they exist for
+    the same record, confounds and masker. The randomized SVD of a record is
+    seeded by its key, so that compressions do not depend on the
+    random_state of the fit. Returns the list of compressed records,
+    memory-mapped"""
+    filenames = []
+    tasks = []
+    for img, these_confounds in zip(imgs, confounds):
+        key = _temporal_pca_key(masker, img, these_confounds)
+        seed = int(key[:7], 16)
+        filename = join(cache_dir, 'tpca%i_%s.npy'
+                        % (n_temporal_components, key))
+        if not os.path.exists(filename):
+            tasks.append((img, these_confounds, seed, filename))
+        filenames.append(filename)
+    Parallel(n_jobs=n_jobs)(
+        delayed(_compress_record)(masker, img, these_confounds,
+                                  n_temporal_components, filename,
+                                  random_state=seed)
+        for img, these_confounds, seed, filename in tasks)
+    return [np.load(filename, mmap_mode='r') for filename in filenames]
+
+
+def _open_record(masker, img, confounds):
+    """Return the masked data of a record. Raw .npy records are memory
+    mapped and chunked records are returned as a ChunkedRecord, so that rows
+    are only loaded when they are read"""
+    if isinstance(img, np.ndarray) and img.ndim == 2:
+        return img
+    if isinstance(masker, MultiRawMasker):
+        return masker.transform(img, confounds=confounds, mmap_mode='r')
+    return masker.transform(img, confounds=confounds)
+
+
+class _RecordCache(object):
+    """Local cache of preprocessed records.
+
+    The first time a record is opened, its masked data is saved as a .npy
+    file, optionally in reduced precision, so that later epochs
+    memory-map it instead of masking and cleaning the image again. Records
+    that are already memory-mapped (raw .npy records), read on access
+    (chunked records) or in memory are not cached. Once max_size bytes are written, further records are not
+    cached: epochs cycle over all records, so that evicting records would
+    only replace cached records by others. Files live in a private
+    subdirectory of cache_dir, removed by close.
+    """
+    def __init__(self, cache_dir, dtype=None, max_size=None):
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        self.dir_ = mkdtemp(prefix='modl_records_', dir=cache_dir)
+        self.dtype = dtype
+        self.max_size = max_size
+        self.size_ = 0
+        self.filenames_ = {}
+
+    def open(self, record, masker, img, confounds):
+        if record in self.filenames_:
+            return np.load(self.filenames_[record], mmap_mode='r')
+        data = _open_record(masker, img, confounds)
+        if isinstance(data, (np.memmap, ChunkedRecord)) or data is img:
+            return data
+        dtype = data.dtype if self.dtype is None else np.dtype(self.dtype)
+        size = data.shape[0] * data.shape[1] * dtype.itemsize
+        if self.max_size is None or self.size_ + size <= self.max_size:
+            filename = join(self.dir_, 'record_%i.npy' % record)
+            np.save(filename, data.astype(dtype, copy=False))
+            self.filenames_[record] = filename
+            self.size_ += size
+        return data
+
+    def close(self):
+        shutil.rmtree(self.dir_, ignore_errors=True)
+        self.filenames_ = {}
+
+
+def _permutation(data, random_state):
+    """Random order of the rows of a record. Chunked records are visited
+    chunk by chunk, in random order, with rows shuffled within each chunk,
+    so that a visit decompresses each chunk once. Batches still mix
+    n_mix_records records"""
+    n_samples = data.shape[0]
+    if not isinstance(data, ChunkedRecord):
+        return random_state.permutation(n_samples)
+    chunk_size = data.chunk_size
+    starts = random_state.permutation(np.arange(0, n_samples, chunk_size))
+    return np.concatenate([
+        random_state.permutation(np.arange(start,
+                                           min(start + chunk_size,
+                                               n_samples)))
+        for start in starts])
+
+
+def _read_rows(data, rows, out):
+    """Gather the rows of data into out, casting them to out.dtype. rows
+    should be sorted for sequential reads of memory-mapped data. Chunked
+    records only decompress the chunks holding rows"""
+    if isinstance(data, ChunkedRecord):
+        return data.read(rows, out=out)
+    if data.dtype == out.dtype:
+        return np.take(data, rows, axis=0, out=out)
+    out[:] = data[rows]
+    return out
+
+
 def _flip(components):
     """Flip signs in each composant positive part is l1 larger
     than negative part"""
@@ -556,40 +1258,98 @@ def _flip(components):
     return components
 
 
-def _lazy_scan(imgs):
-    """Extracts number of samples and dtype
-    from a 4D list of Niilike-image, without loading data"""
-    n_samples_list = []
-    for img in imgs:
-        print(img)
-        try:
-            img = check_niimg(img)
-            this_n_samples = img.shape[3]
-            dtype = img.get_data_dtype()
-        except ImageFileError:
-            img = np.load(img, mmap_mode='r')
-            this_n_samples = img.shape[0]
-            dtype = img.dtype
-        n_samples_list.append(this_n_samples)
-    return n_samples_list, dtype
-
-
 def _transform_img(coder, masker, img, confounds):
     data = masker.transform(img,
                             confounds=confounds)
     return coder.transform(data)
 
 
+def _dual_regression_img(coder, masker, img, confounds, gram_factor=None,
+                         filename=None):
+    """Dual regression of a single subject, from a single read of its
+    data. gram_factor is the Cholesky factorization of G + alpha I, used
+    to compute ridge time courses in closed form"""
+    data = masker.transform(img, confounds=confounds)
+    if gram_factor is not None:
+        Dx = data.dot(coder.components_.T)
+        code = linalg.cho_solve(gram_factor, Dx.T).T
+    else:
+        code = coder.transform(data)
+    code_gram = code.T.dot(code)
+    maps = linalg.pinvh(code_gram).dot(code.T.dot(data))
+    if filename is not None:
+        np.save(filename, maps)
+        return code, filename
+    return code, maps
+
+
 def _score_img(coder, masker, img, confounds):
+    """Return the objective summed over the samples of img, and their
+    number"""
     data = masker.transform(img, confounds=confounds)
-    return coder.score(data)
+    n_samples = data.shape[0]
+    return coder.score(data) * n_samples, n_samples
 
 
 class rfMRIDictionaryScorer:
-    """Base callback to compute test score"""
+    """Base callback to compute test score
+
+    Parameters
+    ----------
+    test_imgs: list of Niimg-like objects
+        Held-out data
+
+    test_confounds: list of confounds or None
+        Confounds of held-out data
+
+    info: dict or None
+        If not None, filled with the time, score and iteration of each call,
+        and dumped in artifact_dir if it is set
+
+    artifact_dir: str or None
+        Directory where dictionaries are saved at each call
+
+    n_test_samples: int or None
+        If not None, the objective is estimated on n_test_samples time
+        points drawn once among all held-out images, instead of all of them
+
+    n_test_voxels: int or None
+        If not None, the objective is estimated on n_test_voxels voxels
+        drawn once, coding each sample against the restriction of the
+        dictionary to these voxels. The data term is rescaled by
+        n_voxels / n_test_voxels
+
+    random_state: int, RandomState or None
+        Control the selection of time points and voxels
+
+    async_artifacts: bool
+        Write dictionary snapshots and info in a background thread, so
+        that learning is not blocked. Snapshots may then be dropped if they
+        are produced faster than they are written. Call flush to wait for
+        pending writes, and close to also stop the thread (done at the end
+        of fMRIDictFact.fit and in final_score)
+
+    max_pending_artifacts: int
+        Number of snapshots that may wait to be written before older ones
+        are dropped, when async_artifacts is True
+
+    Attributes
+    ----------
+    score: list of float
+        Score at each call, estimated if n_test_samples or n_test_voxels is
+        set
+
+    score_error: list of float
+        Standard error of the estimated scores, due to the sampling of time
+        points and voxels (codes being fixed). 0 for full scores
+    """
 
     def __init__(self, test_imgs, test_confounds=None,
-                 info=None, artifact_dir=None):
+                 info=None, artifact_dir=None,
+                 n_test_samples=None, n_test_voxels=None,
+                 random_state=None,
+                 async_artifacts=False,
+                 max_pending_artifacts=2):
         self.start_time = time.perf_counter()
         self.test_imgs = test_imgs
         if test_confounds is None:
@@ -597,25 +1357,131 @@ class rfMRIDictionaryScorer:
         self.test_confounds = test_confounds
         self.test_time = 0
         self.score = []
+        self.score_error = []
         self.iter = []
         self.time = []
         self.cpu_time = []
         self.io_time = []
         self.info = info
         self.artifact_dir = artifact_dir
+        self.n_test_samples = n_test_samples
+        self.n_test_voxels = n_test_voxels
+        self.random_state = random_state
+        self.async_artifacts = async_artifacts
+        self.max_pending_artifacts = max_pending_artifacts
+        self._writer = None
+
+    def _write(self, key, func, *args):
+        if not self.async_artifacts:
+            func(*args)
+            return
+        if self._writer is None:
+            self._writer = ArtifactWriter(
+                max_pending=self.max_pending_artifacts)
+        self._writer.submit(key, func, *args)
+
+    def flush(self):
+        """Wait for pending artifacts to be written"""
+        if self._writer is not None:
+            self._writer.flush()
+
+    def close(self):
+        """Wait for pending artifacts to be written and stop the background
+        writer. A new one is started if the scorer is called again"""
+        if self._writer is not None:
+            writer, self._writer = self._writer, None
+            writer.close()
+
+    def __del__(self):
+        # __init__ may have failed before setting _writer
+        if getattr(self, '_writer', None) is not None:
+            self.close()
+
+    def _load_data(self, masker):
+        data = masker.transform(self.test_imgs,
+                                confounds=self.test_confounds)
+        if self.n_test_samples is None and self.n_test_voxels is None:
+            self.data = data
+            return
+        # Keep only the sampled time points and voxels in memory
+        random_state = check_random_state(self.random_state)
+        len_imgs = np.array([this_data.shape[0] for this_data in data])
+        self.n_samples_ = np.sum(len_imgs)
+        self.n_voxels_ = data[0].shape[1]
+        n_test_samples = self.n_samples_ if self.n_test_samples is None \
+            else min(self.n_test_samples, self.n_samples_)
+        n_test_voxels = self.n_voxels_ if self.n_test_voxels is None \
+            else min(self.n_test_voxels, self.n_voxels_)
+        samples = np.sort(random_state.permutation(
+            self.n_samples_)[:n_test_samples])
+        self.voxels_ = np.sort(random_state.permutation(
+            self.n_voxels_)[:n_test_voxels])
+        offsets = np.concatenate([[0], np.cumsum(len_imgs)])
+        self.data = np.concatenate(
+            [this_data[samples[(samples >= start) & (samples < stop)]
+                       - start][:, self.voxels_]
+             for this_data, start, stop in zip(data, offsets[:-1],
+                                               offsets[1:])])
+
+    def _subsampled_score(self, dict_fact):
+        """Estimate the objective on sampled time points and voxels, along
+        with its standard error"""
+        n_samples, n_voxels = self.data.shape
+        scale = sqrt(self.n_voxels_ / n_voxels)
+        coder = Coder(dictionary=dict_fact.components_[:, self.voxels_]
+                                 * scale,
+                      code_alpha=dict_fact.code_alpha,
+                      code_l1_ratio=dict_fact.code_l1_ratio,
+                      code_pos=dict_fact.code_pos,
+                      tol=dict_fact.tol,
+                      max_iter=dict_fact.max_iter).fit()
+        X = self.data * scale
+        code = coder.transform(X)
+        residual = X - code.dot(coder.components_)
+        regul = dict_fact.code_alpha * (
+            np.sum(np.abs(code), axis=1) * dict_fact.code_l1_ratio
+            + (1 - dict_fact.code_l1_ratio) * np.sum(code ** 2, axis=1) / 2)
+        objective = np.sum(residual ** 2, axis=1) / 2 + regul
+        score = np.mean(objective)
+        # Variance from time point sampling
+        var = 0
+        if n_samples > 1:
+            var += (np.var(objective, ddof=1) / n_samples
+                    * (1 - n_samples / self.n_samples_))
+        # Variance from voxel sampling
+        if n_voxels > 1:
+            loss = np.sum(residual ** 2, axis=0) / 2 / n_samples
+            var += (n_voxels * np.var(loss, ddof=1)
+                    * (1 - n_voxels / self.n_voxels_))
+        return score, sqrt(var)
+
+    def final_score(self, estimator):
+        """Full score of a fitted fMRIDictFact on held-out data, to be
+        computed once learning is over when scores are estimated during
+        learning"""
+        score = estimator.score(self.test_imgs, confounds=self.test_confounds)
+        self.close()
+        if self.info is not None:
+            self.info['final_score'] = score
+            if self.artifact_dir is not None:
+                dump(self.info, join(self.artifact_dir, 'info.pkl'))
+        return score
 
     def __call__(self, masker, dict_fact, cpu_time, io_time):
         test_time = time.perf_counter()
         if not hasattr(self, 'data'):
-            self.data = masker.transform(self.test_imgs,
-                                         confounds=self.test_confounds)
-        scores = np.array([dict_fact.score(data) for data in self.data])
-        len_imgs = np.array([data.shape[0] for data in self.data])
-
-        score = np.sum(scores * len_imgs) / np.sum(len_imgs)
+            self._load_data(masker)
+        if self.n_test_samples is None and self.n_test_voxels is None:
+            scores = np.array([dict_fact.score(data) for data in self.data])
+            len_imgs = np.array([data.shape[0] for data in self.data])
+            score = np.sum(scores * len_imgs) / np.sum(len_imgs)
+            error = 0.
+        else:
+            score, error = self._subsampled_score(dict_fact)
         self.test_time += time.perf_counter() - test_time
         this_time = time.perf_counter() - self.start_time - self.test_time
         self.score.append(score)
+        self.score_error.append(error)
         self.time.append(this_time)
         self.cpu_time.append(cpu_time)
         self.io_time.append(io_time)
@@ -623,11 +1489,21 @@ class rfMRIDictionaryScorer:
         if self.info is not None:
             self.info['time'] = self.cpu_time
             self.info['score'] = self.score
+            self.info['score_error'] = self.score_error
             self.info['iter'] = self.iter
-            dump(self.info, join(self.artifact_dir, 'info.pkl'))
+            if self.artifact_dir is not None:
+                self._write('info', dump, copy.deepcopy(self.info),
+                            join(self.artifact_dir, 'info.pkl'))
 
         if self.artifact_dir is not None:
+            # _flip returns a copy, safe to write while learning goes on
             components = _flip(dict_fact.components_)
-            components_img = masker.inverse_transform(components)
-            components_img.to_filename(join(self.artifact_dir, 'components_%i.nii.gz')
-                                       % dict_fact.n_iter_)
+            filename = join(self.artifact_dir, 'components_%i.nii.gz'
+                            % dict_fact.n_iter_)
+            self._write(filename, _write_components, masker, components,
+                        filename)
+
+
+def _write_components(masker, components, filename):
+    components_img = masker.inverse_transform(components)
+    components_img.to_filename(filename)
@@ -2,21 +2,17 @@ from math import sqrt
 
 import time
 
+import numpy as np
 from modl.feature_extraction.image import LazyCleanPatchExtractor
 from modl.input_data.image import scale_patches
 from sklearn.base import BaseEstimator
 from sklearn.utils import check_random_state, gen_batches
 
-from .dict_fact import DictFact
+from .dict_fact import DictFact, METHODS
 
 
 class ImageDictFact(BaseEstimator):
-    methods = {'masked': {'G_agg': 'masked', 'Dx_agg': 'masked'},
-               'dictionary only': {'G_agg': 'full', 'Dx_agg': 'full'},
-               'gram': {'G_agg': 'masked', 'Dx_agg': 'masked'},
-               # 1st epoch parameters
-               'average': {'G_agg': 'average', 'Dx_agg': 'average'},
-               'reducing ratio': {'G_agg': 'masked', 'Dx_agg': 'masked'}}
+    methods = METHODS
 
     settings = {'dictionary learning': {'comp_l1_ratio': 0,
                                         'code_l1_ratio': 1,
@@ -47,8 +43,14 @@ class ImageDictFact(BaseEstimator):
                  max_patches=None,
                  verbose=0,
                  n_threads=1,
+                 code_cache_size=0,
+                 stop_tol=None,
+                 stop_comp_tol=None,
+                 max_time=None,
+                 mixed_precision=False,
                  ):
         self.n_threads = n_threads
+        self.code_cache_size = code_cache_size
         self.step_size = step_size
         self.verbose = verbose
         self.callback = callback
@@ -64,6 +66,10 @@ class ImageDictFact(BaseEstimator):
         self.patch_size = patch_size
         self.buffer_size = buffer_size
         self.max_patches = max_patches
+        self.stop_tol = stop_tol
+        self.stop_comp_tol = stop_comp_tol
+        self.max_time = max_time
+        self.mixed_precision = mixed_precision
 
     def fit(self, image, y=None):
         self.random_state = check_random_state(self.random_state)
@@ -111,62 +117,76 @@ class ImageDictFact(BaseEstimator):
                                    tol=1e-2,
                                    callback=self._callback,
                                    verbose=self.verbose,
-                                   n_threads=self.n_threads)
+                                   n_threads=self.n_threads,
+                                   code_cache_size=self.code_cache_size,
+                                   stop_tol=self.stop_tol,
+                                   stop_comp_tol=self.stop_comp_tol,
+                                   max_time=self.max_time,
+                                   mixed_precision=self.mixed_precision)
 
         if self.verbose:
             print('Preparing patch extraction')
         patch_extractor = LazyCleanPatchExtractor(
             patch_size=self.patch_size, max_patches=self.max_patches,
-            random_state=self.random_state)
+            random_state=self.random_state, n_threads=self.n_threads)
         patch_extractor.fit(image)
 
-        n_patches = patch_extractor.n_patches_
-        self.patch_shape_ = patch_extractor.patch_shape_
+        try:
+            n_patches = patch_extractor.n_patches_
+            self.patch_shape_ = patch_extractor.patch_shape_
 
-        if self.verbose:
-            print('Fitting dictionary')
-        init_patches = patch_extractor.partial_transform(batch=
-                                                         self.n_components)
-        init_patches = _flatten_patches(init_patches, with_std=with_std,
-                                        with_mean=with_mean, copy=False)
-        self.dict_fact_.prepare(n_samples=n_patches, X=init_patches)
-        for i in range(self.n_epochs):
             if self.verbose:
-                print('Epoch %i' % (i + 1))
-            if i >= 1:
+                print('Fitting dictionary')
+            init_patches = patch_extractor.partial_transform_flat(
+                batch=self.n_components, with_mean=with_mean,
+                with_std=with_std)
+            self.dict_fact_.prepare(n_samples=n_patches, X=init_patches)
+            # Patches are gathered and scaled into this reused buffer
+            patches_buffer = np.empty((buffer_size, init_patches.shape[1]),
+                                      dtype=init_patches.dtype)
+            for i in range(self.n_epochs):
+                if self.dict_fact_.converged_:
+                    break
                 if self.verbose:
-                    print('Shuffling dataset')
-                permutation = self.dict_fact_.shuffle()
-                patch_extractor.shuffle(permutation)
-            buffers = gen_batches(n_patches, buffer_size)
-            if self.method == 'gram' and i == 4:
-                self.dict_fact_.set_params(G_agg='full', Dx_agg='average')
-            if self.method == 'reducing ratio':
-                reduction = 1 + (self.reduction - 1) / sqrt(i + 1)
-                self.dict_fact_.set_params(reduction=reduction)
-            for j, buffer in enumerate(buffers):
-                buffer_size = buffer.stop - buffer.start
-                patches = patch_extractor.partial_transform(batch=buffer)
-                patches = _flatten_patches(patches, with_mean=with_mean,
-                                           with_std=with_std, copy=False)
-                self.dict_fact_.partial_fit(patches, buffer)
+                    print('Epoch %i' % (i + 1))
+                if i >= 1:
+                    if self.verbose:
+                        print('Shuffling dataset')
+                    permutation = self.dict_fact_.shuffle()
+                    patch_extractor.shuffle(permutation)
+                buffers = gen_batches(n_patches, buffer_size)
+                if self.method == 'gram' and i == 4:
+                    self.dict_fact_.set_params(G_agg='full', Dx_agg='average')
+                if self.method == 'reducing ratio':
+                    reduction = 1 + (self.reduction - 1) / sqrt(i + 1)
+                    self.dict_fact_.set_params(reduction=reduction)
+                for j, buffer in enumerate(buffers):
+                    if self.dict_fact_.converged_:
+                        break
+                    buffer_size = buffer.stop - buffer.start
+                    patches = patch_extractor.partial_transform_flat(
+                        batch=buffer, out=patches_buffer[:buffer_size],
+                        with_mean=with_mean, with_std=with_std)
+                    self.dict_fact_.partial_fit(patches, buffer)
+        finally:
+            patch_extractor.close()
         return self
 
     def transform(self, patches):
         with_std = ImageDictFact.settings[self.setting]['with_std']
         with_mean = ImageDictFact.settings[self.setting]['with_mean']
 
-        patches = _flatten_patches(patches, with_mean=with_mean,
-                                   with_std=with_std, copy=True)
-        return self.dict_fact_.transform(patches)
+        flat_patches = _flatten_patches(patches, with_mean=with_mean,
+                                        with_std=with_std, copy=True)
+        return self.dict_fact_.transform(flat_patches, cache_key=patches)
 
     def score(self, patches):
         with_std = ImageDictFact.settings[self.setting]['with_std']
         with_mean = ImageDictFact.settings[self.setting]['with_mean']
 
-        patches = _flatten_patches(patches, with_mean=with_mean,
-                                   with_std=with_std, copy=True)
-        return self.dict_fact_.score(patches)
+        flat_patches = _flatten_patches(patches, with_mean=with_mean,
+                                        with_std=with_std, copy=True)
+        return self.dict_fact_.score(flat_patches, cache_key=patches)
 
     @property
     def n_iter_(self):
@@ -0,0 +1,30 @@
+import threading
+
+from modl.decomposition.autotune import autotune
+from modl.decomposition.dict_fact import DictFact
+from modl.decomposition.tests.test_dict_fact import generate_synthetic
+
+
+def test_autotune():
+    X, Q = generate_synthetic(n_features=20,
+                              n_samples=400,
+                              dictionary_rank=4)
+    n_threads = threading.active_count()
+    params, report = autotune(X, n_components=4, code_alpha=1e-2,
+                              batch_sizes=(10, 50), reductions=(1, 4, 40),
+                              n_threads_list=(1, 2), random_state=0)
+    # Worker threads of the candidates are stopped
+    assert threading.active_count() == n_threads
+    # 'dictionary only' is benchmarked once per n_threads, reduction 40 is
+    # larger than n_features
+    assert len(report) == 2 * 2 * 2 * 2 + 2 * 2
+    best = max(report, key=lambda entry: entry['rate'])
+    assert params['batch_size'] == best['batch_size']
+    assert params['reduction'] == best['reduction']
+    assert params['method'] in ['masked', 'dictionary only', 'average']
+    for entry in report:
+        assert entry['time'] > 0
+
+    params.pop('method')
+    dict_fact = DictFact(n_components=4, random_state=0, **params)
+    dict_fact.fit(X)
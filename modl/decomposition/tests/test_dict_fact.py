@@ -1,10 +1,12 @@
 # Author: Arthur Mensch
+import gc
+import weakref
 
 import numpy as np
 import pytest
 from modl.decomposition.dict_fact import DictFact
 from numpy import linalg
-from numpy.testing import assert_array_equal
+from numpy.testing import assert_array_equal, assert_array_almost_equal
 from sklearn.linear_model import cd_fast
 from sklearn.utils import check_random_state
 
@@ -154,6 +156,167 @@ def test_dict_mf_reconstruction_sparse_dict(solver):
     assert (recovered_maps >= 4)
 
 
+def test_dict_mf_transform_code_cache():
+    X, Q = generate_synthetic(n_features=20,
+                              n_samples=400,
+                              dictionary_rank=4)
+    dict_mf = DictFact(n_components=4, code_alpha=1e-2, n_epochs=1,
+                       code_l1_ratio=1, code_cache_size=1,
+                       tol=1e-8, max_iter=1000, random_state=0)
+    dict_mf.fit(X)
+    P1 = dict_mf.transform(X)
+    assert len(dict_mf._code_cache) == 1
+    # Warm-started transform converges to the same codes
+    P2 = dict_mf.transform(X)
+    assert_array_almost_equal(P1, P2, decimal=2)
+    # A different input evicts the previous entry
+    dict_mf.transform(X[:10])
+    assert len(dict_mf._code_cache) == 1
+    dict_mf.set_params(code_cache_size=0)
+    P3 = dict_mf.transform(X)
+    assert_array_almost_equal(P1, P3, decimal=2)
+
+
+@pytest.mark.parametrize("solver", ['masked', 'full'])
+def test_dict_mf_surrogate(solver):
+    X, Q = generate_synthetic(n_features=20,
+                              n_samples=400,
+                              dictionary_rank=4)
+    dict_mf = DictFact(n_components=4, code_alpha=1e-2, n_epochs=5,
+                       G_agg=solver_dict[solver]['G_agg'],
+                       Dx_agg=solver_dict[solver]['Dx_agg'],
+                       check_freq=400, random_state=0, reduction=2)
+    dict_mf.fit(X)
+    monitor = dict_mf.monitor_
+    assert len(monitor['surrogate']) == 5
+    assert_array_equal(monitor['iter'], np.arange(1, 6) * 400)
+    assert monitor['surrogate'][-1] < monitor['surrogate'][0]
+    # The surrogate approximates the objective function
+    score = dict_mf.score(X)
+    assert abs(monitor['surrogate'][-1] - score) < 0.2 * score
+    assert not dict_mf.converged_
+
+    # Without convergence criteria nor check_freq, nothing is monitored
+    dict_mf.set_params(check_freq=None)
+    dict_mf.fit(X)
+    assert dict_mf.monitor_['surrogate'] == []
+    assert np.isnan(dict_mf.loss_)
+    assert not hasattr(dict_mf, 'last_components_')
+
+    # The dictionary change alone is checked once per epoch, without the
+    # loss nor the surrogate objective
+    dict_mf.set_params(stop_comp_tol=1e-10)
+    dict_mf.fit(X)
+    assert len(dict_mf.monitor_['comp_change']) == 5
+    assert np.all(np.isnan(dict_mf.monitor_['surrogate']))
+    assert np.isnan(dict_mf.loss_)
+
+
+def test_dict_mf_early_stopping():
+    X, Q = generate_synthetic(n_features=20,
+                              n_samples=400,
+                              dictionary_rank=4)
+    dict_mf = DictFact(n_components=4, code_alpha=1e-2, n_epochs=100,
+                       stop_tol=1e-3, random_state=0, reduction=2)
+    dict_mf.fit(X)
+    assert dict_mf.converged_
+    assert dict_mf.n_iter_ < 100 * 400
+    # Further calls do not update the estimator
+    n_iter = dict_mf.n_iter_
+    dict_mf.partial_fit(X)
+    assert dict_mf.n_iter_ == n_iter
+
+    dict_mf = DictFact(n_components=4, code_alpha=1e-2, n_epochs=100,
+                       stop_comp_tol=1e-2, check_freq=100,
+                       random_state=0, reduction=2)
+    dict_mf.fit(X)
+    assert dict_mf.converged_
+    assert dict_mf.monitor_['comp_change'][-1] < 1e-2
+
+    dict_mf = DictFact(n_components=4, code_alpha=1e-2, n_epochs=100,
+                       max_time=0, random_state=0, reduction=2)
+    dict_mf.fit(X)
+    assert dict_mf.n_iter_ == 400
+
+
+def test_dict_mf_estimate_resources():
+    dict_mf = DictFact(n_components=10, G_agg='average', Dx_agg='average')
+    resources = dict_mf.estimate_resources(1000, 100, dtype=np.float32)
+    assert resources['G_average_'] == {'ram': 0, 'disk': 1000 * 100 * 4}
+    assert resources['Dx_average_']['ram'] == 1000 * 10 * 4
+    assert resources['components_']['ram'] == 10 * 100 * 4
+    assert 'G_' not in resources
+    assert resources['total']['disk'] == 1000 * 100 * 4
+    assert resources['total']['ram'] == sum(
+        this['ram'] for attr, this in resources.items() if attr != 'total')
+
+    resources = dict_mf.estimate_resources(1000, 100, dtype=np.float32,
+                                           mmap_attrs=['code_'])
+    assert resources['code_'] == {'ram': 0, 'disk': 1000 * 10 * 4}
+
+
+def test_dict_mf_max_memory():
+    X, Q = generate_synthetic(n_samples=2000, n_features=16)
+    dict_mf = DictFact(n_components=4, Dx_agg='average', random_state=0)
+    resources = dict_mf.estimate_resources(2000, 16)
+    ram = resources['total']['ram']
+    code_ram = resources['code_']['ram']
+
+    dict_mf.fit(X)
+    D1 = dict_mf.components_.copy()
+
+    dict_mf.set_params(max_memory=ram - code_ram // 2, random_state=0)
+    dict_mf.fit(X)
+    assert isinstance(dict_mf.code_, np.memmap)
+    assert not isinstance(dict_mf.Dx_average_, np.memmap)
+    assert_array_equal(D1, dict_mf.components_)
+
+    # Temporary files are closed when replaced, and do not keep the
+    # estimator alive
+    mmap_file = dict_mf.code_mmap_
+    dict_mf.fit(X)
+    assert mmap_file.closed
+    mmap_file = dict_mf.code_mmap_
+    ref = weakref.ref(dict_mf)
+    del dict_mf
+    gc.collect()
+    assert ref() is None
+    assert mmap_file.closed
+
+    dict_mf = DictFact(n_components=4, Dx_agg='average', random_state=0,
+                       max_memory=ram - 2 * code_ram - 1)
+    with pytest.raises(MemoryError):
+        dict_mf.fit(X)
+
+
+@pytest.mark.parametrize("solver", solvers)
+def test_dict_mf_mixed_precision(solver):
+    X, Q = generate_synthetic()
+    dict_mf = DictFact(n_components=4,
+                       code_alpha=1e-4,
+                       n_epochs=5,
+                       comp_l1_ratio=0,
+                       G_agg=solver_dict[solver]['G_agg'],
+                       Dx_agg=solver_dict[solver]['Dx_agg'],
+                       mixed_precision=True,
+                       random_state=rng_global, reduction=1)
+    dict_mf.fit(X)
+    assert dict_mf.components_.dtype == np.float32
+    assert dict_mf.code_.dtype == np.float32
+    assert dict_mf.gradient_.dtype == np.float32
+    assert dict_mf.B_.dtype == np.float64
+    assert dict_mf.C_.dtype == np.float64
+    P = dict_mf.transform(X)
+    assert P.dtype == np.float32
+    Y = P.dot(dict_mf.components_)
+    rel_error = np.sum((X - Y) ** 2) / np.sum(X ** 2)
+    assert (rel_error < 0.02)
+
+    resources = dict_mf.estimate_resources(200, 16)
+    assert resources['B_']['ram'] == 4 * 16 * 8
+    assert resources['components_']['ram'] == 4 * 16 * 4
+
+
 def enet_regression_multi_gram_(G, Dx, X, code, l1_ratio, alpha,
                                 positive):
     batch_size = code.shape[0]
@@ -1,11 +1,22 @@
+import os
+import shutil
+from tempfile import mkdtemp
+
 import nibabel
 import numpy as np
 import pytest
-from nilearn.image import iter_img
+from numpy.testing import assert_array_equal, assert_array_almost_equal
+from nilearn.image import index_img, iter_img
 from nilearn.input_data import MultiNiftiMasker
 from sklearn.externals.joblib import Memory
 
 from modl.decomposition import fMRIDictFact
+from modl.decomposition.dict_fact import DictFact
+from modl.decomposition.fmri import (_compute_components, _iter_batches,
+                                     _record_probabilities,
+                                     rfMRIDictionaryScorer)
+from modl.input_data.fmri.chunked import ChunkedRecord, save_chunked
+from modl.input_data.fmri.unmask import MultiRawMasker
 from modl.utils.system import get_cache_dirs
 
 methods = ['masked', 'average', 'gram', 'reducing ratio', 'dictionary only']
@@ -130,6 +141,431 @@ def test_component_sign():
         mp = mp.get_data()
         assert(np.sum(mp[mp <= 0]) <= np.sum(mp[mp > 0]))
 
+def test_dict_fact_raw_records():
+    data, mask_img, components, init = _make_test_data(n_subjects=3)
+    masker = MultiRawMasker(mask_img=mask_img).fit()
+    raw_data = MultiNiftiMasker(mask_img).fit().transform(data)
+    tmpdir = mkdtemp()
+    try:
+        filenames = []
+        for i, this_data in enumerate(raw_data):
+            filename = os.path.join(tmpdir, 'record_%i.npy' % i)
+            np.save(filename, this_data)
+            filenames.append(filename)
+        maps = []
+        for imgs in [raw_data, filenames]:
+            maps.append(_compute_components(masker, imgs, dict_init=init,
+                                            n_components=4,
+                                            method='average', reduction=2,
+                                            batch_size=15, n_epochs=2,
+                                            random_state=0))
+        # Memory-mapped records yield the same result as in-memory arrays
+        np.testing.assert_array_almost_equal(maps[0], maps[1])
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+@pytest.mark.parametrize("n_mix_records", [1, 3])
+def test_iter_batches(n_mix_records):
+    mask_img = nibabel.Nifti1Image(np.ones((2, 2, 1), dtype=np.int8),
+                                   np.eye(4))
+    masker = MultiRawMasker(mask_img=mask_img).fit()
+    lengths = [7, 12, 5, 9]
+    data_list = [(np.full((length, 4), i, dtype='float64'), None)
+                 for i, length in enumerate(lengths)]
+    indices_list = np.zeros(len(lengths) + 1, dtype='int')
+    indices_list[1:] = np.cumsum(lengths)
+    buffer = np.empty((4, 4), dtype='float32')
+    seen = []
+    n_mixed = 0
+    for data, sample_indices, _, _ in _iter_batches(
+            masker, data_list, [2, 0, 3, 1], indices_list, buffer,
+            n_mix_records, np.random.RandomState(0)):
+        records = np.searchsorted(indices_list, sample_indices,
+                                  side='right') - 1
+        assert_array_equal(data[:, 0], records)
+        n_mixed += len(np.unique(records)) > 1
+        seen.append(sample_indices)
+    seen = np.sort(np.concatenate(seen))
+    assert_array_equal(seen, np.arange(np.sum(lengths)))
+    if n_mix_records == 1:
+        assert n_mixed == 0
+    else:
+        assert n_mixed > 0
+
+
+def test_iter_batches_visit_size():
+    mask_img = nibabel.Nifti1Image(np.ones((2, 2, 1), dtype=np.int8),
+                                   np.eye(4))
+    masker = MultiRawMasker(mask_img=mask_img).fit()
+    lengths = [7, 12, 5]
+    data_list = [(np.full((length, 4), i, dtype='float64'), None)
+                 for i, length in enumerate(lengths)]
+    indices_list = np.zeros(len(lengths) + 1, dtype='int')
+    indices_list[1:] = np.cumsum(lengths)
+    buffer = np.empty((4, 4), dtype='float64')
+    # Record 1 is visited twice
+    seen = np.concatenate([sample_indices for _, sample_indices, _, _ in
+                           _iter_batches(masker, data_list, [1, 0, 1, 2],
+                                         indices_list, buffer, 2,
+                                         np.random.RandomState(0),
+                                         visit_size=6)])
+    records = np.searchsorted(indices_list, seen, side='right') - 1
+    assert_array_equal(np.bincount(records), [6, 12, 5])
+
+
+def test_iter_batches_repeated_records():
+    mask_img = nibabel.Nifti1Image(np.ones((2, 2, 1), dtype=np.int8),
+                                   np.eye(4))
+    masker = MultiRawMasker(mask_img=mask_img).fit()
+    lengths = [7, 12, 5]
+    data_list = [(np.full((length, 4), i, dtype='float64'), None)
+                 for i, length in enumerate(lengths)]
+    indices_list = np.zeros(len(lengths) + 1, dtype='int')
+    indices_list[1:] = np.cumsum(lengths)
+    buffer = np.empty((6, 4), dtype='float64')
+    random_state = np.random.RandomState(0)
+    # Record 0 dominates the weights, and is drawn several times
+    p = _record_probabilities(lengths, [100, 1, 1])
+    record_list = random_state.choice(3, size=6, p=p)
+    assert np.sum(record_list == 0) > 1
+    n_seen = 0
+    for _, sample_indices, _, _ in _iter_batches(
+            masker, data_list, record_list, indices_list, buffer, 2,
+            random_state):
+        assert len(np.unique(sample_indices)) == len(sample_indices)
+        n_seen += len(sample_indices)
+    assert n_seen == np.sum(np.array(lengths)[record_list])
+
+
+def test_record_probabilities():
+    assert _record_probabilities([10, 30]) is None
+    assert_array_almost_equal(_record_probabilities([10, 30], 'length'),
+                              [0.25, 0.75])
+    assert_array_almost_equal(_record_probabilities([10, 30], [3, 1]),
+                              [0.75, 0.25])
+    # Sites are visited equally often, whatever their number of records
+    strata = ['a', 'a', 'a', 'b']
+    assert_array_almost_equal(_record_probabilities([1] * 4, strata=strata),
+                              [1 / 6, 1 / 6, 1 / 6, 1 / 2])
+    assert_array_almost_equal(
+        _record_probabilities([1] * 4, [2, 1, 1, 5], strata=strata),
+        [1 / 4, 1 / 8, 1 / 8, 1 / 2])
+    with pytest.raises(ValueError):
+        _record_probabilities([10, 30], [1, -1])
+    with pytest.raises(ValueError):
+        _record_probabilities([10, 30], 'quality')
+
+
+def test_dict_fact_weighted_records():
+    data, mask_img, components, init = _make_test_data(n_subjects=4)
+    masker = MultiNiftiMasker(mask_img).fit()
+    components_ = masker.transform(components)
+    components_ /= np.sqrt(np.sum(components_ ** 2, axis=1, keepdims=True))
+    maps = _compute_components(masker, data, dict_init=init, n_components=4,
+                               alpha=1, n_epochs=3, random_state=0,
+                               record_weights='length',
+                               strata=[0, 0, 1, 1], visit_size=30)
+    maps /= np.sqrt(np.sum(maps ** 2, axis=1, keepdims=True))
+    G = np.abs(components_.dot(maps.T))
+    assert np.sum(G > 0.95) >= 4
+
+
+def test_dict_fact_chunked_records(monkeypatch):
+    data, mask_img, components, init = _make_test_data(n_subjects=4)
+    raw_data = MultiNiftiMasker(mask_img).fit().transform(data)
+    masker = MultiRawMasker(mask_img=mask_img).fit()
+    n_reads = [0]
+    read_chunk = ChunkedRecord._read_chunk
+
+    def counting_read_chunk(self, f, i):
+        n_reads[0] += 1
+        return read_chunk(self, f, i)
+
+    monkeypatch.setattr(ChunkedRecord, '_read_chunk', counting_read_chunk)
+    tmpdir = mkdtemp()
+    try:
+        filenames = []
+        for i, this_data in enumerate(raw_data):
+            filename = os.path.join(tmpdir, 'record_%i.chunks' % i)
+            save_chunked(filename, this_data, chunk_size=10)
+            filenames.append(filename)
+        # Each visit of 10 rows decompresses a single chunk of the 4 chunks
+        # of a record
+        _compute_components(masker, filenames, dict_init=init,
+                            n_components=4, batch_size=4, n_epochs=2,
+                            visit_size=10, random_state=0)
+        assert n_reads[0] == 2 * 4
+        # Full visits decompress each chunk once
+        n_reads[0] = 0
+        maps = _compute_components(masker, filenames, dict_init=init,
+                                   n_components=4, alpha=1, n_epochs=3,
+                                   random_state=0)
+        assert n_reads[0] == 3 * 4 * 4
+    finally:
+        shutil.rmtree(tmpdir)
+    components_ = masker.transform(components)
+    components_ /= np.sqrt(np.sum(components_ ** 2, axis=1, keepdims=True))
+    maps /= np.sqrt(np.sum(maps ** 2, axis=1, keepdims=True))
+    G = np.abs(components_.dot(maps.T))
+    assert np.sum(G > 0.95) >= 4
+
+
+@pytest.mark.parametrize("record_cache_dtype", [None, 'float16'])
+def test_dict_fact_record_cache(record_cache_dtype):
+    data, mask_img, components, init = _make_test_data(n_subjects=3)
+    masker = MultiNiftiMasker(mask_img).fit()
+    tmpdir = mkdtemp()
+    try:
+        maps = []
+        for record_cache_dir in [None, tmpdir]:
+            maps.append(_compute_components(
+                masker, data, dict_init=init, n_components=4,
+                batch_size=15, n_epochs=3, random_state=0,
+                record_cache_dir=record_cache_dir,
+                record_cache_dtype=record_cache_dtype,
+                record_cache_size=2 * 40 * 400 * 8))
+        # Cache is removed
+        assert os.listdir(tmpdir) == []
+    finally:
+        shutil.rmtree(tmpdir)
+    if record_cache_dtype is None:
+        assert_array_almost_equal(maps[0], maps[1])
+    else:
+        assert_array_almost_equal(maps[0], maps[1], decimal=2)
+
+
+def test_transform_shared_dictionary():
+    data, mask_img, components, init = _make_test_data(n_subjects=3)
+    dict_fact = fMRIDictFact(n_components=4, random_state=0,
+                             mask=mask_img, dict_init=init,
+                             smoothing_fwhm=None).fit(data)
+    codes = dict_fact.transform(data)
+    score = dict_fact.score(data)
+    dict_fact.set_params(n_jobs=2)
+    shared_codes = dict_fact.transform(data)
+    for code, shared_code in zip(codes, shared_codes):
+        assert_array_almost_equal(code, shared_code)
+    assert_array_almost_equal(score, dict_fact.score(data))
+
+
+def test_dual_regression():
+    data, mask_img, components, init = _make_test_data(n_subjects=3)
+    dict_fact = fMRIDictFact(n_components=4, random_state=0,
+                             mask=mask_img, dict_init=init, alpha=1e-3,
+                             smoothing_fwhm=None).fit(data)
+    codes, maps = dict_fact.dual_regression(data)
+    assert len(codes) == len(maps) == 3
+    for img, code, this_maps in zip(data, codes, maps):
+        assert code.shape == (40, 4)
+        assert this_maps.shape == (4, 400)
+        # Subject maps are the least-squares fit given time courses
+        X = dict_fact.masker_.transform(img)
+        expected = np.linalg.lstsq(code, X, rcond=None)[0]
+        assert_array_almost_equal(this_maps, expected)
+    assert_array_almost_equal(codes[0], dict_fact.transform(data[0])[0],
+                              decimal=2)
+    # The factorization of the Gram matrix is computed once per dictionary
+    gram_factor = dict_fact._gram_factor()
+    assert dict_fact._gram_factor() is gram_factor
+    dict_fact.coder_.set_params(code_alpha=1e-2)
+    assert dict_fact._gram_factor() is not gram_factor
+    dict_fact.coder_.set_params(code_alpha=1e-3)
+
+    tmpdir = mkdtemp()
+    try:
+        dict_fact.set_params(n_jobs=2)
+        _, filenames = dict_fact.dual_regression(data, output_dir=tmpdir)
+        for filename, this_maps in zip(filenames, maps):
+            assert_array_almost_equal(np.load(filename), this_maps)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_score_weighting():
+    data, mask_img, components, init = _make_test_data(n_subjects=2)
+    dict_fact = fMRIDictFact(n_components=4, random_state=0,
+                             mask=mask_img, dict_init=init,
+                             smoothing_fwhm=None).fit(data)
+    imgs = [index_img(data[0], slice(0, 10)), data[1]]
+    scores = [dict_fact.score(img) for img in imgs]
+    # Images are weighted by their number of samples
+    assert_array_almost_equal(dict_fact.score(imgs),
+                              (10 * scores[0] + 40 * scores[1]) / 50)
+
+
+def test_scorer_subsampled():
+    data, mask_img, components, init = _make_test_data(n_subjects=3)
+    masker = MultiNiftiMasker(mask_img).fit()
+    X = np.concatenate(masker.transform(data))
+    dict_fact = DictFact(n_components=4, code_alpha=1, random_state=0,
+                         n_epochs=2).fit(X)
+    scorer = rfMRIDictionaryScorer(data)
+    scorer(masker, dict_fact, 0, 0)
+    full_score = scorer.score[0]
+    assert scorer.score_error[0] == 0
+
+    # Sampling everything yields the full score
+    scorer = rfMRIDictionaryScorer(data, n_test_samples=1000,
+                                   n_test_voxels=1000, random_state=0)
+    scorer(masker, dict_fact, 0, 0)
+    assert_array_almost_equal(scorer.score[0], full_score, decimal=3)
+    assert scorer.score_error[0] == 0
+
+    scorer = rfMRIDictionaryScorer(data, n_test_samples=60,
+                                   n_test_voxels=200, random_state=0)
+    scorer(masker, dict_fact, 0, 0)
+    assert scorer.data.shape == (60, 200)
+    assert 0 < scorer.score_error[0]
+    assert abs(scorer.score[0] - full_score) < 4 * scorer.score_error[0]
+
+    # info is filled without artifact_dir
+    info = {}
+    scorer = rfMRIDictionaryScorer(data, info=info, n_test_samples=60,
+                                   random_state=0)
+    scorer(masker, dict_fact, 0, 0)
+    assert info['score'] == scorer.score
+    estimator = fMRIDictFact(n_components=4, random_state=0, mask=mask_img,
+                             dict_init=init, smoothing_fwhm=None,
+                             n_epochs=1).fit(data)
+    final_score = scorer.final_score(estimator)
+    assert info['final_score'] == final_score
+
+
+def test_scorer_artifacts():
+    data, mask_img, components, init = _make_test_data(n_subjects=2)
+    tmpdir = mkdtemp()
+    try:
+        for async_artifacts in [False, True]:
+            scorer = rfMRIDictionaryScorer(data[:1], info={},
+                                           artifact_dir=tmpdir,
+                                           async_artifacts=async_artifacts)
+            dict_fact = fMRIDictFact(n_components=4, random_state=0,
+                                     mask=mask_img, dict_init=init,
+                                     smoothing_fwhm=None, verbose=3,
+                                     callback=scorer).fit(data[1:])
+            # Artifacts are flushed and the writer stopped at the end of fit
+            assert scorer._writer is None
+            filenames = os.listdir(tmpdir)
+            assert 'info.pkl' in filenames
+            assert any(filename.startswith('components_')
+                       for filename in filenames)
+            assert len(scorer.score) > 0
+            shutil.rmtree(tmpdir)
+            os.mkdir(tmpdir)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_dict_fact_temporal_pca():
+    data, mask_img, components, init = _make_test_data(n_subjects=4)
+    raw_data = MultiNiftiMasker(mask_img).fit().transform(data)
+    masker = MultiRawMasker(mask_img=mask_img).fit()
+    tmpdir = mkdtemp()
+    cache_dir = mkdtemp()
+    try:
+        filenames = []
+        for i, this_data in enumerate(raw_data):
+            filename = os.path.join(tmpdir, 'record_%i.npy' % i)
+            np.save(filename, this_data)
+            filenames.append(filename)
+        maps = _compute_components(masker, filenames, dict_init=init,
+                                   n_components=4, alpha=1, n_epochs=3,
+                                   n_temporal_components=8,
+                                   random_state=0)
+        # Without record_cache_dir, compressions are not kept
+        assert len(os.listdir(tmpdir)) == 4
+        _compute_components(masker, filenames, dict_init=init,
+                            n_components=4, n_temporal_components=8,
+                            record_cache_dir=cache_dir, random_state=0)
+        pca_filenames = sorted(os.listdir(cache_dir))
+        assert len(pca_filenames) == 4
+        pca_filename = os.path.join(cache_dir, pca_filenames[0])
+        assert np.load(pca_filename).shape == (8, 400)
+        # Compressions are reused for the same records, whatever the
+        # random_state of the fit
+        mtime = os.path.getmtime(pca_filename)
+        _compute_components(masker, filenames, dict_init=init,
+                            n_components=4, n_temporal_components=8,
+                            record_cache_dir=cache_dir, random_state=None)
+        assert os.path.getmtime(pca_filename) == mtime
+        assert sorted(os.listdir(cache_dir)) == pca_filenames
+        # and recomputed for other confounds
+        confounds = [np.ones((40, 1))] * 4
+        _compute_components(masker, filenames, confounds=confounds,
+                            dict_init=init, n_components=4,
+                            n_temporal_components=8,
+                            record_cache_dir=cache_dir, random_state=0)
+        assert len(os.listdir(cache_dir)) == 8
+    finally:
+        shutil.rmtree(tmpdir)
+        shutil.rmtree(cache_dir)
+    # Compressed records recover the maps
+    for this_maps in [maps,
+                      _compute_components(masker, raw_data, dict_init=init,
+                                          n_components=4, alpha=1,
+                                          n_epochs=3,
+                                          n_temporal_components=8,
+                                          random_state=0)]:
+        components_ = masker.transform(components)
+        components_ /= np.sqrt(np.sum(components_ ** 2, axis=1,
+                                      keepdims=True))
+        this_maps = this_maps / np.sqrt(np.sum(this_maps ** 2, axis=1,
+                                               keepdims=True))
+        G = np.abs(components_.dot(this_maps.T))
+        assert np.sum(G > 0.95) >= 4
+
+
+def test_dict_fact_clustering():
+    data, mask_img, components, init = _make_test_data(n_subjects=4)
+    masker = MultiNiftiMasker(mask_img).fit()
+    voxel_maps = _compute_components(masker, data, dict_init=init,
+                                     n_components=4, alpha=1, n_epochs=3,
+                                     random_state=0)
+    voxel_maps /= np.sqrt(np.sum(voxel_maps ** 2, axis=1, keepdims=True))
+    # The penalty mapped to parcels yields the maps learned on voxels with
+    # the same alpha, and refining at full resolution recovers them
+    for n_clusters in [25, 100]:
+        for n_refine_epochs, threshold in [(0, 0.99), (1, 0.999)]:
+            maps = _compute_components(masker, data, dict_init=init,
+                                       n_components=4, alpha=1, n_epochs=3,
+                                       n_clusters=n_clusters,
+                                       n_refine_epochs=n_refine_epochs,
+                                       random_state=0)
+            assert maps.shape == (4, 400)
+            maps /= np.sqrt(np.sum(maps ** 2, axis=1, keepdims=True))
+            G = np.abs(voxel_maps.dot(maps.T))
+            assert np.sum(G > threshold) >= 4
+
+
+def test_dict_fact_multiresolution():
+    data, mask_img, components, init = _make_test_data(n_subjects=4)
+    masker = MultiNiftiMasker(mask_img).fit()
+    components_ = masker.transform(components)
+    components_ /= np.sqrt(np.sum(components_ ** 2, axis=1, keepdims=True))
+    # 1mm voxels: the 0.5mm level is skipped
+    maps = _compute_components(masker, data, dict_init=init,
+                               n_components=4, alpha=1,
+                               n_epochs=1, resolutions=[4, 2, 0.5],
+                               n_coarse_epochs=2, random_state=0)
+    assert maps.shape == (4, 400)
+    maps /= np.sqrt(np.sum(maps ** 2, axis=1, keepdims=True))
+    G = np.abs(components_.dot(maps.T))
+    assert np.sum(G > 0.95) >= 4
+
+
+def test_dict_fact_multiresolution_stopping(capsys):
+    data, mask_img, components, init = _make_test_data(n_subjects=4)
+    masker = MultiNiftiMasker(mask_img).fit()
+    # Stopping criteria apply to every level
+    _compute_components(masker, data, n_components=4, alpha=1,
+                        n_epochs=3, resolutions=[4, 2],
+                        n_coarse_epochs=3, max_time=0, verbose=1,
+                        random_state=0)
+    out, _ = capsys.readouterr()
+    assert out.count('Converged after 2 epochs') == 3
+
+
 def test_verbose():
     pass
 
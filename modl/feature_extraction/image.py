@@ -1,14 +1,19 @@
+from concurrent.futures import ThreadPoolExecutor
+from math import ceil
+
 import numpy as np
-from ..input_data.image import clean_mask, fill
+from ..input_data.image import clean_windows, gather_patches
 from sklearn.base import BaseEstimator
 from sklearn.feature_extraction.image import extract_patches
-from sklearn.utils import check_random_state
+from sklearn.utils import check_random_state, gen_batches
+from sklearn.utils.random import sample_without_replacement
 
 
 class LazyCleanPatchExtractor(BaseEstimator):
     def __init__(self, patch_size=None,
                  random_state=None,
-                 max_patches=None):
+                 max_patches=None,
+                 n_threads=1):
         """
         Patch extractor that handles images with partial data,
         represented by -1. Extracted patches are fully known. Patches are
@@ -23,10 +28,15 @@ class LazyCleanPatchExtractor(BaseEstimator):
             Randomness control
         max_patches: int or None,
             Maximum number of patches to extract
+        n_threads: int,
+            Number of threads used to find clean patches, and by
+            partial_transform_flat. The threads of partial_transform_flat
+            are started on its first call, and stopped by close
         """
 
         self.patch_size = patch_size
         self.max_patches = max_patches
+        self.n_threads = n_threads
 
         self.random_state = random_state
 
@@ -39,18 +49,42 @@ class LazyCleanPatchExtractor(BaseEstimator):
             patch_size = self.patch_size
         patch_shape = (patch_size[0], patch_size[1], n_channels)
         self.patches_ = extract_patches(X, patch_shape=patch_shape)
+        if X.dtype not in [np.float32, np.float64]:
+            X = X.astype(np.float64)
+        self.image_ = np.ascontiguousarray(X)
 
+        # Patches are stored as flat positions in the grid of patches,
+        # drawn without building the array of all positions
+        grid_shape = self.patches_.shape[:3]
         clean = np.all(X != -1)
         if not clean:
-            self.indices_3d = clean_mask(self.patches_, X)
+            take = clean_windows(X, patch_shape, n_threads=self.n_threads)
+            self.positions_ = _sample_positions(take, self.max_patches,
+                                                self.random_state)
         else:
-            self.indices_3d = fill(*self.patches_.shape[:3])
-        n_samples = self.indices_3d.shape[0]
-        selection = self.random_state.permutation(n_samples)[:self.max_patches]
-        self.indices_3d = self.indices_3d[selection]
-
+            n_positions = int(np.prod(grid_shape))
+            if (self.max_patches is None
+                    or self.max_patches >= n_positions):
+                self.positions_ = np.arange(n_positions)
+            else:
+                self.positions_ = _sample_without_replacement(
+                    n_positions, self.max_patches, self.random_state)
+        self.random_state.shuffle(self.positions_)
         return self
 
+    def _indices(self, batch):
+        """Grid coordinates of the patches at batch, shape (n, 3)"""
+        positions = self.positions_[batch]
+        indices = np.empty((len(positions), 3), dtype=np.int_)
+        for i, coord in enumerate(np.unravel_index(positions,
+                                                   self.patches_.shape[:3])):
+            indices[:, i] = coord
+        return indices
+
+    @property
+    def indices_3d(self):
+        return self._indices(slice(None))
+
     def partial_transform(self, X=None, batch=None):
         if X is not None:
             self.fit(X)
@@ -58,10 +92,57 @@ class LazyCleanPatchExtractor(BaseEstimator):
             return self.transform()
         elif isinstance(batch, int):
             batch = slice(0, batch)
-        these_indices = tuple(self.indices_3d[batch].T)
+        these_indices = tuple(self._indices(batch).T)
         patches = self.patches_[these_indices]
         return patches
 
+    def partial_transform_flat(self, batch=None, out=None, with_mean=True,
+                               with_std=True):
+        """
+        Flattened patches, centered and scaled channel-wise as by
+        scale_patches. Patches are gathered from the image directly into
+        out, and scaled in the same pass, in n_threads threads.
+
+        Parameters
+        ----------
+        batch: slice, int or None
+            Patches to extract, all if None
+
+        out: ndarray or None
+            C-contiguous array of shape (n_batch_patches, n_features) and
+            of the image dtype, reused across batches to avoid allocations
+
+        with_mean, with_std: bool
+            See scale_patches
+
+        Returns
+        -------
+        patches: ndarray, shape (n_batch_patches, n_features)
+        """
+        if batch is None:
+            batch = slice(0, self.n_patches_)
+        elif isinstance(batch, int):
+            batch = slice(0, batch)
+        indices = self._indices(batch)
+        n_patches = indices.shape[0]
+        patch_h, patch_w, n_channels = self.patch_shape_
+        if out is None:
+            out = np.empty((n_patches, patch_h * patch_w * n_channels),
+                           dtype=self.image_.dtype)
+
+        par_func = lambda this_batch: gather_patches(
+            self.image_, indices[this_batch], patch_h, patch_w,
+            out[this_batch], with_mean, with_std)
+        if self.n_threads > 1 and n_patches > 0:
+            size_job = ceil(n_patches / self.n_threads)
+            batches = list(gen_batches(n_patches, size_job))
+            if getattr(self, '_pool', None) is None:
+                self._pool = ThreadPoolExecutor(self.n_threads)
+            _ = list(self._pool.map(par_func, batches))
+        else:
+            par_func(slice(0, n_patches))
+        return out
+
     def transform(self, X=None):
         if X is not None:
             self.fit(X)
@@ -70,14 +151,62 @@ class LazyCleanPatchExtractor(BaseEstimator):
 
     def shuffle(self, permutation=None):
         if permutation is None:
-            n_samples = self.indices_3d.shape[0]
-            permutation = self.random_state.permutation(n_samples)
-        self.indices_3d = self.indices_3d[permutation]
+            self.random_state.shuffle(self.positions_)
+        else:
+            self.positions_ = self.positions_[permutation]
+
+    def close(self):
+        """Stop the threads of partial_transform_flat, which starts them
+        again if called later"""
+        if getattr(self, '_pool', None) is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state.pop('_pool', None)
+        return state
 
     @property
     def n_patches_(self):
-        return self.indices_3d.shape[0]
+        return self.positions_.shape[0]
 
     @property
     def patch_shape_(self):
         return self.patches_.shape[-3:]
+
+
+def _sample_without_replacement(n_population, n_samples, random_state):
+    """Draw n_samples integers in [0, n_population[, in memory
+    O(n_samples)"""
+    if n_samples * 10 < n_population:
+        method = 'tracking_selection'
+    else:
+        method = 'reservoir_sampling'
+    return sample_without_replacement(n_population, n_samples,
+                                      method=method,
+                                      random_state=random_state)
+
+
+def _sample_positions(take, max_patches, random_state):
+    """Draw max_patches flat positions among the non-zero entries of take,
+    without listing all of them"""
+    n_rows = take.shape[0]
+    take = take.reshape(n_rows, -1)
+    row_counts = np.count_nonzero(take, axis=1)
+    row_ends = np.cumsum(row_counts)
+    n_valid = int(row_ends[-1]) if n_rows else 0
+    if max_patches is None or max_patches >= n_valid:
+        return np.flatnonzero(take)
+    # Ranks among valid positions, mapped to positions row by row
+    ranks = np.sort(_sample_without_replacement(n_valid, max_patches,
+                                                random_state))
+    rows = np.searchsorted(row_ends, ranks, side='right')
+    positions = np.empty(max_patches, dtype=np.int_)
+    starts = np.searchsorted(rows, np.arange(n_rows + 1))
+    for row in np.unique(rows):
+        start, stop = starts[row], starts[row + 1]
+        offsets = ranks[start:stop] - (row_ends[row] - row_counts[row])
+        positions[start:stop] = (np.flatnonzero(take[row])[offsets]
+                                 + row * take.shape[1])
+    return positions
@@ -0,0 +1,64 @@
+import pickle
+
+import numpy as np
+from numpy.testing import assert_array_almost_equal, assert_array_equal
+from sklearn.feature_extraction.image import extract_patches
+
+from modl.feature_extraction.image import LazyCleanPatchExtractor
+from modl.input_data.image import scale_patches
+
+
+def test_partial_transform_flat():
+    rs = np.random.RandomState(0)
+    image = rs.rand(30, 25, 4)
+    image[:3] = -1
+    for n_threads in [1, 3]:
+        extractor = LazyCleanPatchExtractor(patch_size=(5, 4),
+                                            max_patches=100, random_state=0,
+                                            n_threads=n_threads).fit(image)
+        patches = extractor.partial_transform(batch=slice(10, 60))
+        assert np.all(patches != -1)
+        out = np.empty((50, 5 * 4 * 4))
+        flat = extractor.partial_transform_flat(batch=slice(10, 60),
+                                                out=out)
+        assert flat is out
+        assert_array_almost_equal(flat,
+                                  scale_patches(patches).reshape(50, -1))
+        # Threads are stopped by close, and restarted if needed
+        extractor.close()
+        assert getattr(extractor, '_pool', None) is None
+        extractor = pickle.loads(pickle.dumps(extractor))
+        assert getattr(extractor, '_pool', None) is None
+        assert_array_equal(extractor.partial_transform_flat(
+            batch=slice(10, 60)), flat)
+        extractor.close()
+
+
+def test_sample_positions():
+    rs = np.random.RandomState(0)
+    image = rs.rand(40, 30, 3)
+    image[rs.rand(40, 30) > 0.99] = -1
+    image[:5] = -1
+    patches = extract_patches(image, (4, 5, 3))
+    clean = set(map(tuple, np.c_[np.where(np.all(patches != -1,
+                                                 axis=(3, 4, 5)))]))
+    for max_patches in [50, 400, None]:
+        extractor = LazyCleanPatchExtractor(patch_size=(4, 5),
+                                            max_patches=max_patches,
+                                            random_state=0).fit(image)
+        indices = extractor.indices_3d
+        assert len(set(map(tuple, indices))) == len(indices)
+        assert set(map(tuple, indices)) <= clean
+        if max_patches is None:
+            assert len(indices) == len(clean)
+        else:
+            assert len(indices) == max_patches
+        positions = extractor.positions_.copy()
+        extractor.shuffle()
+        assert_array_equal(np.sort(extractor.positions_), np.sort(positions))
+    # Images without missing values
+    extractor = LazyCleanPatchExtractor(patch_size=(4, 5), max_patches=30,
+                                        random_state=0).fit(rs.rand(40, 30,
+                                                                    3))
+    assert len(np.unique(extractor.positions_)) == 30
+    assert np.all(extractor.positions_ < 37 * 26)
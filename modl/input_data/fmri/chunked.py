@@ -0,0 +1,225 @@
+"""
+Chunked, compressed on-disk storage for masked time series.
+
+A record holds a (n_samples, n_voxels) array, cut in chunks of consecutive
+time points that are compressed independently with zlib, so that blocks of
+time points can be read without decompressing the whole record. Data may be
+stored in reduced precision: float16, or int16 with a per-voxel scale.
+
+File layout: an 8-byte magic string, the length of the JSON header as a
+little-endian uint64, the JSON header (shape, dtypes, chunk offsets and
+sizes, scaling), then the compressed payload.
+"""
+import json
+import struct
+import zlib
+
+import numpy as np
+
+MAGIC = b'MODLCHK1'
+CHUNKED_EXT = '.chunks'
+PRECISIONS = ['float32', 'float64', 'float16', 'int16']
+
+
+def _encode(array, shuffle, compression_level):
+    """Compress an array, after byte-shuffling it if required"""
+    if shuffle and array.dtype.itemsize > 1:
+        array = np.ascontiguousarray(array)
+        buffer = array.view(np.uint8).reshape(-1, array.dtype.itemsize)
+        buffer = np.ascontiguousarray(buffer.T).tobytes()
+    else:
+        buffer = np.ascontiguousarray(array).tobytes()
+    return zlib.compress(buffer, compression_level)
+
+
+def _decode(buffer, dtype, shape, shuffle):
+    """Inverse of _encode"""
+    dtype = np.dtype(dtype)
+    buffer = zlib.decompress(buffer)
+    array = np.frombuffer(buffer, dtype=np.uint8)
+    if shuffle and dtype.itemsize > 1:
+        array = np.ascontiguousarray(array.reshape(dtype.itemsize, -1).T)
+    return array.view(dtype).reshape(shape)
+
+
+def save_chunked(filename, data, chunk_size=100, precision='float32',
+                 compression_level=1, shuffle=True):
+    """
+    Save a masked time series in the chunked format
+
+    Parameters
+    ----------
+    filename: str
+        Destination file, conventionally ending with CHUNKED_EXT
+
+    data: ndarray, shape (n_samples, n_voxels)
+        Masked time series
+
+    chunk_size: int
+        Number of time points per chunk, i.e. granularity of random access
+
+    precision: str in ['float32', 'float64', 'float16', 'int16']
+        Storage precision. 'int16' stores round(data / scale) with a
+        per-voxel scale max(|data|) / 32767
+
+    compression_level: int in [0, 9]
+        zlib compression level. 1 is fast and already gains most of the
+        size reduction
+
+    shuffle: bool
+        Byte-shuffle each chunk before compression, which groups exponent
+        and mantissa bytes and improves compression of floating values
+    """
+    if precision not in PRECISIONS:
+        raise ValueError('precision should be in %s, got %s'
+                         % (PRECISIONS, precision))
+    data = np.asarray(data)
+    if data.ndim != 2:
+        raise ValueError('Expected 2D data, got shape %s' % str(data.shape))
+    n_samples, n_voxels = data.shape
+    header = {'shape': [n_samples, n_voxels],
+              'dtype': data.dtype.str,
+              'precision': precision,
+              'chunk_size': chunk_size,
+              'shuffle': shuffle,
+              'scale': None,
+              'chunks': []}
+    blocks = []
+    offset = 0
+    if precision == 'int16':
+        scale = np.max(np.abs(data), axis=0).astype(np.float32) / 32767
+        scale[scale == 0] = 1
+        block = _encode(scale, shuffle, compression_level)
+        header['scale'] = [offset, len(block)]
+        blocks.append(block)
+        offset += len(block)
+    for start in range(0, n_samples, chunk_size):
+        chunk = data[start:start + chunk_size]
+        if precision == 'int16':
+            chunk = np.round(chunk / scale).astype(np.int16)
+        else:
+            chunk = chunk.astype(precision, copy=False)
+        block = _encode(chunk, shuffle, compression_level)
+        header['chunks'].append([offset, len(block)])
+        blocks.append(block)
+        offset += len(block)
+    header = json.dumps(header).encode('utf-8')
+    with open(filename, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        for block in blocks:
+            f.write(block)
+
+
+class ChunkedRecord(object):
+    """
+    Read-only access to a record saved with save_chunked. Only the chunks
+    holding the requested time points are read and decompressed. The last
+    decompressed chunk is kept, so that consecutive reads within a chunk
+    decompress it once.
+
+    Parameters
+    ----------
+    filename: str
+        Record file
+
+    Attributes
+    ----------
+    shape: tuple (n_samples, n_voxels)
+
+    ndim: int
+        Always 2
+
+    dtype: np.dtype
+        dtype of the arrays returned by read: the original dtype, or float32
+        for records stored in reduced precision
+    """
+    ndim = 2
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            magic = f.read(len(MAGIC))
+            if magic != MAGIC:
+                raise ValueError('%s is not a chunked record' % filename)
+            header_size, = struct.unpack('<Q', f.read(8))
+            header = json.loads(f.read(header_size).decode('utf-8'))
+        self.header_ = header
+        self.payload_offset_ = len(MAGIC) + 8 + header_size
+        self.shape = tuple(header['shape'])
+        self.chunk_size = header['chunk_size']
+        self.precision = header['precision']
+        if self.precision in ['float16', 'int16']:
+            self.dtype = np.dtype(np.float32)
+        else:
+            self.dtype = np.dtype(header['dtype'])
+        self._scale = None
+        self._chunk_id = None
+        self._chunk = None
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _read_block(self, f, offset, size):
+        f.seek(self.payload_offset_ + offset)
+        return f.read(size)
+
+    def _read_chunk(self, f, i):
+        offset, size = self.header_['chunks'][i]
+        start = i * self.chunk_size
+        stop = min(start + self.chunk_size, self.shape[0])
+        chunk = _decode(self._read_block(f, offset, size), self.precision,
+                        (stop - start, self.shape[1]),
+                        self.header_['shuffle'])
+        if self.precision == 'int16':
+            if self._scale is None:
+                offset, size = self.header_['scale']
+                self._scale = _decode(self._read_block(f, offset, size),
+                                      np.float32, (self.shape[1],),
+                                      self.header_['shuffle'])
+            return chunk * self._scale
+        return chunk.astype(self.dtype, copy=False)
+
+    def read(self, rows=None, out=None):
+        """
+        Read time points
+
+        Parameters
+        ----------
+        rows: slice, ndarray of int or None
+            Time points to read. None reads the whole record
+
+        out: ndarray or None
+            Array of shape (n_rows, n_voxels) and dtype self.dtype to write
+            into
+
+        Returns
+        -------
+        data: ndarray, shape (n_rows, n_voxels)
+        """
+        n_samples = self.shape[0]
+        if rows is None:
+            rows = slice(0, n_samples)
+        if isinstance(rows, slice):
+            rows = np.arange(n_samples)[rows]
+        rows = np.asarray(rows)
+        if out is None:
+            out = np.empty((len(rows), self.shape[1]), dtype=self.dtype)
+        chunk_ids = rows // self.chunk_size
+        with open(self.filename, 'rb') as f:
+            for i in np.unique(chunk_ids):
+                mask = chunk_ids == i
+                if i != self._chunk_id:
+                    self._chunk = self._read_chunk(f, i)
+                    self._chunk_id = i
+                out[mask] = self._chunk[rows[mask] - i * self.chunk_size]
+        return out
+
+    def __getitem__(self, rows):
+        return self.read(rows)
+
+
+def load_chunked(filename):
+    """Load a whole record saved with save_chunked"""
+    return ChunkedRecord(filename).read()
@@ -1,5 +1,5 @@
 import copy
-import os
+import warnings
 from distutils.version import LooseVersion
 
 import nibabel
@@ -15,10 +15,6 @@ from nilearn._utils.niimg import short_repr, _get_target_dtype
 from nilearn.input_data import MultiNiftiMasker
 from nilearn.input_data.nifti_masker import filter_and_mask, NiftiMasker
 
-from sklearn.externals import joblib as joblib
-from sklearn.externals.joblib.func_inspect import filter_args
-from sklearn.externals.joblib.hashing import NumpyHasher
-
 
 # We rely on this patch to use nibabel image affine depending
 # upon the older or newer versions of nibabel.
@@ -58,57 +54,6 @@ class Nifti1Image(NibabelNifti1Image):
             self.set_filename(state['filename'])
 
 
-class NibabelHasher(NumpyHasher):
-    def __init__(self, hash_name='md5', coerce_mmap=False):
-        """
-            Parameters
-            ----------
-            hash_name: string
-                The hash algorithm to be used
-            coerce_mmap: boolean
-                Make no difference between np.memmap and np.ndarray
-                objects.
-        """
-        NumpyHasher.__init__(self, hash_name=hash_name,
-                             coerce_mmap=coerce_mmap)
-        import nibabel as nibabel
-        self.nibabel = nibabel
-
-    def save(self, obj):
-        if isinstance(obj, Nifti1Image):
-            filename = obj.get_filename()
-            if filename is not None:
-                stat = os.stat(filename)
-                last_modified = stat.st_mtime
-                klass = obj.__class__
-                obj = (klass, ('HASHED', filename, last_modified))
-        NumpyHasher.save(self, obj)
-
-
-def our_hash(obj, hash_name='md5', coerce_mmap=False):
-    """ Quick calculation of a hash to identify uniquely Python objects
-        containing numpy arrays.
-
-
-        Parameters
-        -----------
-        hash_name: 'md5' or 'sha1'
-            Hashing algorithm used. sha1 is supposedly safer, but md5 is
-            _faster.
-        coerce_mmap: boolean
-            Make no difference between np.memmap and np.ndarray
-    """
-    hasher = NibabelHasher(hash_name=hash_name, coerce_mmap=coerce_mmap)
-    hash = hasher.hash(obj)
-    return hash
-
-
-def our_get_argument_hash(self, *args, **kwargs):
-    return our_hash(filter_args(self.func, self.ignore,
-                                args, kwargs),
-                    coerce_mmap=True)
-
-
 def our_load_niimg(niimg, dtype=None):
     """Load a niimg, check if it is a nibabel SpatialImage and cast if needed
 
@@ -221,8 +166,18 @@ def our_transform_single_imgs(self, imgs, confounds=None, copy=True):
 
 
 def monkey_patch_nifti_image():
+    """Make images loaded by nibabel keep their filename when pickled, and
+    avoid copies when masking them.
+
+    Deprecated: this patches nibabel and nilearn globally. Cache with a
+    modl.utils.hashing.FingerprintMemory instead, which fingerprints the
+    files of images, memmaps and records without patching.
+    """
+    warnings.warn('monkey_patch_nifti_image is deprecated and will be '
+                  'removed in a future release: use '
+                  'modl.utils.hashing.FingerprintMemory to hash images by '
+                  'their files', DeprecationWarning, stacklevel=2)
     nibabel.load = load
-    joblib.memory.MemorizedFunc._get_argument_hash = our_get_argument_hash
     nilearn._utils.niimg.load_niimg = our_load_niimg
     NiftiMasker.transform_single_imgs = our_transform_single_imgs
     MultiNiftiMasker.transform = our_multi_nifti_masker_transform
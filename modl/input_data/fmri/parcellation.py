@@ -0,0 +1,146 @@
+"""
+Spatially constrained voxel clustering, used to learn dictionaries in a
+compressed space of parcels.
+"""
+import numpy as np
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
+
+
+def _grid_edges(mask):
+    """Edges between neighboring voxels of a 3D boolean mask, along each
+    axis. Voxels are numbered in C order, as in masked arrays"""
+    index = np.full(mask.shape, -1, dtype='int')
+    index[mask] = np.arange(np.sum(mask))
+    edges = []
+    for axis in range(mask.ndim):
+        first = [slice(None)] * mask.ndim
+        second = [slice(None)] * mask.ndim
+        first[axis] = slice(None, -1)
+        second[axis] = slice(1, None)
+        i, j = index[tuple(first)], index[tuple(second)]
+        both = (i >= 0) & (j >= 0)
+        edges.append(np.vstack([i[both], j[both]]))
+    return np.hstack(edges)
+
+
+def _nn_edges(features, edges):
+    """Return, for each node, the edge to its nearest neighbor in the graph,
+    as unique (i, j, distance) triplets sorted by distance"""
+    i, j = edges
+    distances = np.sum((features[i] - features[j]) ** 2, axis=1)
+    nodes = np.concatenate([i, j])
+    neighbors = np.concatenate([j, i])
+    distances = np.concatenate([distances, distances])
+    order = np.lexsort((distances, nodes))
+    nodes, neighbors, distances = (nodes[order], neighbors[order],
+                                   distances[order])
+    first = np.ones(len(nodes), dtype=bool)
+    first[1:] = nodes[1:] != nodes[:-1]
+    nodes, neighbors, distances = (nodes[first], neighbors[first],
+                                   distances[first])
+    # Mutual nearest neighbors yield the same edge twice
+    low, high = np.minimum(nodes, neighbors), np.maximum(nodes, neighbors)
+    _, unique = np.unique(low * (np.max(high) + 1) + high, return_index=True)
+    low, high, distances = low[unique], high[unique], distances[unique]
+    order = np.argsort(distances, kind='mergesort')
+    return low[order], high[order]
+
+
+def rena_clustering(X, mask, n_clusters, max_iter=50):
+    """
+    Recursive nearest-neighbor agglomeration of voxels (ReNA).
+
+    At each iteration, every cluster is merged with its nearest neighbor
+    (in feature space) among spatially adjacent clusters, which divides the
+    number of clusters by about two while keeping them connected and of
+    balanced sizes. The last iteration only merges the closest pairs, so
+    that exactly n_clusters clusters remain when the mask is connected.
+
+    Parameters
+    ----------
+    X: ndarray, shape (n_samples, n_voxels)
+        Masked data whose time series are the voxel features
+
+    mask: ndarray of bool, shape (n_x, n_y, n_z)
+        Mask from which X is extracted, with n_voxels True entries
+
+    n_clusters: int
+        Number of clusters to form
+
+    max_iter: int
+        Maximum number of agglomeration steps
+
+    Returns
+    -------
+    labels: ndarray of int, shape (n_voxels,)
+        Cluster of each voxel, in [0, n_clusters[
+
+    References
+    ----------
+    A. Hoyos-Idrobo et al., Recursive nearest agglomeration (ReNA): fast
+    clustering for approximation of structured signals, IEEE TPAMI, 2018
+    """
+    mask = np.asarray(mask, dtype=bool)
+    features = np.asarray(X, dtype=np.float64).T
+    n_voxels = features.shape[0]
+    if n_voxels != np.sum(mask):
+        raise ValueError('X has %i voxels, mask %i' % (n_voxels,
+                                                       np.sum(mask)))
+    edges = _grid_edges(mask)
+    sizes = np.ones(n_voxels)
+    labels = np.arange(n_voxels)
+    n_nodes = n_voxels
+    for _ in range(max_iter):
+        if n_nodes <= n_clusters or edges.shape[1] == 0:
+            break
+        low, high = _nn_edges(features, edges)
+        # The nearest-neighbor graph is a forest: each kept edge removes a
+        # node
+        low, high = low[:n_nodes - n_clusters], high[:n_nodes - n_clusters]
+        graph = sparse.coo_matrix((np.ones(len(low)), (low, high)),
+                                  shape=(n_nodes, n_nodes))
+        n_nodes, node_labels = connected_components(graph, directed=False)
+        labels = node_labels[labels]
+        # Size-weighted averages of features
+        new_sizes = np.bincount(node_labels, weights=sizes)
+        merge = sparse.coo_matrix((sizes, (node_labels,
+                                           np.arange(len(sizes)))))
+        features = merge.dot(features) / new_sizes[:, np.newaxis]
+        sizes = new_sizes
+        edges = node_labels[edges]
+        edges = edges[:, edges[0] != edges[1]]
+        if edges.shape[1]:
+            edges = np.unique(np.sort(edges, axis=0), axis=1)
+    return labels
+
+
+def grid_clustering(mask, affine, resolution):
+    """
+    Group voxels in the cubes of a coarser grid, of side resolution (in
+    mm), aligned on the first voxel of the mask array.
+
+    Parameters
+    ----------
+    mask: ndarray of bool, shape (n_x, n_y, n_z)
+        Mask of the voxels to group
+
+    affine: ndarray, shape (4, 4)
+        Affine of the mask image, from which voxel sizes are read
+
+    resolution: float
+        Side of the coarse voxels, in mm
+
+    Returns
+    -------
+    labels: ndarray of int, shape (n_voxels,)
+        Coarse voxel of each masked voxel, numbered from 0 in C order
+    """
+    mask = np.asarray(mask, dtype=bool)
+    voxel_size = np.sqrt(np.sum(np.asarray(affine)[:3, :3] ** 2, axis=0))
+    coords = np.array(np.where(mask)).T
+    blocks = np.floor(coords * voxel_size / resolution).astype('int')
+    _, labels = np.unique(np.ravel_multi_index(blocks.T,
+                                               np.max(blocks, axis=0) + 1),
+                          return_inverse=True)
+    return labels
@@ -1,7 +1,11 @@
 import json
 import os
-import sys
+import time
 import traceback
+from collections import deque
+from concurrent.futures import (FIRST_COMPLETED, ProcessPoolExecutor,
+                                ThreadPoolExecutor, wait)
+from concurrent.futures.process import BrokenProcessPool
 from itertools import repeat
 from os.path import join
 
@@ -9,42 +13,207 @@ import numpy as np
 import pandas as pd
 from nilearn._utils import check_niimg
 from nilearn.input_data import MultiNiftiMasker
-from sklearn.externals.joblib import Memory, Parallel, delayed
+from sklearn.externals.joblib import Memory
 
+from modl.input_data.fmri.chunked import (CHUNKED_EXT, ChunkedRecord,
+                                          save_chunked)
+from modl.input_data.fmri.scan import scan_imgs
 from modl.input_data.fmri.unmask import MultiRawMasker
 
 
-def _unmask_single_img(masker, imgs, confounds, root,
-                       raw_dir, mock=False, overwrite=False):
-    imgs = check_niimg(imgs)
-    if imgs.get_filename() is None:
-        raise ValueError('Provided Nifti1Image should be linked to a file.')
-    filename = imgs.get_filename()
-    raw_filename = filename.replace('.nii.gz', '.npy')
-    raw_filename = raw_filename.replace(root, raw_dir)
-    dirname = os.path.dirname(raw_filename)
-    print('Saving %s to %s' % (filename, raw_filename))
-    if not mock:
-        if overwrite or not os.path.exists(raw_filename):
-            try:
-                data = masker.transform(imgs, confounds=confounds)
-                if not os.path.exists(dirname):
-                    os.makedirs(dirname)
-                np.save(raw_filename, data)
-            except EOFError:
-                exc_type, exc_value, exc_traceback = sys.exc_info()
-                msg = '\n'.join(traceback.format_exception(
-                    exc_type, exc_value, exc_traceback))
-                raw_filename += '-error'
-                if not os.path.exists(dirname):
-                    os.makedirs(dirname)
-                with open(raw_filename, 'w+') as f:
-                    f.write(msg)
+def _raw_filename(filename, root, raw_dir, raw_format='npy'):
+    if raw_format == 'chunked':
+        raw_filename = filename.replace('.nii.gz', CHUNKED_EXT)
+    else:
+        raw_filename = filename.replace('.nii.gz', '.npy')
+    return raw_filename.replace(root, raw_dir)
+
+
+def _check_raw_file(raw_filename):
+    """Check that a record written by a previous run is complete, from
+    the size implied by its header"""
+    try:
+        if raw_filename.endswith(CHUNKED_EXT):
+            record = ChunkedRecord(raw_filename)
+            offset, size = record.header_['chunks'][-1]
+            expected_size = record.payload_offset_ + offset + size
         else:
-            print('File already exists: skipping.')
+            with open(raw_filename, 'rb') as f:
+                version = np.lib.format.read_magic(f)
+                if version == (1, 0):
+                    shape, _, dtype = np.lib.format.read_array_header_1_0(f)
+                else:
+                    shape, _, dtype = np.lib.format.read_array_header_2_0(f)
+                expected_size = f.tell() + int(np.prod(shape)) * dtype.itemsize
+    except (ValueError, IOError, IndexError):
+        return False
+    return os.path.getsize(raw_filename) >= expected_size
+
+
+def _unmask_single_img(masker, imgs, confounds, raw_filename,
+                       raw_format='npy', chunked_params=None):
+    """Mask imgs and write the result atomically to raw_filename"""
+    data = masker.transform(imgs, confounds=confounds)
+    dirname = os.path.dirname(raw_filename)
+    if not os.path.exists(dirname):
+        os.makedirs(dirname)
+    tmp_filename = raw_filename + '.tmp'
+    if raw_format == 'chunked':
+        save_chunked(tmp_filename, data, **chunked_params)
+    else:
+        with open(tmp_filename, 'wb') as f:
+            np.save(f, data)
+    os.replace(tmp_filename, raw_filename)
+    return raw_filename
+
+
+def _read_journal(journal):
+    entries = {}
+    if os.path.exists(journal):
+        with open(journal, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Line truncated by a crash
+                    continue
+                entries[entry['filename']] = entry['status']
+    return entries
+
+
+def _append_journal(journal, raw_filename, status, duration):
+    with open(journal, 'a') as f:
+        f.write(json.dumps({'filename': raw_filename, 'status': status,
+                            'duration': duration}) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _write_error(raw_filename, msg):
+    raw_filename += '-error'
+    dirname = os.path.dirname(raw_filename)
+    if not os.path.exists(dirname):
+        os.makedirs(dirname)
+    with open(raw_filename, 'w+') as f:
+        f.write(msg)
     return raw_filename
 
 
+def _make_executor(n_jobs):
+    # Each worker holds one record in memory: n_jobs caps memory usage
+    if n_jobs == 1:
+        return ThreadPoolExecutor(max_workers=1)
+    return ProcessPoolExecutor(max_workers=n_jobs)
+
+
+def _unmask_imgs(masker, imgs_list, confounds_list, raw_filenames, journal,
+                 n_jobs=1, n_retries=2, raw_format='npy',
+                 chunked_params=None, overwrite=False):
+    """Unmask records in n_jobs processes, journaling each completed record
+    so that an interrupted run can be resumed.
+
+    A worker that dies (e.g. killed by the OOM killer) breaks the process
+    pool: the pool is then rebuilt and the records that were in flight are
+    resubmitted. If several records were in flight, they are rerun one at a
+    time so that only the record that kills its worker is charged a retry.
+
+    Returns the list of written files, where records that failed
+    n_retries + 1 times are replaced by a '-error' file holding the
+    traceback.
+    """
+    journaled = _read_journal(journal)
+    filenames = list(raw_filenames)
+    todo = []
+    for i, raw_filename in enumerate(raw_filenames):
+        if not overwrite and os.path.exists(raw_filename) and (
+                journaled.get(raw_filename) == 'done'
+                or _check_raw_file(raw_filename)):
+            print('File already exists: skipping %s' % raw_filename)
+        else:
+            todo.append(i)
+    if not todo:
+        return filenames
+    t0 = time.perf_counter()
+    n_done = 0
+    pending = deque((i, 0) for i in todo)
+    # Records in flight when a worker died, to be rerun one at a time
+    suspects = deque()
+    futures = {}
+    executor = _make_executor(n_jobs)
+
+    def submit(i, attempt):
+        future = executor.submit(_unmask_single_img, masker,
+                                 imgs_list[i], confounds_list[i],
+                                 raw_filenames[i],
+                                 raw_format=raw_format,
+                                 chunked_params=chunked_params)
+        futures[future] = i, attempt, time.perf_counter()
+
+    def finish(i, status, duration):
+        nonlocal n_done
+        raw_filename = raw_filenames[i]
+        _append_journal(journal, raw_filename, status, duration)
+        n_done += 1
+        elapsed = time.perf_counter() - t0
+        print('Processed %s [%i/%i, %.1f records/hour]'
+              % (raw_filename, n_done, len(todo),
+                 n_done * 3600 / elapsed))
+
+    def fail(i, attempt, msg, duration):
+        if attempt < n_retries:
+            print('Failed to unmask %s, retrying:\n%s'
+                  % (imgs_list[i], msg))
+            pending.append((i, attempt + 1))
+        else:
+            print('Failed to unmask %s:\n%s' % (imgs_list[i], msg))
+            filenames[i] = _write_error(raw_filenames[i], msg)
+            finish(i, 'error', duration)
+
+    def collect(future, broken):
+        i, attempt, start = futures.pop(future)
+        duration = time.perf_counter() - start
+        try:
+            future.result()
+        except BrokenProcessPool:
+            broken.append((i, attempt, duration))
+        except Exception:
+            fail(i, attempt, traceback.format_exc(), duration)
+        else:
+            finish(i, 'done', duration)
+
+    try:
+        while pending or suspects or futures:
+            if suspects:
+                if not futures:
+                    submit(*suspects.popleft())
+            else:
+                while pending and len(futures) < n_jobs:
+                    submit(*pending.popleft())
+            done, _ = wait(list(futures.keys()),
+                           return_when=FIRST_COMPLETED)
+            broken = []
+            for future in done:
+                collect(future, broken)
+            if not broken:
+                continue
+            # Every record in flight fails along with the dead worker
+            for future in list(futures.keys()):
+                collect(future, broken)
+            # The workers of a broken pool are already terminated
+            executor = _make_executor(n_jobs)
+            if len(broken) == 1:
+                i, attempt, duration = broken[0]
+                fail(i, attempt, 'Worker process died while unmasking %s'
+                     % imgs_list[i], duration)
+            else:
+                print('A worker process died, rerunning %i records one '
+                      'at a time' % len(broken))
+                suspects.extend((i, attempt) for i, attempt, _ in broken)
+    finally:
+        executor.shutdown(wait=True)
+    return filenames
+
+
 def get_raw_rest_data(raw_dir):
     if not os.path.exists(raw_dir):
         raise ValueError('Unmask directory %s does not exist.'
@@ -62,8 +231,19 @@ def create_raw_rest_data(imgs_list,
                          n_jobs=1,
                          mock=False,
                          memory=Memory(cachedir=None),
-                         overwrite=False):
+                         overwrite=False,
+                         raw_format='npy',
+                         chunked_params=None,
+                         n_retries=2):
     """
+    Mask a list of images and save the results as raw records in raw_dir,
+    along with the masker parameters and a data.csv index.
+
+    Records are unmasked by n_jobs processes, which bounds the number of
+    images decompressed in memory at once. Each record is written
+    atomically and logged in raw_dir/journal.jsonl once complete, so that
+    an interrupted run can be restarted: complete records are skipped
+    unless overwrite is True.
 
     Parameters
     ----------
@@ -74,6 +254,15 @@ def create_raw_rest_data(imgs_list,
     masker_params
     n_jobs
     mock
+    raw_format: str in ['npy', 'chunked']
+        Storage of unmasked records: plain .npy files, that can be memory
+        mapped, or compressed chunked records (see save_chunked)
+    chunked_params: dict or None
+        Keyword arguments of save_chunked (chunk_size, precision,
+        compression_level, shuffle), used if raw_format == 'chunked'
+    n_retries: int
+        Number of times unmasking a record is retried before writing a
+        '-error' file holding the traceback
 
     Returns
     -------
@@ -81,6 +270,11 @@ def create_raw_rest_data(imgs_list,
     """
     if masker_params is None:
         masker_params = {}
+    if raw_format not in ['npy', 'chunked']:
+        raise ValueError("raw_format should be 'npy' or 'chunked', got %s"
+                         % raw_format)
+    if chunked_params is None:
+        chunked_params = {}
     masker = MultiNiftiMasker(verbose=1, memory=memory,
                               memory_level=1,
                               **masker_params)
@@ -97,17 +291,37 @@ def create_raw_rest_data(imgs_list,
 
     if not os.path.exists(raw_dir):
         os.makedirs(raw_dir)
-    filenames = Parallel(n_jobs=n_jobs)(delayed(_unmask_single_img)(
-        masker, imgs, confounds, root, raw_dir, mock=mock,
-        overwrite=overwrite)
-                                        for imgs, confounds in
-                                        zip(imgs_list['filename'],
-                                            confounds))
+    imgs = list(imgs_list['filename'])
+    confounds = [these_confounds for these_confounds, _ in
+                 zip(confounds, imgs)]
+    filenames = []
+    for img in imgs:
+        if not isinstance(img, str):
+            img = check_niimg(img).get_filename()
+            if img is None:
+                raise ValueError('Provided Nifti1Image should be linked '
+                                 'to a file.')
+        filenames.append(_raw_filename(img, root, raw_dir, raw_format))
+    if mock:
+        for img, filename in zip(imgs, filenames):
+            print('Saving %s to %s' % (img, filename))
+    else:
+        filenames = _unmask_imgs(masker, imgs, confounds, filenames,
+                                 os.path.join(raw_dir, 'journal.jsonl'),
+                                 n_jobs=n_jobs, n_retries=n_retries,
+                                 raw_format=raw_format,
+                                 chunked_params=chunked_params,
+                                 overwrite=overwrite)
     imgs_list = imgs_list.rename(columns={'filename': 'orig_filename'})
     imgs_list = imgs_list.assign(filename=filenames)
     imgs_list = imgs_list.assign(confounds=None)
     if not mock:
         imgs_list.to_csv(os.path.join(raw_dir, 'data.csv'), mode='w+')
+        # Header cache for fMRIDictFact(scan_manifest=...)
+        scan_imgs([filename for filename in filenames
+                   if not filename.endswith('-error')],
+                  manifest=os.path.join(raw_dir, 'manifest.json'),
+                  n_jobs=n_jobs)
         mask_img_file = os.path.join(raw_dir, 'mask_img.nii.gz')
         masker.mask_img_.to_filename(mask_img_file)
         params = masker.get_params()
@@ -0,0 +1,139 @@
+import json
+import os
+from functools import reduce
+
+import nibabel
+import numpy as np
+from nibabel.filebasedimages import ImageFileError
+from nilearn._utils import check_niimg
+from nilearn._utils.compat import _basestring
+from sklearn.externals.joblib import Parallel, delayed
+
+from .chunked import CHUNKED_EXT, ChunkedRecord
+
+
+def _read_npy_header(filename):
+    """Read shape and dtype of a .npy file without mapping its content"""
+    with open(filename, 'rb') as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, _, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, _, dtype = np.lib.format.read_array_header_2_0(f)
+    return shape, dtype
+
+
+def _read_header(img):
+    """Return (n_samples, dtype) of a record, reading only its header.
+
+    Parameters
+    ----------
+    img: str, Niimg-like object or ndarray
+        4D image (time is the last axis) or 2D masked array (time is the
+        first axis), possibly given as a filename.
+    """
+    if isinstance(img, np.ndarray):
+        return img.shape[0], img.dtype
+    if isinstance(img, _basestring):
+        if img.endswith('.npy'):
+            shape, dtype = _read_npy_header(img)
+            return shape[0], dtype
+        if img.endswith(CHUNKED_EXT):
+            record = ChunkedRecord(img)
+            return record.shape[0], record.dtype
+        try:
+            header = nibabel.load(img).header
+        except ImageFileError:
+            shape, dtype = _read_npy_header(img)
+            return shape[0], dtype
+        return header.get_data_shape()[3], header.get_data_dtype()
+    img = check_niimg(img)
+    return img.shape[3], img.get_data_dtype()
+
+
+def _file_key(filename):
+    stat = os.stat(filename)
+    return stat.st_size, stat.st_mtime
+
+
+def scan_imgs(imgs, manifest=None, n_jobs=1, verbose=0):
+    """Extract the number of samples and dtype of a list of records, reading
+    only file headers.
+
+    Results for files are cached in a JSON manifest, keyed by absolute path,
+    size and modification time, so that subsequent scans of unchanged files
+    do not touch them.
+
+    Parameters
+    ----------
+    imgs: list of str, Niimg-like objects or ndarrays
+        Records to scan. Strings may point to NIfTI, .npy or chunked
+        files.
+
+    manifest: str or None
+        Path of the JSON manifest used to cache header information. Created
+        or updated if needed. If None, nothing is cached.
+
+    n_jobs: int
+        Number of threads used to read headers.
+
+    verbose: int
+        Verbosity level.
+
+    Returns
+    -------
+    n_samples_list: list of int
+        Number of samples in each record.
+
+    dtype: np.dtype
+        dtype that can hold the data of all records.
+    """
+    imgs = list(imgs)
+    if manifest is not None and os.path.exists(manifest):
+        with open(manifest, 'r') as f:
+            entries = json.load(f)
+    else:
+        entries = {}
+
+    results = [None] * len(imgs)
+    to_scan = []
+    for i, img in enumerate(imgs):
+        if isinstance(img, _basestring):
+            filename = os.path.abspath(img)
+            size, mtime = _file_key(filename)
+            entry = entries.get(filename)
+            if (entry is not None and entry['size'] == size
+                    and entry['mtime'] == mtime):
+                results[i] = entry['n_samples'], np.dtype(entry['dtype'])
+                continue
+        to_scan.append(i)
+
+    if verbose:
+        print('Reading %i headers, %i found in manifest'
+              % (len(to_scan), len(imgs) - len(to_scan)))
+    scanned = Parallel(n_jobs=n_jobs, backend='threading')(
+        delayed(_read_header)(imgs[i]) for i in to_scan)
+
+    updated = False
+    for i, (n_samples, dtype) in zip(to_scan, scanned):
+        results[i] = int(n_samples), np.dtype(dtype)
+        img = imgs[i]
+        if isinstance(img, _basestring):
+            filename = os.path.abspath(img)
+            size, mtime = _file_key(filename)
+            entries[filename] = {'size': size, 'mtime': mtime,
+                                 'n_samples': int(n_samples),
+                                 'dtype': np.dtype(dtype).str}
+            updated = True
+
+    if manifest is not None and updated:
+        tmp_manifest = manifest + '.tmp'
+        with open(tmp_manifest, 'w+') as f:
+            json.dump(entries, f)
+        os.replace(tmp_manifest, manifest)
+
+    if len(results) == 0:
+        return [], None
+    n_samples_list = [n_samples for n_samples, _ in results]
+    dtype = reduce(np.promote_types, [dtype for _, dtype in results])
+    return n_samples_list, dtype
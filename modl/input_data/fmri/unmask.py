@@ -6,6 +6,24 @@ from nilearn._utils.compat import _basestring
 from nilearn.input_data import MultiNiftiMasker
 from sklearn.externals.joblib import Memory, Parallel, delayed
 
+from .chunked import CHUNKED_EXT, ChunkedRecord, load_chunked
+
+RAW_EXTS = ['.npy', CHUNKED_EXT]
+
+
+def _load_raw(filename, mmap_mode=None):
+    """Load a .npy or chunked record. If mmap_mode is not None, chunked
+    records are returned as a ChunkedRecord, that decompresses rows on
+    access, instead of being decompressed in memory"""
+    if isinstance(filename, np.ndarray):
+        return filename
+    name, ext = os.path.splitext(filename)
+    if ext == CHUNKED_EXT:
+        if mmap_mode is not None:
+            return ChunkedRecord(filename)
+        return load_chunked(filename)
+    return np.load(filename, mmap_mode=mmap_mode)
+
 
 class MultiRawMasker(MultiNiftiMasker):
     def __init__(self, mask_img=None, smoothing_fwhm=None,
@@ -40,8 +58,8 @@ class MultiRawMasker(MultiNiftiMasker):
         self._check_fitted()
         if isinstance(imgs, str):
             name, ext = os.path.splitext(imgs)
-            if ext == '.npy':
-                data = np.load(imgs, mmap_mode=mmap_mode)
+            if ext in RAW_EXTS:
+                data = _load_raw(imgs, mmap_mode=mmap_mode)
             else:
                 return MultiNiftiMasker.transform_single_imgs(self, imgs,
                                                               confounds=confounds,
@@ -92,15 +110,15 @@ class MultiRawMasker(MultiNiftiMasker):
         for imgs in imgs_list:
             if isinstance(imgs, str):
                 name, ext = os.path.splitext(imgs)
-                if ext != '.npy':
+                if ext not in RAW_EXTS:
                     raw = False
                     break
             elif not isinstance(imgs, np.ndarray):
                 raw = False
                 break
         if raw:
-            data = Parallel(n_jobs=n_jobs)(delayed(np.load)(imgs,
-                                                            mmap_mode=mmap_mode)
+            data = Parallel(n_jobs=n_jobs)(delayed(_load_raw)(imgs,
+                                                              mmap_mode=mmap_mode)
                                            for imgs in imgs_list)
             return data
         else:
@@ -129,7 +147,7 @@ class MultiRawMasker(MultiNiftiMasker):
         """
         self._check_fitted()
         if not hasattr(imgs, '__iter__') \
-                or isinstance(imgs, _basestring):
+                or isinstance(imgs, (_basestring, np.ndarray)):
             return self.transform_single_imgs(imgs, mmap_mode=mmap_mode)
         return self.transform_imgs(imgs, confounds, n_jobs=self.n_jobs,
                                    mmap_mode=mmap_mode)
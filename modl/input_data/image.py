@@ -23,4 +23,6 @@ def scale_patches(X, with_mean=True, with_std=True, channel_wise=True, copy=True
     return X
 
 from .image_fast import clean_mask
-from .image_fast import fill
\ No newline at end of file
+from .image_fast import clean_windows
+from .image_fast import fill
+from .image_fast import gather_patches
\ No newline at end of file
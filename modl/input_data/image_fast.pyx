@@ -8,9 +8,131 @@ import numpy as np
 cimport numpy as np
 
 from cython cimport floating
+from libc.math cimport fmax, sqrt
+from libc.stdlib cimport free, malloc
+from libc.string cimport memcpy
 
-def clean_mask(floating[:, :, :, :, :, :] patches,
-          floating[:, :, :] image):
+# Summed-area tables use 32-bit counts unless the image has 2 ** 31 pixels
+# or more
+ctypedef fused count_t:
+    int
+    long long
+
+
+def _missing_row_sums(floating[:, :, :] image, long z, long rr,
+                      count_t[:, ::1] sat, long start, long stop):
+    """Rows start to stop of the integral image: sat[i + 1, j + 1] counts
+    the pixels image[i, :j + 1] with a missing value (-1) among channels
+    rr to rr + z, summed along rows only"""
+    cdef long n_cols = image.shape[1]
+    cdef long i, j, c
+    cdef count_t acc
+    with nogil:
+        for i in range(start, stop):
+            acc = 0
+            for j in range(n_cols):
+                for c in range(rr, rr + z):
+                    if image[i, j, c] == -1:
+                        acc += 1
+                        break
+                sat[i + 1, j + 1] = acc
+
+
+def _cumsum_columns(count_t[:, ::1] sat, long start, long stop):
+    """Cumulative sums along rows of sat[:, start:stop]"""
+    cdef long n_rows = sat.shape[0]
+    cdef long i, j
+    with nogil:
+        for i in range(1, n_rows):
+            for j in range(start, stop):
+                sat[i, j] += sat[i - 1, j]
+
+
+def _clean_windows(count_t[:, ::1] sat, long x, long y, long rr,
+                   unsigned char[:, :, ::1] take, long start, long stop):
+    """take[pp, qq, rr] = 1 for the windows of shape (x, y) at rows start
+    to stop that contain no missing pixel"""
+    cdef long q = take.shape[1]
+    cdef long pp, qq
+    cdef count_t count
+    with nogil:
+        for pp in range(start, stop):
+            for qq in range(q):
+                count = (sat[pp + x, qq + y] - sat[pp, qq + y]
+                         - sat[pp + x, qq] + sat[pp, qq])
+                take[pp, qq, rr] = count == 0
+
+
+def _run_blocks(func, long n, int n_threads, pool, *args):
+    """Call func(*args, start, stop) on n_threads blocks of range(n)"""
+    cdef long size_job = (n + n_threads - 1) // n_threads
+    blocks = [(start, min(start + size_job, n))
+              for start in range(0, n, max(size_job, 1))]
+    if pool is None or len(blocks) < 2:
+        for start, stop in blocks:
+            func(*args, start, stop)
+    else:
+        futures = [pool.submit(func, *args, start, stop)
+                   for start, stop in blocks]
+        for future in futures:
+            future.result()
+
+
+def clean_windows(image, patch_shape, int n_threads=1):
+    """
+    Mask of the patch positions of image whose patches contain no missing
+    value (-1), computed from summed-area tables of missing pixels in
+    O(image size) whatever the patch size. Rows are processed in n_threads
+    threads.
+
+    Parameters
+    ----------
+    image: float/double ndarray, shape (height, width, n_channels)
+
+    patch_shape: (int, int, int)
+        Shape (x, y, z) of the patches
+
+    n_threads: int
+        Number of threads
+
+    Returns
+    -------
+    take: uint8 ndarray, shape (height - x + 1, width - y + 1,
+        n_channels - z + 1)
+        1 for clean patches
+    """
+    cdef long x, y, z, n_rows, n_cols, n_channels, p, q, r, rr
+    x, y, z = patch_shape
+    n_rows, n_cols, n_channels = image.shape
+    p, q, r = n_rows - x + 1, n_cols - y + 1, n_channels - z + 1
+    take = np.zeros((max(p, 0), max(q, 0), max(r, 0)), dtype=np.uint8)
+    if p <= 0 or q <= 0 or r <= 0:
+        return take
+    # np.intc and np.longlong match the C types of count_t on all platforms
+    if image.shape[0] * image.shape[1] < 2 ** 31:
+        sat_dtype = np.intc
+    else:
+        sat_dtype = np.longlong
+    sat = np.zeros((n_rows + 1, n_cols + 1), dtype=sat_dtype)
+    if n_threads > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        pool = ThreadPoolExecutor(n_threads)
+    else:
+        pool = None
+    try:
+        for rr in range(r):
+            _run_blocks(_missing_row_sums, n_rows, n_threads, pool,
+                        image, z, rr, sat)
+            _run_blocks(_cumsum_columns, n_cols + 1, n_threads, pool, sat)
+            _run_blocks(_clean_windows, p, n_threads, pool,
+                        sat, x, y, rr, take)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    return take
+
+
+def clean_mask(patches, image, int n_threads=1):
     """
     Given the patches extracted from image using gen_patches, return the indices
     for which patch are clean (i.e. with non-negative values)
@@ -19,42 +141,16 @@ def clean_mask(floating[:, :, :, :, :, :] patches,
     patches: float/double ndarray, shape (*patch_indices, *patch_shape)
         Extracted from sklearn.feature_extraction.image.gen_batches
     image: float/double ndarray, shape (width, height, n_channel)
+    n_threads: int
+        Number of threads, see clean_windows
 
     Returns
     -------
     indices: int ndarray, shape = (n_good_patches, 3)
         Coordinates of the clean patches
     """
-    cdef long p = patches.shape[0]
-    cdef long q = patches.shape[1]
-    cdef long r = patches.shape[2]
-    cdef long x = patches.shape[3]
-    cdef long y = patches.shape[4]
-    cdef long z = patches.shape[5]
-    cdef long size = p * q * r
-    cdef long pp, qq, rr, xx, yy, zz
-    cdef long l = 0
-    cdef long n_samples = 0
-    cdef int[:, :, :] take = view.array((p, q, r), sizeof(int), format='i', mode='c')
-    cdef long[:, :] indices = view.array((size, 3), sizeof(long), format='l')
-    take[:] = 1
-    for pp in range(p + x - 1):
-        for qq in range(q + y -1):
-            for rr in range(r + z - 1):
-                if image[pp, qq, rr] == -1:
-                    for xx in range(max(0, pp - x + 1), min(p, pp + 1)):
-                        for yy in range(max(0, qq - y + 1), min(q, qq + 1)):
-                            for zz in range(max(0, rr - y + 1), min(r, rr + 1)):
-                                take[xx, yy, zz] = 0
-    for pp in range(p):
-        for qq in range(q):
-            for rr in range(r):
-                if take[pp, qq, rr]:
-                    indices[l, 0] = pp
-                    indices[l, 1] = qq
-                    indices[l, 2] = rr
-                    l +=1
-    return np.asarray(indices[:l])
+    take = clean_windows(image, patches.shape[3:], n_threads=n_threads)
+    return np.argwhere(take)
 
 def fill(long p, long q, long r):
     """
@@ -72,3 +168,103 @@ def fill(long p, long q, long r):
                 indices[l, 2] = rr
                 l +=1
     return np.asarray(indices)
+
+
+def gather_patches(floating[:, :, ::1] image, long[:, :] indices,
+                   long patch_h, long patch_w, floating[:, ::1] out,
+                   bint with_mean=True, bint with_std=True,
+                   bint channel_wise=True):
+    """
+    Copy the patches of image at indices into the rows of out, centered
+    and scaled as by scale_patches, in a single pass over the data per
+    patch. Releases the GIL.
+
+    Parameters
+    ----------
+    image: float/double ndarray, shape (height, width, n_channels)
+        C-contiguous image
+
+    indices: long ndarray, shape (n_patches, >= 2)
+        Top-left corner of each patch
+
+    patch_h, patch_w: long
+        Patch shape
+
+    out: float/double ndarray, shape (n_patches, patch_h * patch_w *
+        n_channels)
+        C-contiguous output, receiving flattened patches
+
+    with_mean, with_std, channel_wise: bint
+        See scale_patches
+    """
+    cdef long n_patches = indices.shape[0]
+    cdef long n_channels = image.shape[2]
+    cdef long row_size = patch_w * n_channels
+    cdef long n_pixels = patch_h * patch_w
+    cdef long n_stats = n_channels if channel_wise else 1
+    cdef long i, hh, ww, ll, c, pos
+    cdef double n, std, value
+    cdef double channel_scale = sqrt(n_channels) if channel_wise else 1
+    cdef floating* src
+    cdef floating* dst
+    cdef double* sums = <double*> malloc(n_stats * sizeof(double))
+    cdef double* sq_sums = <double*> malloc(n_stats * sizeof(double))
+    cdef double* means = <double*> malloc(n_stats * sizeof(double))
+    cdef double* scales = <double*> malloc(n_stats * sizeof(double))
+    if (sums == NULL or sq_sums == NULL or means == NULL
+            or scales == NULL):
+        free(sums)
+        free(sq_sums)
+        free(means)
+        free(scales)
+        raise MemoryError()
+    n = n_pixels if channel_wise else n_pixels * n_channels
+    with nogil:
+        for i in range(n_patches):
+            for c in range(n_stats):
+                sums[c] = 0
+                sq_sums[c] = 0
+            # Gather rows of the patch, accumulating statistics
+            dst = &out[i, 0]
+            for hh in range(patch_h):
+                src = &image[indices[i, 0] + hh, indices[i, 1], 0]
+                if channel_wise:
+                    for ww in range(patch_w):
+                        for c in range(n_channels):
+                            value = src[c]
+                            dst[c] = value
+                            sums[c] += value
+                            sq_sums[c] += value * value
+                        src += n_channels
+                        dst += n_channels
+                else:
+                    for ll in range(row_size):
+                        value = src[ll]
+                        dst[ll] = value
+                        sums[0] += value
+                        sq_sums[0] += value * value
+                    dst += row_size
+            for c in range(n_stats):
+                means[c] = sums[c] / n if with_mean else 0
+                if with_std:
+                    # Sum of squares of centered data
+                    std = sqrt(fmax(sq_sums[c] - n * means[c] * means[c],
+                                    0))
+                    if std == 0:
+                        std = 1
+                    scales[c] = 1 / (std * channel_scale)
+                else:
+                    scales[c] = 1
+            dst = &out[i, 0]
+            if channel_wise:
+                for pos in range(n_pixels):
+                    for c in range(n_channels):
+                        dst[c] = <floating> ((dst[c] - means[c]) * scales[c])
+                    dst += n_channels
+            else:
+                for pos in range(n_pixels * n_channels):
+                    dst[pos] = <floating> ((dst[pos] - means[0]) * scales[0])
+    free(sums)
+    free(sq_sums)
+    free(means)
+    free(scales)
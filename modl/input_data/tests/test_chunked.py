@@ -0,0 +1,68 @@
+import shutil
+from os.path import join
+from tempfile import mkdtemp
+
+import nibabel
+import numpy as np
+import pytest
+from numpy.testing import assert_array_equal, assert_array_almost_equal
+
+from modl.input_data.fmri.chunked import (ChunkedRecord, save_chunked,
+                                          load_chunked)
+from modl.input_data.fmri.scan import scan_imgs
+from modl.input_data.fmri.unmask import MultiRawMasker
+
+
+@pytest.fixture(scope="module")
+def tmpdir():
+    tmp = mkdtemp()
+    yield tmp
+    shutil.rmtree(tmp)
+
+
+@pytest.mark.parametrize("precision", ['float32', 'float16', 'int16'])
+def test_chunked_roundtrip(tmpdir, precision):
+    rng = np.random.RandomState(0)
+    data = rng.randn(53, 20).astype('float32')
+    data[:, 3] = 0
+    filename = join(tmpdir, 'record_%s.chunks' % precision)
+    save_chunked(filename, data, chunk_size=10, precision=precision)
+    loaded = load_chunked(filename)
+    assert loaded.shape == data.shape
+    assert loaded.dtype == np.float32
+    if precision == 'float32':
+        assert_array_equal(loaded, data)
+    else:
+        assert_array_almost_equal(loaded, data, decimal=2)
+
+    # Random access
+    record = ChunkedRecord(filename)
+    assert len(record) == 53
+    rows = np.array([0, 11, 12, 35, 52])
+    assert_array_equal(record[rows], loaded[rows])
+    assert_array_equal(record[20:45], loaded[20:45])
+    out = np.empty((len(rows), 20), dtype=np.float32)
+    record.read(rows, out=out)
+    assert_array_equal(out, loaded[rows])
+
+
+def test_chunked_masker(tmpdir):
+    rng = np.random.RandomState(0)
+    mask = np.zeros((3, 3, 3))
+    mask[1:, 1:, 1:] = 1
+    mask_img = nibabel.Nifti1Image(mask, np.eye(4))
+    data = rng.randn(30, 8)
+    filename = join(tmpdir, 'masked.chunks')
+    save_chunked(filename, data, chunk_size=7, precision='float64')
+
+    assert scan_imgs([filename]) == ([30], np.float64)
+
+    masker = MultiRawMasker(mask_img=mask_img).fit()
+    assert_array_equal(masker.transform(filename), data)
+    loaded = masker.transform([filename, filename])
+    assert len(loaded) == 2
+    assert_array_equal(loaded[1], data)
+    # Memory-mapping reads chunks on access
+    record = masker.transform(filename, mmap_mode='r')
+    assert isinstance(record, ChunkedRecord)
+    assert_array_equal(record.read(), data)
@@ -1,6 +1,8 @@
 import numpy as np
 from modl.input_data.image import scale_patches
-from modl.input_data.image_fast import clean_mask, fill
+from modl.input_data.image_fast import (clean_mask, clean_windows, fill,
+                                       gather_patches, _clean_windows,
+                                       _cumsum_columns, _missing_row_sums)
 from numpy.testing import assert_array_almost_equal, assert_array_equal
 from sklearn.feature_extraction.image import extract_patches
 from sklearn.utils import check_random_state
@@ -50,3 +52,56 @@ def test_clean():
 def test_fill():
     p, q, r = 10, 10, 10
     assert_array_equal(np.c_[np.where(np.ones((p, q, r)))], fill(p, q, r))
+
+
+def test_gather_patches():
+    rs = check_random_state(0)
+    image = rs.randn(20, 16, 5)
+    patches = extract_patches(image, (4, 3, 5))
+    indices = fill(*patches.shape[:3])[rs.permutation(17 * 14)[:30]]
+    for dtype in [np.float32, np.float64]:
+        this_image = image.astype(dtype)
+        for with_mean in [False, True]:
+            for with_std in [False, True]:
+                for channel_wise in [False, True]:
+                    out = np.empty((30, 4 * 3 * 5), dtype=dtype)
+                    gather_patches(this_image, indices, 4, 3, out,
+                                   with_mean=with_mean, with_std=with_std,
+                                   channel_wise=channel_wise)
+                    Y = scale_patches(patches[tuple(indices.T)],
+                                      with_mean=with_mean,
+                                      with_std=with_std,
+                                      channel_wise=channel_wise)
+                    assert_array_almost_equal(out, Y.reshape(30, -1),
+                                              decimal=5)
+
+
+def test_clean_windows():
+    rs = check_random_state(0)
+    image = rs.rand(30, 25, 4)
+    image[rs.rand(30, 25, 4) > 0.995] = -1
+    image[:3] = -1
+    for patch_shape in [(5, 4, 4), (3, 6, 2)]:
+        patches = extract_patches(image, patch_shape)
+        true_take = np.all(patches != -1, axis=(3, 4, 5))
+        for n_threads in [1, 3]:
+            take = clean_windows(image, patch_shape, n_threads=n_threads)
+            assert_array_equal(take, true_take)
+            assert_array_equal(clean_mask(patches, image,
+                                          n_threads=n_threads),
+                               np.c_[np.where(true_take)])
+
+
+def test_clean_windows_count_dtypes():
+    # Images of 2 ** 31 pixels or more use 64-bit summed-area tables
+    rs = check_random_state(0)
+    image = rs.rand(30, 25, 1)
+    image[rs.rand(30, 25) > 0.99] = -1
+    true_take = clean_windows(image, (5, 4, 1))
+    for dtype in [np.intc, np.longlong]:
+        sat = np.zeros((31, 26), dtype=dtype)
+        take = np.zeros_like(true_take)
+        _missing_row_sums(image, 1, 0, sat, 0, 30)
+        _cumsum_columns(sat, 0, 26)
+        _clean_windows(sat, 5, 4, 0, take, 0, 26)
+        assert_array_equal(take, true_take)
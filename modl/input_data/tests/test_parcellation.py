@@ -0,0 +1,54 @@
+import numpy as np
+from numpy.testing import assert_array_equal
+from scipy.sparse.csgraph import connected_components
+
+from modl.input_data.fmri.parcellation import (grid_clustering,
+                                               rena_clustering, _grid_edges)
+
+
+def test_rena_clustering():
+    rng = np.random.RandomState(0)
+    mask = np.zeros((10, 12, 3), dtype=bool)
+    mask[1:-1, 1:-1] = True
+    n_voxels = np.sum(mask)
+    X = rng.randn(20, n_voxels)
+    labels = rena_clustering(X, mask, 30)
+    assert labels.shape == (n_voxels,)
+    assert len(np.unique(labels)) == 30
+
+    # Clusters are spatially connected
+    edges = _grid_edges(mask)
+    for label in range(30):
+        voxels = np.where(labels == label)[0]
+        inside = np.in1d(edges[0], voxels) & np.in1d(edges[1], voxels)
+        index = np.full(n_voxels, -1)
+        index[voxels] = np.arange(len(voxels))
+        graph = np.zeros((len(voxels), len(voxels)))
+        graph[index[edges[0, inside]], index[edges[1, inside]]] = 1
+        assert connected_components(graph, directed=False)[0] == 1
+
+
+def test_rena_clustering_structure():
+    # Piecewise constant signals are clustered along their pieces
+    rng = np.random.RandomState(0)
+    mask = np.ones((8, 8, 1), dtype=bool)
+    pieces = np.zeros((8, 8), dtype='int')
+    pieces[4:, :] = 1
+    X = rng.randn(30, 2)[:, pieces.ravel()]
+    X += 0.01 * rng.randn(*X.shape)
+    labels = rena_clustering(X, mask, 2)
+    assert len(np.unique(labels[pieces.ravel() == 0])) == 1
+    assert len(np.unique(labels[pieces.ravel() == 1])) == 1
+
+
+def test_grid_clustering():
+    mask = np.zeros((6, 6, 2), dtype=bool)
+    mask[:5, :4] = True
+    affine = np.diag([2., 2., 2., 1.])
+    labels = grid_clustering(mask, affine, 4)
+    # Blocks of 2 x 2 x 1 voxels, clipped by the mask
+    assert len(np.unique(labels)) == 3 * 2 * 1
+    assert_array_equal(np.bincount(labels), [8, 8, 8, 8, 4, 4])
+    # A resolution finer than voxels leaves them alone
+    labels = grid_clustering(mask, affine, 1)
+    assert_array_equal(labels, np.arange(np.sum(mask)))
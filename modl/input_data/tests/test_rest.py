@@ -0,0 +1,103 @@
+import json
+import os
+import shutil
+import time
+from os.path import join
+from tempfile import mkdtemp
+
+import nibabel
+import numpy as np
+import pandas as pd
+import pytest
+from numpy.testing import assert_array_equal
+
+from modl.input_data.fmri.rest import create_raw_rest_data, _unmask_imgs
+
+
+class _CrashingMasker(object):
+    """Masker whose worker process dies on the record named 'crash'"""
+    def transform(self, imgs, confounds=None):
+        if imgs == 'crash':
+            time.sleep(.5)
+            os._exit(1)
+        elif imgs == 'slow':
+            time.sleep(1)
+        return np.zeros((10, 8))
+
+
+@pytest.fixture(scope="module")
+def tmpdir():
+    tmp = mkdtemp()
+    yield tmp
+    shutil.rmtree(tmp)
+
+
+def test_create_raw_rest_data(tmpdir):
+    rng = np.random.RandomState(0)
+    root = join(tmpdir, 'root')
+    raw_dir = join(tmpdir, 'raw')
+    os.makedirs(root)
+    mask_img = nibabel.Nifti1Image(np.ones((2, 2, 2), dtype=np.int8),
+                                   np.eye(4))
+    filenames = []
+    for i in range(3):
+        filename = join(root, 'img_%i.nii.gz' % i)
+        nibabel.Nifti1Image(rng.randn(2, 2, 2, 10),
+                            np.eye(4)).to_filename(filename)
+        filenames.append(filename)
+    # Unreadable record
+    filename = join(root, 'img_3.nii.gz')
+    with open(filename, 'wb') as f:
+        f.write(b'corrupted')
+    filenames.append(filename)
+    imgs_list = pd.DataFrame({'filename': filenames})
+    masker_params = {'mask_img': mask_img, 'standardize': False,
+                     'detrend': False}
+
+    create_raw_rest_data(imgs_list, root, raw_dir,
+                         masker_params=masker_params, n_retries=1)
+    raw_filenames = [join(raw_dir, 'img_%i.npy' % i) for i in range(3)]
+    for raw_filename in raw_filenames:
+        assert np.load(raw_filename).shape == (10, 8)
+    assert os.path.exists(join(raw_dir, 'img_3.npy-error'))
+    assert not os.path.exists(join(raw_dir, 'img_3.npy'))
+    data_list = pd.read_csv(join(raw_dir, 'data.csv'))
+    assert data_list['filename'].iloc[3] == join(raw_dir, 'img_3.npy-error')
+    with open(join(raw_dir, 'journal.jsonl'), 'r') as f:
+        entries = [json.loads(line) for line in f]
+    assert sorted(entry['status'] for entry in entries) == ['done'] * 3 + [
+        'error']
+
+    # Complete records are skipped on restart, truncated ones recomputed
+    expected = np.load(raw_filenames[1])
+    np.save(raw_filenames[0], np.zeros((10, 8)))
+    with open(raw_filenames[1], 'r+b') as f:
+        f.truncate(100)
+    os.remove(join(raw_dir, 'journal.jsonl'))
+    create_raw_rest_data(imgs_list, root, raw_dir,
+                         masker_params=masker_params, n_retries=0,
+                         n_jobs=2)
+    assert_array_equal(np.load(raw_filenames[0]), 0)
+    assert_array_equal(np.load(raw_filenames[1]), expected)
+
+
+def test_unmask_imgs_dead_worker(tmpdir):
+    raw_dir = join(tmpdir, 'dead_worker')
+    # 'slow' is in flight when the worker processing 'crash' dies
+    imgs = ['slow', 'crash', 'a', 'b']
+    raw_filenames = [join(raw_dir, '%s.npy' % img) for img in imgs]
+    journal = join(raw_dir, 'journal.jsonl')
+    filenames = _unmask_imgs(_CrashingMasker(), imgs, [None] * len(imgs),
+                             raw_filenames, journal, n_jobs=2, n_retries=1)
+    assert filenames[1] == raw_filenames[1] + '-error'
+    with open(filenames[1], 'r') as f:
+        assert 'Worker process died' in f.read()
+    for i in [0, 2, 3]:
+        assert filenames[i] == raw_filenames[i]
+        assert np.load(raw_filenames[i]).shape == (10, 8)
+    with open(journal, 'r') as f:
+        entries = [json.loads(line) for line in f]
+    assert len(entries) == len(imgs)
+    statuses = {entry['filename']: entry['status'] for entry in entries}
+    assert statuses == {raw_filename: 'done' if i != 1 else 'error'
+                        for i, raw_filename in enumerate(raw_filenames)}
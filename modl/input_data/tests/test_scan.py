@@ -0,0 +1,58 @@
+import json
+import os
+import shutil
+from os.path import join
+from tempfile import mkdtemp
+
+import nibabel
+import numpy as np
+import pytest
+
+from modl.input_data.fmri.scan import scan_imgs
+
+
+@pytest.fixture(scope="module")
+def tmpdir():
+    tmp = mkdtemp()
+    yield tmp
+    shutil.rmtree(tmp)
+
+
+def test_scan_imgs(tmpdir):
+    rng = np.random.RandomState(0)
+    imgs = []
+    for i, length in enumerate([10, 20]):
+        filename = join(tmpdir, 'raw_%i.npy' % i)
+        np.save(filename, rng.randn(length, 5).astype('float32'))
+        imgs.append(filename)
+    filename = join(tmpdir, 'img.nii.gz')
+    nibabel.Nifti1Image(rng.randn(2, 2, 2, 15).astype('float32'),
+                        np.eye(4)).to_filename(filename)
+    imgs.append(filename)
+    in_memory_img = nibabel.Nifti1Image(
+        rng.randn(2, 2, 2, 7).astype('float64'), np.eye(4))
+    imgs.append(in_memory_img)
+
+    manifest = join(tmpdir, 'manifest.json')
+    n_samples_list, dtype = scan_imgs(imgs, manifest=manifest, n_jobs=2)
+    assert n_samples_list == [10, 20, 15, 7]
+    assert dtype == np.float64
+
+    with open(manifest, 'r') as f:
+        entries = json.load(f)
+    assert len(entries) == 3
+    assert entries[os.path.abspath(imgs[1])]['n_samples'] == 20
+
+    # Entries are read from the manifest
+    entries[os.path.abspath(imgs[0])]['n_samples'] = 100
+    with open(manifest, 'w') as f:
+        json.dump(entries, f)
+    n_samples_list, dtype = scan_imgs(imgs[:3], manifest=manifest)
+    assert n_samples_list == [100, 20, 15]
+    assert dtype == np.float32
+
+    # Modified files are scanned again
+    np.save(imgs[0], rng.randn(12, 5).astype('float32'))
+    os.utime(imgs[0], (0, 0))
+    n_samples_list, dtype = scan_imgs(imgs[:3], manifest=manifest)
+    assert n_samples_list == [12, 20, 15]
@@ -0,0 +1,106 @@
+import threading
+from collections import OrderedDict
+
+
+class ArtifactWriter(object):
+    """
+    Write artifacts (dictionary snapshots, logs) in a background thread, so
+    that learning is not blocked by compression and disk writes.
+
+    Tasks are callables submitted with a key. A pending task is replaced by
+    a newer task with the same key, so that e.g. only the last state of a
+    log is written. At most max_pending tasks wait in the queue: beyond,
+    the oldest pending task is dropped if policy is 'drop', or submit
+    blocks until the worker catches up if policy is 'block'.
+
+    Arrays passed to tasks should be copies of the learning state, as the
+    task runs while learning goes on.
+
+    Parameters
+    ----------
+    max_pending: int
+        Maximum number of tasks waiting to be run
+
+    policy: str in ['drop', 'block']
+        Behavior when max_pending tasks are waiting
+
+    Attributes
+    ----------
+    n_dropped_: int
+        Number of tasks dropped or replaced before being run
+    """
+    def __init__(self, max_pending=2, policy='drop'):
+        if policy not in ['drop', 'block']:
+            raise ValueError("policy should be 'drop' or 'block', got %s"
+                             % policy)
+        self.max_pending = max_pending
+        self.policy = policy
+        self.n_dropped_ = 0
+        self._tasks = OrderedDict()
+        self._running = False
+        self._error = None
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._work)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, key, func, *args, **kwargs):
+        """Schedule func(*args, **kwargs), replacing any pending task with
+        the same key"""
+        with self._condition:
+            if self._closed:
+                raise ValueError('ArtifactWriter is closed')
+            self._check_error()
+            if key in self._tasks:
+                del self._tasks[key]
+                self.n_dropped_ += 1
+            while len(self._tasks) >= self.max_pending:
+                if self.policy == 'drop':
+                    self._tasks.popitem(last=False)
+                    self.n_dropped_ += 1
+                else:
+                    self._condition.wait()
+            self._tasks[key] = func, args, kwargs
+            self._condition.notify_all()
+
+    def flush(self):
+        """Wait for all pending tasks to be written, and raise the first
+        error met by the worker, if any"""
+        with self._condition:
+            while self._tasks or self._running:
+                self._condition.wait()
+            self._check_error()
+
+    def close(self):
+        """Flush pending tasks and stop the worker"""
+        self.flush()
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join()
+
+    def _check_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _work(self):
+        while True:
+            with self._condition:
+                while not self._tasks and not self._closed:
+                    self._condition.wait()
+                if not self._tasks:
+                    return
+                _, (func, args, kwargs) = self._tasks.popitem(last=False)
+                self._running = True
+            try:
+                func(*args, **kwargs)
+            except Exception as e:
+                with self._condition:
+                    if self._error is None:
+                        self._error = e
+            finally:
+                with self._condition:
+                    self._running = False
+                    self._condition.notify_all()
@@ -0,0 +1,176 @@
+"""
+Fast argument hashing for joblib caching of file-backed data.
+
+joblib hashes arrays by their full content, which takes longer than many
+cached computations when arguments are large memory-mapped records. The
+FingerprintHasher identifies file-backed arguments by a fingerprint of the
+file instead: its path, size, modification time and a digest of sampled
+blocks of its content. It is used by the caches of FingerprintMemory, an
+opt-in replacement of joblib.Memory.
+"""
+import hashlib
+import mmap
+import os
+import sys
+
+import numpy as np
+from sklearn.externals.joblib import Memory
+from sklearn.externals.joblib.func_inspect import filter_args
+from sklearn.externals.joblib.hashing import NumpyHasher
+from sklearn.externals.joblib.memory import MemorizedFunc
+
+FINGERPRINT_EXTS = ('.npy', '.chunks', '.nii', '.nii.gz')
+
+
+def fingerprint_file(filename, sample_size=2 ** 20, n_blocks=16):
+    """
+    Fingerprint of a file, computed without reading it in full
+
+    Parameters
+    ----------
+    filename: str
+
+    sample_size: int
+        Number of bytes read from the file: n_blocks blocks evenly spaced
+        from its start to its end. Files smaller than sample_size are read
+        in full
+
+    n_blocks: int
+        Number of blocks read
+
+    Returns
+    -------
+    fingerprint: tuple
+        (absolute path, size, modification time, sampled digest)
+    """
+    filename = os.path.abspath(filename)
+    stat = os.stat(filename)
+    size = stat.st_size
+    digest = hashlib.md5()
+    with open(filename, 'rb') as f:
+        if size <= sample_size:
+            digest.update(f.read())
+        else:
+            block_size = sample_size // n_blocks
+            for offset in np.linspace(0, size - block_size, n_blocks):
+                f.seek(int(offset))
+                digest.update(f.read(block_size))
+    return filename, size, stat.st_mtime, digest.hexdigest()
+
+
+def _mmap_offset(array):
+    """Offset in its file of the first byte of a memmap, or of a view of
+    it"""
+    low, _ = np.byte_bounds(array)
+    mapped = np.frombuffer(array._mmap, dtype=np.uint8)
+    mapped_start = mapped.__array_interface__['data'][0]
+    # The mapping starts at a multiple of the allocation granularity
+    # below the offset given to np.memmap
+    mapping_offset = array.offset - array.offset % mmap.ALLOCATIONGRANULARITY
+    return mapping_offset + low - mapped_start
+
+
+class FingerprintHasher(NumpyHasher):
+    """
+    Hasher that replaces file-backed objects by fingerprints of their
+    files (see fingerprint_file):
+
+    - read-only memmaps, along with their shape, dtype, strides and offset
+      in the file
+    - strings that are paths to existing files ending with one of exts
+    - nibabel images whose data is a proxy to a file
+
+    Other objects are hashed as by joblib.
+
+    Parameters
+    ----------
+    hash_name: str
+        Hash algorithm
+
+    coerce_mmap: bool
+        Make no difference between np.memmap and np.ndarray objects that
+        are not fingerprinted
+
+    sample_size: int
+        Number of bytes of each file read to compute its fingerprint
+
+    exts: tuple of str
+        Extensions of the paths to fingerprint
+    """
+    def __init__(self, hash_name='md5', coerce_mmap=False,
+                 sample_size=2 ** 20, exts=FINGERPRINT_EXTS):
+        NumpyHasher.__init__(self, hash_name=hash_name,
+                             coerce_mmap=coerce_mmap)
+        self.sample_size = sample_size
+        self.exts = exts
+
+    def _fingerprint(self, filename):
+        # Paths are encoded so that they are not fingerprinted again
+        filename, size, mtime, digest = fingerprint_file(filename,
+                                                         self.sample_size)
+        return ('FINGERPRINT', filename.encode('utf-8'), size, mtime, digest)
+
+    def save(self, obj):
+        if (isinstance(obj, np.memmap) and obj.mode == 'r'
+                and obj.filename is not None and obj._mmap is not None):
+            obj = (self._fingerprint(obj.filename), obj.shape,
+                   obj.dtype.str, obj.strides, _mmap_offset(obj))
+        elif (isinstance(obj, str) and obj.endswith(self.exts)
+              and os.path.isfile(obj)):
+            obj = self._fingerprint(obj)
+        else:
+            # nibabel is not imported if no image can be given
+            nibabel = sys.modules.get('nibabel')
+            if (nibabel is not None and
+                    isinstance(obj, nibabel.spatialimages.SpatialImage)
+                    and nibabel.arrayproxy.is_proxy(obj.dataobj)
+                    and obj.get_filename() is not None):
+                obj = (obj.__class__, self._fingerprint(obj.get_filename()))
+        NumpyHasher.save(self, obj)
+
+
+def fingerprint_hash(obj, hash_name='md5', coerce_mmap=False,
+                     sample_size=2 ** 20, exts=FINGERPRINT_EXTS):
+    """Hash of obj, fingerprinting the files backing its content. See
+    FingerprintHasher"""
+    hasher = FingerprintHasher(hash_name=hash_name, coerce_mmap=coerce_mmap,
+                               sample_size=sample_size, exts=exts)
+    return hasher.hash(obj)
+
+
+class _FingerprintMemorizedFunc(MemorizedFunc):
+    def _get_argument_hash(self, *args, **kwargs):
+        return fingerprint_hash(filter_args(self.func, self.ignore,
+                                            args, kwargs),
+                                coerce_mmap=(self.mmap_mode is not None),
+                                sample_size=self.sample_size)
+
+
+class FingerprintMemory(Memory):
+    """
+    joblib Memory whose cached functions hash file-backed arguments
+    (memmaps, paths to records, NIfTI images loaded from disk) by
+    fingerprints of their files, see FingerprintHasher. Other arguments
+    are hashed by content, as with Memory.
+
+    Results are not recomputed if a file changes without changing its
+    size, its modification time or its sampled blocks.
+
+    Parameters
+    ----------
+    All parameters of joblib.Memory, and
+
+    sample_size: int, keyword only
+        Number of bytes of each file read to compute its fingerprint
+    """
+    def __init__(self, *args, sample_size=2 ** 20, **kwargs):
+        Memory.__init__(self, *args, **kwargs)
+        self.sample_size = sample_size
+
+    def cache(self, func=None, ignore=None, verbose=None, mmap_mode=False):
+        cached_func = Memory.cache(self, func, ignore=ignore, verbose=verbose,
+                                   mmap_mode=mmap_mode)
+        if type(cached_func) is MemorizedFunc:
+            cached_func.__class__ = _FingerprintMemorizedFunc
+            cached_func.sample_size = self.sample_size
+        return cached_func
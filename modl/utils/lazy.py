@@ -0,0 +1,66 @@
+"""
+Lazy loading of the public attributes of a package, so that importing it
+does not import heavy optional dependencies (nilearn, pandas, skimage...)
+before they are used.
+"""
+import importlib
+import sys
+import types
+
+
+class _LazyModule(types.ModuleType):
+    """Module type forwarding missing attributes and dir() to the
+    module-level __getattr__ and __dir__, as Python >= 3.7 does natively
+    (PEP 562)"""
+    def __getattr__(self, name):
+        try:
+            getattr_ = self.__dict__['__getattr__']
+        except KeyError:
+            raise AttributeError('module %r has no attribute %r'
+                                 % (self.__name__, name))
+        return getattr_(name)
+
+    def __dir__(self):
+        return self.__dict__['__dir__']()
+
+
+def lazy_attributes(module_name, attributes):
+    """
+    Expose attributes of a module, imported from its submodules on first
+    access.
+
+    To be called at the end of a package __init__, as
+    lazy_attributes(__name__, {'DictFact': '.decomposition.dict_fact'})
+
+    Parameters
+    ----------
+    module_name: str
+        Name of the module to which attributes are added
+
+    attributes: dict
+        Maps each attribute name to the (possibly relative) name of the
+        module defining it. Attributes are added to the module __all__
+    """
+    module = sys.modules[module_name]
+
+    def __getattr__(name):
+        try:
+            submodule = attributes[name]
+        except KeyError:
+            raise AttributeError('module %r has no attribute %r'
+                                 % (module_name, name))
+        value = getattr(importlib.import_module(submodule, module_name),
+                        name)
+        # Later accesses do not go through __getattr__
+        setattr(module, name, value)
+        return value
+
+    def __dir__():
+        return sorted(set(module.__dict__) | set(attributes))
+
+    module.__getattr__ = __getattr__
+    module.__dir__ = __dir__
+    module.__all__ = sorted(set(getattr(module, '__all__', []))
+                            | set(attributes))
+    if sys.version_info < (3, 7):
+        module.__class__ = _LazyModule
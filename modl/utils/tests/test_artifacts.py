@@ -0,0 +1,46 @@
+import threading
+import time
+
+import pytest
+
+from modl.utils.artifacts import ArtifactWriter
+
+
+def test_artifact_writer():
+    written = []
+    writer = ArtifactWriter(max_pending=10, policy='block')
+    for i in range(5):
+        writer.submit(i, written.append, i)
+    writer.flush()
+    assert written == list(range(5))
+    writer.close()
+    with pytest.raises(ValueError):
+        writer.submit(0, written.append, 0)
+
+
+def test_artifact_writer_backpressure():
+    written = []
+    event = threading.Event()
+    writer = ArtifactWriter(max_pending=2, policy='drop')
+    # Block the worker
+    writer.submit('wait', event.wait)
+    time.sleep(0.1)
+    for i in range(4):
+        writer.submit(i, written.append, i)
+    # Same key: coalesced
+    writer.submit(3, written.append, 30)
+    event.set()
+    writer.flush()
+    assert written == [2, 30]
+    assert writer.n_dropped_ == 3
+    writer.close()
+
+
+def test_artifact_writer_error():
+    def fail():
+        raise IOError('disk full')
+    writer = ArtifactWriter()
+    writer.submit('fail', fail)
+    with pytest.raises(IOError):
+        writer.flush()
+    writer.close()
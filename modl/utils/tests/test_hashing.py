@@ -0,0 +1,67 @@
+import os
+import shutil
+import time
+from tempfile import mkdtemp
+
+import numpy as np
+import pytest
+
+from modl.utils.hashing import (FingerprintMemory, fingerprint_file,
+                                fingerprint_hash)
+
+
+@pytest.fixture
+def tmpdir():
+    tmp = mkdtemp()
+    yield tmp
+    shutil.rmtree(tmp)
+
+
+def test_fingerprint_file(tmpdir):
+    filename = os.path.join(tmpdir, 'record.npy')
+    np.save(filename, np.arange(10000.))
+    fingerprint = fingerprint_file(filename, sample_size=1024)
+    assert fingerprint[:2] == (filename, os.path.getsize(filename))
+    assert fingerprint == fingerprint_file(filename, sample_size=1024)
+    # Sampled blocks include the end of the file
+    data = np.load(filename)
+    data[-1] = -1
+    np.save(filename, data)
+    os.utime(filename, (fingerprint[2], fingerprint[2]))
+    assert fingerprint != fingerprint_file(filename, sample_size=1024)
+
+
+def test_fingerprint_hash(tmpdir):
+    filename = os.path.join(tmpdir, 'record.npy')
+    np.save(filename, np.arange(10000.).reshape(100, 100))
+    data = np.load(filename, mmap_mode='r')
+    assert fingerprint_hash(data) == fingerprint_hash(
+        np.load(filename, mmap_mode='r'))
+    # Views are told apart
+    assert fingerprint_hash(data[1:]) != fingerprint_hash(data[2:])
+    assert fingerprint_hash(data[:, 1]) != fingerprint_hash(data[:, 2])
+    # In-memory arrays are hashed by content
+    assert fingerprint_hash(np.asarray(data)) == fingerprint_hash(
+        np.arange(10000.).reshape(100, 100))
+    hash_ = fingerprint_hash([filename, 1])
+    assert hash_ == fingerprint_hash([filename, 1])
+    os.utime(filename, (time.time() + 10, time.time() + 10))
+    assert hash_ != fingerprint_hash([filename, 1])
+
+
+def test_fingerprint_memory(tmpdir):
+    filename = os.path.join(tmpdir, 'record.npy')
+    np.save(filename, np.arange(10000.))
+    calls = []
+
+    def total(data):
+        calls.append(1)
+        return np.sum(data)
+
+    memory = FingerprintMemory(location=os.path.join(tmpdir, 'cache'),
+                               verbose=0)
+    cached_total = memory.cache(total)
+    for _ in range(2):
+        assert cached_total(np.load(filename, mmap_mode='r')) == np.sum(
+            np.arange(10000.))
+    assert len(calls) == 1
@@ -0,0 +1,29 @@
+import subprocess
+import sys
+
+import pytest
+
+
+def _run(code):
+    return subprocess.check_output([sys.executable, '-c', code]).decode()
+
+
+def test_lazy_import():
+    # Estimators do not import their dependencies before being accessed
+    code = ("import sys; import modl; from modl import DictFact; "
+            "print('nilearn' in sys.modules, 'pandas' in sys.modules)")
+    assert _run(code).split() == ['False', 'False']
+    code = ("import sys; from modl.decomposition import fMRIDictFact; "
+            "import modl; assert modl.fMRIDictFact is fMRIDictFact; "
+            "print('nilearn' in sys.modules)")
+    assert _run(code).split() == ['True']
+
+
+def test_lazy_attributes():
+    import modl
+    import modl.datasets
+    assert 'fMRIDictFact' in dir(modl)
+    assert 'fetch_adhd' in modl.datasets.__all__
+    assert 'get_data_dirs' in modl.datasets.__all__
+    with pytest.raises(AttributeError):
+        modl.NotAnEstimator